@@ -0,0 +1,99 @@
+"""
+Benchmark de alta de préstamos contra la base configurada en las variables DB_*.
+
+Compara, para N préstamos:
+- legacy: SELECT del cliente + INSERT + UPDATE del folio (ruta anterior de Add_loan)
+- single: Add_loan (una sentencia por préstamo)
+- batch:  Add_loans en lotes de --batch-size (INSERT multi-fila)
+
+Uso:
+    python benchmarks/bench_add_loan.py --loans 2000 --batch-size 500 --rounds 3
+"""
+import argparse
+import json
+import os
+import statistics
+import sys
+import time
+import warnings
+
+warnings.filterwarnings("ignore")
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import main  # noqa: E402
+
+add_loan = main.Add_loan.fn.__wrapped__
+add_loans = main.Add_loans.fn.__wrapped__
+
+
+def legacy_add_loan(client_id: int, amount: float, rate: float) -> None:
+    today = time.strftime("%Y-%m-%d")
+    conn = main.get_db_connection()
+    cursor = conn.cursor()
+    cursor.execute("SELECT id, name FROM clients WHERE id = %s", (client_id,))
+    cursor.fetchone()
+    cursor.execute(
+        "INSERT INTO loans (client_id, original_amount, current_balance, granting_date, interest_rate, start_date, status) "
+        "VALUES (%s, %s, %s, %s, %s, %s, 'active') RETURNING id",
+        (client_id, amount, amount, today, rate, today)
+    )
+    loan_id = cursor.fetchone()["id"]
+    cursor.execute("UPDATE loans SET folio = %s WHERE id = %s RETURNING id", (f"F-{loan_id:07d}", loan_id))
+    cursor.fetchone()
+    conn.commit()
+    cursor.close()
+    conn.close()
+
+
+def timed(fn) -> float:
+    started = time.perf_counter()
+    fn()
+    return time.perf_counter() - started
+
+
+def main_bench() -> int:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--loans", type=int, default=2000)
+    parser.add_argument("--batch-size", type=int, default=500)
+    parser.add_argument("--rounds", type=int, default=3,
+                        help="Rondas alternando las variantes (la tabla crece; se toma la mediana)")
+    args = parser.parse_args()
+
+    client = main.Add_client.fn.__wrapped__(name="bench", email="bench@example.com", phone="0")
+    client_id = client["client"]["id"]
+    n = args.loans
+
+    def run_legacy():
+        for i in range(n):
+            legacy_add_loan(client_id, 1000 + i, 5)
+
+    def run_single():
+        for i in range(n):
+            result = add_loan(client_id=client_id, original_amount=1000 + i, interest_rate=5)
+            assert "error" not in result, result
+
+    def run_batch():
+        for start in range(0, n, args.batch_size):
+            items = [{"client_id": client_id, "original_amount": 1000 + i, "interest_rate": 5}
+                     for i in range(start, min(start + args.batch_size, n))]
+            result = add_loans(loans=items)
+            assert result.get("failed") == 0, result
+
+    variants = (("legacy", run_legacy), ("single", run_single), ("batch", run_batch))
+    samples = {name: [] for name, _ in variants}
+    for _ in range(args.rounds):
+        for name, fn in variants:
+            samples[name].append(timed(fn))
+    report = {}
+    for name, values in samples.items():
+        elapsed = statistics.median(values)
+        report[name] = {"seconds": round(elapsed, 3), "loans_per_second": round(n / elapsed, 1)}
+    base = report["legacy"]["loans_per_second"]
+    for entry in report.values():
+        entry["speedup"] = round(entry["loans_per_second"] / base, 2)
+    print(json.dumps({"loans": n, "batch_size": args.batch_size, "rounds": args.rounds, "results": report}, indent=2))
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main_bench())
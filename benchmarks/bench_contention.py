@@ -0,0 +1,164 @@
+"""
+Benchmark de contención: muchos clientes pagando el mismo préstamo a la vez.
+
+Crea un préstamo "caliente" con un statement y lanza --clients hilos que llaman en bucle a
+Register_interest_payment (80%), Generate_late_fee (10%) y Register_principal_payment (10%)
+sobre ese préstamo. Al final verifica la consistencia con verify_ledger (cadena de saldos,
+saldo del préstamo, interest_paid vs pagos) y además que interest_paid / late_fee_generated
+del statement y el saldo del préstamo coincidan con la suma de los movimientos.
+
+--legacy corre además la versión anterior de Register_interest_payment (leer en Python,
+sumar y escribir), para comparar throughput y mostrar las actualizaciones perdidas.
+
+Uso:
+    DB_POOL_MAX=40 python benchmarks/bench_contention.py --clients 32 --calls 50
+"""
+import argparse
+import json
+import os
+import random
+import sys
+import threading
+import time
+import warnings
+
+warnings.filterwarnings("ignore")
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import main  # noqa: E402
+
+interest_payment = main.Register_interest_payment.fn.__wrapped__
+principal_payment = main.Register_principal_payment.fn.__wrapped__
+late_fee = main.Generate_late_fee.fn.__wrapped__
+PERIOD = "2000-01"
+
+
+def legacy_interest_payment(loan_id: int, period: str, amount: float, **_) -> dict:
+    # Ruta anterior: lectura sin lock y escritura del valor calculado en Python
+    conn = main.get_db_connection()
+    cursor = conn.cursor()
+    cursor.execute("SELECT id, current_balance FROM loans WHERE id = %s", (loan_id,))
+    loan = cursor.fetchone()
+    cursor.execute("SELECT id, interest_generated, interest_paid, status FROM statements WHERE loan_id = %s AND period = %s",
+                   (loan_id, period))
+    stmt = cursor.fetchone()
+    new_interest_paid = round(float(stmt["interest_paid"]) + amount, 2)
+    prev_bal = float(loan["current_balance"])
+    cursor.execute("""
+        INSERT INTO movements (loan_id, movement_type, amount, previous_balance, new_balance,
+                               movement_date, application_period, note)
+        VALUES (%s, 'interest_payment', %s, %s, %s, CURRENT_DATE, %s, 'bench')
+    """, (loan_id, amount, prev_bal, prev_bal, period))
+    cursor.execute("UPDATE statements SET interest_paid = %s, status = 'partial' WHERE id = %s", (new_interest_paid, stmt["id"]))
+    conn.commit()
+    cursor.close()
+    conn.close()
+    return {"success": True}
+
+
+def setup_hot_loan() -> int:
+    client = main.Add_client.fn.__wrapped__(name="bench-contention", email="bench@example.com", phone="0")
+    loan = main.Add_loan.fn.__wrapped__(client_id=client["client"]["id"], original_amount=1_000_000,
+                                        interest_rate=5, granting_date="1999-12-01", start_date="1999-12-01")
+    loan_id = loan["loan"]["id"]
+    conn = main.get_db_connection()
+    cursor = conn.cursor()
+    cursor.execute("""
+        INSERT INTO statements (loan_id, period, initial_balance, final_balance, interest_generated, cut_off_date, due_date)
+        VALUES (%s, %s, 1000000, 1000000, 1000000, '2000-01-01', '2000-01-11')
+    """, (loan_id, PERIOD))
+    conn.commit()
+    cursor.close()
+    conn.close()
+    return loan_id
+
+
+def check(loan_id: int) -> dict:
+    conn = main.get_db_connection()
+    cursor = conn.cursor()
+    cursor.execute("""
+        SELECT s.interest_paid, s.late_fee_generated, l.original_amount, l.current_balance,
+               (SELECT COALESCE(SUM(amount), 0) FROM movements WHERE loan_id = l.id AND movement_type = 'interest_payment') AS paid,
+               (SELECT COALESCE(SUM(amount), 0) FROM movements WHERE loan_id = l.id AND movement_type = 'late_fee_charge') AS fees,
+               (SELECT COALESCE(SUM(amount), 0) FROM movements WHERE loan_id = l.id AND movement_type = 'principal_payment') AS principal
+        FROM statements s JOIN loans l ON l.id = s.loan_id
+        WHERE s.loan_id = %s AND s.period = %s
+    """, (loan_id, PERIOD))
+    row = cursor.fetchone()
+    cursor.close()
+    conn.close()
+    ledger = [d for d in main.verify_ledger(full=True)["details"] if d.get("loan_id") == loan_id]
+    return {
+        "interest_paid_ok": row["interest_paid"] == row["paid"],
+        "lost_interest": float(row["paid"] - row["interest_paid"]),
+        "late_fee_ok": row["late_fee_generated"] == row["fees"],
+        "balance_ok": row["current_balance"] == row["original_amount"] - row["principal"],
+        "ledger_discrepancies": len(ledger),
+    }
+
+
+def run(clients: int, calls: int, pay_interest) -> dict:
+    loan_id = setup_hot_loan()
+    latencies = []
+    errors = []
+    lock = threading.Lock()
+
+    def worker():
+        rng = random.Random()
+        for _ in range(calls):
+            pick = rng.random()
+            started = time.perf_counter()
+            if pick < 0.8:
+                result = pay_interest(loan_id=loan_id, period=PERIOD, amount=0.01)
+            elif pick < 0.9:
+                result = late_fee(loan_id=loan_id, period=PERIOD, late_fee_amount=1)
+            else:
+                result = principal_payment(loan_id=loan_id, amount=1)
+            elapsed = time.perf_counter() - started
+            with lock:
+                latencies.append(elapsed)
+                if "error" in result:
+                    errors.append(result["error"])
+
+    threads = [threading.Thread(target=worker) for _ in range(clients)]
+    started = time.perf_counter()
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    elapsed = time.perf_counter() - started
+    latencies.sort()
+    report = {
+        "calls": len(latencies),
+        "errors": len(errors),
+        "seconds": round(elapsed, 2),
+        "calls_per_second": round(len(latencies) / elapsed, 1),
+        "p50_ms": round(latencies[len(latencies) // 2] * 1000, 2),
+        "p99_ms": round(latencies[int(len(latencies) * 0.99) - 1] * 1000, 2),
+    }
+    report.update(check(loan_id))
+    if errors:
+        report["first_error"] = errors[0]
+    return report
+
+
+def main_bench() -> int:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--clients", type=int, default=32)
+    parser.add_argument("--calls", type=int, default=50, help="Llamadas por cliente")
+    parser.add_argument("--legacy", action="store_true", help="Incluir la ruta anterior de pagos de interés")
+    args = parser.parse_args()
+
+    if main.DB_POOL_MAX < args.clients:
+        print(f"Aviso: DB_POOL_MAX={main.DB_POOL_MAX} < clientes={args.clients}; el pool limita la concurrencia.",
+              file=sys.stderr)
+    results = {"atomic": run(args.clients, args.calls, interest_payment)}
+    if args.legacy:
+        results["legacy"] = run(args.clients, args.calls, legacy_interest_payment)
+    print(json.dumps({"clients": args.clients, "calls_per_client": args.calls, "results": results}, indent=2))
+    ok = results["atomic"]
+    return 0 if ok["interest_paid_ok"] and ok["late_fee_ok"] and ok["balance_ok"] and not ok["ledger_discrepancies"] else 1
+
+
+if __name__ == "__main__":
+    sys.exit(main_bench())
@@ -0,0 +1,66 @@
+"""
+Benchmark de Export_period contra la base configurada en las variables DB_*.
+
+Exporta el rango pedido en CSV comprimido (y Parquet si pyarrow está instalado) y reporta
+filas por segundo y el pico de memoria del proceso (RSS), que debe mantenerse constante
+sin importar el tamaño del rango.
+
+Uso:
+    python benchmarks/bench_export.py 2025-01 2025-12 --output-dir /tmp/export-bench
+"""
+import argparse
+import json
+import os
+import resource
+import shutil
+import sys
+import warnings
+
+warnings.filterwarnings("ignore")
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import main  # noqa: E402
+
+
+def main_bench() -> int:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("from_period")
+    parser.add_argument("to_period")
+    parser.add_argument("--output-dir", default="/tmp/export-bench")
+    parser.add_argument("--parallelism", type=int, default=4)
+    parser.add_argument("--keep", action="store_true", help="No borrar los archivos exportados")
+    args = parser.parse_args()
+
+    formats = ["csv"]
+    try:
+        import pyarrow  # noqa: F401
+        formats.append("parquet")
+    except ImportError:
+        pass
+
+    report = {}
+    for file_format in formats:
+        output_dir = os.path.join(args.output_dir, file_format)
+        shutil.rmtree(output_dir, ignore_errors=True)
+        manifest = main.export_period(args.from_period, args.to_period, file_format=file_format,
+                                      output_dir=output_dir, parallelism=args.parallelism)
+        rows = sum(manifest["rows"].values())
+        seconds = manifest["elapsed_ms"] / 1000
+        report[file_format] = {
+            "files": len(manifest["files"]),
+            "rows": manifest["rows"],
+            "seconds": round(seconds, 2),
+            "rows_per_second": round(rows / seconds) if seconds else None,
+            "megabytes": round(manifest["bytes"] / 1e6, 1),
+            # ru_maxrss está en KB en Linux
+            "peak_rss_mb": round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024, 1)
+        }
+        if not args.keep:
+            shutil.rmtree(output_dir, ignore_errors=True)
+    print(json.dumps({"from_period": args.from_period, "to_period": args.to_period,
+                      "parallelism": args.parallelism, "results": report}, indent=2))
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main_bench())
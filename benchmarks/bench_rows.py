@@ -0,0 +1,112 @@
+"""
+Microbenchmark de serialización de filas en herramientas de lectura.
+
+Crea un préstamo con --rows movimientos y compara Get_loan_movements:
+- legacy: RealDictCursor + un dict por fila con float()/strftime() (ruta anterior)
+- json:   json_agg en Postgres vía _fetch_json_rows (ruta actual)
+
+Verifica que ambas rutas devuelvan exactamente la misma lista y reporta la mediana de --rounds.
+
+Uso:
+    python benchmarks/bench_rows.py --rows 100000 --rounds 5
+"""
+import argparse
+import json
+import os
+import statistics
+import sys
+import time
+import tracemalloc
+import warnings
+
+warnings.filterwarnings("ignore")
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import main  # noqa: E402
+
+get_movements = main.Get_loan_movements.fn.__wrapped__
+
+
+def legacy_get_movements(loan_id: int) -> list:
+    conn = main.get_db_connection()
+    cursor = conn.cursor()
+    cursor.execute("""
+        SELECT id, loan_id, movement_type, amount, previous_balance, new_balance,
+        movement_date, application_period, reference, note
+        FROM movements
+        WHERE loan_id = %s
+        ORDER BY movement_date DESC, id DESC
+    """, (loan_id,))
+    rows = cursor.fetchall()
+    cursor.close()
+    conn.close()
+    movements = []
+    for row in rows:
+        movements.append({
+            "id": row["id"],
+            "loan_id": row["loan_id"],
+            "movement_type": row["movement_type"],
+            "amount": float(row["amount"]),
+            "previous_balance": float(row["previous_balance"]),
+            "new_balance": float(row["new_balance"]),
+            "movement_date": row["movement_date"].strftime('%Y-%m-%d'),
+            "application_period": row["application_period"],
+            "reference": row["reference"],
+            "note": row["note"]
+        })
+    return movements
+
+
+def setup_loan(rows: int) -> int:
+    client = main.Add_client.fn.__wrapped__(name="bench-rows", email="bench@example.com", phone="0")
+    loan = main.Add_loan.fn.__wrapped__(client_id=client["client"]["id"], original_amount=1_000_000,
+                                        interest_rate=5, granting_date="2000-01-01", start_date="2000-01-01")
+    loan_id = loan["loan"]["id"]
+    conn = main.get_db_connection()
+    cursor = conn.cursor()
+    cursor.execute("""
+        INSERT INTO movements (loan_id, movement_type, amount, previous_balance, new_balance,
+                               movement_date, application_period, reference, note)
+        SELECT %s, 'interest_payment', 12.34 + (g %% 100), 1000000, 1000000,
+               DATE '2000-01-01' + (g %% 3650), to_char(DATE '2000-01-01' + (g %% 3650), 'YYYY-MM'),
+               'REF-' || g, CASE WHEN g %% 2 = 0 THEN 'bench' END
+        FROM generate_series(1, %s) AS g
+    """, (loan_id, rows))
+    conn.commit()
+    cursor.close()
+    conn.close()
+    return loan_id
+
+
+def measure(fn, loan_id: int, rounds: int) -> dict:
+    times = []
+    for _ in range(rounds):
+        started = time.perf_counter()
+        fn(loan_id)
+        times.append(time.perf_counter() - started)
+    tracemalloc.start()
+    fn(loan_id)
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return {"median_s": round(statistics.median(times), 3), "peak_mb": round(peak / 2**20, 1)}
+
+
+def main_bench() -> int:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--rows", type=int, default=100_000)
+    parser.add_argument("--rounds", type=int, default=5)
+    args = parser.parse_args()
+
+    loan_id = setup_loan(args.rows)
+    same = legacy_get_movements(loan_id) == get_movements(loan_id=loan_id)
+    results = {
+        "legacy": measure(legacy_get_movements, loan_id, args.rounds),
+        "json": measure(lambda i: get_movements(loan_id=i), loan_id, args.rounds),
+    }
+    results["speedup"] = round(results["legacy"]["median_s"] / results["json"]["median_s"], 2)
+    print(json.dumps({"rows": args.rows, "identical": same, "results": results}, indent=2))
+    return 0 if same else 1
+
+
+if __name__ == "__main__":
+    sys.exit(main_bench())
@@ -0,0 +1,107 @@
+"""
+Benchmark de arranque del servidor MCP.
+
+Mide:
+- Tiempo de importación de main.py (proceso nuevo, mediana de N corridas).
+- Tiempo hasta /ready y hasta la primera respuesta de una herramienta vía SSE,
+  arrancando `python main.py` en un puerto local.
+
+Falla (exit code 1) si se excede el presupuesto configurado.
+
+Uso:
+    python benchmarks/bench_startup.py --runs 5 --import-budget 1.5 --first-response-budget 4
+"""
+import argparse
+import asyncio
+import json
+import os
+import statistics
+import subprocess
+import sys
+import time
+import urllib.request
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def measure_import(runs: int) -> float:
+    samples = []
+    for _ in range(runs):
+        started = time.perf_counter()
+        subprocess.run(
+            [sys.executable, "-W", "ignore", "-c", "import main"],
+            cwd=ROOT, check=True, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL
+        )
+        samples.append(time.perf_counter() - started)
+    return statistics.median(samples)
+
+
+async def _first_tool_response(url: str, deadline: float) -> None:
+    from fastmcp import Client
+
+    while True:
+        try:
+            async with Client(url) as client:
+                await client.call_tool("Get_client_by_id", {"client_id": 0}, raise_on_error=False)
+                return
+        except Exception:
+            if time.perf_counter() > deadline:
+                raise
+            await asyncio.sleep(0.05)
+
+
+def _wait_ready(port: int, deadline: float) -> None:
+    while True:
+        try:
+            with urllib.request.urlopen(f"http://127.0.0.1:{port}/ready", timeout=1) as resp:
+                if resp.status == 200:
+                    return
+        except Exception:
+            if time.perf_counter() > deadline:
+                raise
+        time.sleep(0.05)
+
+
+def measure_server(port: int, timeout: float) -> dict:
+    env = dict(os.environ, MCP_HOST="127.0.0.1", MCP_PORT=str(port), LOG_LEVEL="WARNING")
+    started = time.perf_counter()
+    proc = subprocess.Popen(
+        [sys.executable, "-W", "ignore", "main.py"],
+        cwd=ROOT, env=env, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL
+    )
+    try:
+        asyncio.run(_first_tool_response(f"http://127.0.0.1:{port}/sse", started + timeout))
+        first_response = time.perf_counter() - started
+        try:
+            _wait_ready(port, started + timeout)
+            ready = time.perf_counter() - started
+        except Exception:
+            ready = None
+        return {"first_tool_response_s": round(first_response, 3), "ready_s": round(ready, 3) if ready else None}
+    finally:
+        proc.terminate()
+        proc.wait(timeout=10)
+
+
+def main() -> int:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--runs", type=int, default=5)
+    parser.add_argument("--port", type=int, default=3901)
+    parser.add_argument("--timeout", type=float, default=30.0)
+    parser.add_argument("--import-budget", type=float, default=float(os.getenv("STARTUP_IMPORT_BUDGET_S", "2.0")))
+    parser.add_argument("--first-response-budget", type=float, default=float(os.getenv("STARTUP_FIRST_RESPONSE_BUDGET_S", "5.0")))
+    args = parser.parse_args()
+
+    report = {"import_s": round(measure_import(args.runs), 3)}
+    report.update(measure_server(args.port, args.timeout))
+    report["budget"] = {"import_s": args.import_budget, "first_tool_response_s": args.first_response_budget}
+    report["within_budget"] = (
+        report["import_s"] <= args.import_budget
+        and report["first_tool_response_s"] <= args.first_response_budget
+    )
+    print(json.dumps(report, indent=2))
+    return 0 if report["within_budget"] else 1
+
+
+if __name__ == "__main__":
+    sys.exit(main())
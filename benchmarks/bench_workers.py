@@ -0,0 +1,116 @@
+"""
+Prueba de carga del modo multi-worker: arranca `python main.py` con distintos
+valores de MCP_WORKERS y mide throughput de llamadas a herramientas vía SSE.
+
+Cada cliente concurrente abre su propia sesión MCP y llama a la herramienta en bucle
+durante --duration segundos. Requiere una base de datos accesible con las variables DB_*.
+
+Los clientes no hacen pausas, así que el servidor se arranca sin límites de llamadas/s por
+sesión (ADMISSION_LIMITS con rate 0) para medir los workers y no el control de admisión;
+si ADMISSION_LIMITS ya está definida se respeta. Los rechazos de admisión se cuentan
+aparte ("rejected") y no como errores.
+
+Uso:
+    python benchmarks/bench_workers.py --workers 1 2 4 --clients 32 --duration 20 \\
+        --tool Get_loan_by_id --args '{"loan_id": 1}'
+"""
+import argparse
+import asyncio
+import json
+import os
+import subprocess
+import sys
+import time
+import urllib.request
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+NO_RATE_LIMITS = json.dumps({cost: {"rate": 0} for cost in ("light", "report", "batch")})
+
+
+def _wait_ready(port: int, timeout: float) -> None:
+    deadline = time.monotonic() + timeout
+    while True:
+        try:
+            with urllib.request.urlopen(f"http://127.0.0.1:{port}/ready", timeout=1) as resp:
+                if resp.status == 200:
+                    return
+        except Exception:
+            if time.monotonic() > deadline:
+                raise
+        time.sleep(0.2)
+
+
+async def _client_loop(url: str, tool: str, args: dict, stop_at: float, stats: dict) -> None:
+    from fastmcp import Client
+
+    async with Client(url) as client:
+        while time.monotonic() < stop_at:
+            started = time.perf_counter()
+            result = await client.call_tool(tool, args, raise_on_error=False)
+            stats["latencies"].append(time.perf_counter() - started)
+            data = result.structured_content or {}
+            if isinstance(data, dict) and isinstance(data.get("result"), list) and data["result"]:
+                data = data["result"][0]
+            if isinstance(data, dict) and "retry_after_seconds" in data:
+                stats["rejected"] += 1
+            elif result.is_error or (isinstance(data, dict) and "error" in data):
+                stats["errors"] += 1
+            else:
+                stats["ok"] += 1
+
+
+async def _drive(url: str, clients: int, duration: float, tool: str, args: dict) -> dict:
+    stats = {"ok": 0, "errors": 0, "rejected": 0, "latencies": []}
+    stop_at = time.monotonic() + duration
+    started = time.perf_counter()
+    await asyncio.gather(*(_client_loop(url, tool, args, stop_at, stats) for _ in range(clients)))
+    elapsed = time.perf_counter() - started
+    latencies = sorted(stats["latencies"])
+    total = stats["ok"] + stats["errors"] + stats["rejected"]
+    return {
+        "calls": total,
+        "errors": stats["errors"],
+        "rejected": stats["rejected"],
+        "throughput_rps": round(total / elapsed, 1),
+        "p50_ms": round(latencies[len(latencies) // 2] * 1000, 2) if latencies else None,
+        "p99_ms": round(latencies[int(len(latencies) * 0.99) - 1] * 1000, 2) if latencies else None,
+    }
+
+
+def run_case(workers: int, port: int, clients: int, duration: float, tool: str, args: dict) -> dict:
+    env = dict(os.environ, MCP_WORKERS=str(workers), MCP_HOST="127.0.0.1", MCP_PORT=str(port),
+               MCP_WORKER_BASE_PORT=str(port + 100), LOG_LEVEL="WARNING",
+               ADMISSION_LIMITS=os.environ.get("ADMISSION_LIMITS") or NO_RATE_LIMITS)
+    proc = subprocess.Popen([sys.executable, "-W", "ignore", "main.py"], cwd=ROOT, env=env,
+                            stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    try:
+        _wait_ready(port, 60)
+        result = asyncio.run(_drive(f"http://127.0.0.1:{port}/sse", clients, duration, tool, args))
+        result["workers"] = workers
+        return result
+    finally:
+        proc.terminate()
+        proc.wait(timeout=60)
+
+
+def main() -> int:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--workers", type=int, nargs="+", default=[1, 2, 4])
+    parser.add_argument("--clients", type=int, default=32)
+    parser.add_argument("--duration", type=float, default=20.0)
+    parser.add_argument("--port", type=int, default=3910)
+    parser.add_argument("--tool", default="Get_loan_by_id")
+    parser.add_argument("--args", default='{"loan_id": 1}')
+    args = parser.parse_args()
+
+    results = [run_case(w, args.port, args.clients, args.duration, args.tool, json.loads(args.args))
+               for w in args.workers]
+    base = results[0]["throughput_rps"] or 1
+    for r in results:
+        r["speedup"] = round(r["throughput_rps"] / base, 2)
+    print(json.dumps(results, indent=2))
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,331 @@
+"""
+Prueba de carga del servidor MCP vía SSE con mezclas de herramientas configurables.
+
+Arranca `python main.py` localmente (o usa --url contra un servidor ya levantado), abre una
+sesión MCP por cliente virtual y sube la concurrencia por etapas (--stages). Cada cliente
+elige la herramienta según los pesos de --mix y arma los argumentos con ids reales
+tomados de la base (préstamos, clientes y statements pendientes).
+
+Reporta por etapa: throughput, percentiles de latencia, tasa de errores (total y por
+herramienta), rechazos del control de admisión (aparte de los errores) y conexiones a
+Postgres muestreadas de pg_stat_activity. El reporte JSON
+(--report) incluye el commit y la configuración para comparar entre versiones (--compare).
+
+El servidor que se arranca va sin límites de llamadas/s por sesión (ADMISSION_LIMITS con
+rate 0, salvo que ya esté definida): los clientes virtuales no hacen pausas (--think-ms 0)
+y con los límites por defecto se mediría el token bucket, no el servidor.
+
+Atención: las herramientas de escritura (Register_interest_payment, ...) modifican la base.
+
+Uso:
+    python benchmarks/loadtest.py --stages 10 50 100 200 --stage-duration 30 \\
+        --mix Get_loan_by_id=70 Register_interest_payment=20 Get_all_pending_interest_statements=10 \\
+        --report loadtest-report.json --compare loadtest-baseline.json
+"""
+import argparse
+import asyncio
+import json
+import os
+import random
+import subprocess
+import sys
+import threading
+import time
+import urllib.request
+import warnings
+from datetime import datetime
+
+warnings.filterwarnings("ignore")
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+import main  # noqa: E402
+
+NO_RATE_LIMITS = json.dumps({cost: {"rate": 0} for cost in main.ADMISSION_LIMITS})
+DEFAULT_MIX = ["Get_loan_by_id=70", "Register_interest_payment=20", "Get_all_pending_interest_statements=10"]
+
+
+class Fixtures:
+    """Ids reales para armar argumentos de las herramientas."""
+
+    def __init__(self, sample: int):
+        conn = main.get_db_connection()
+        cursor = conn.cursor()
+        cursor.execute("SELECT id, client_id FROM loans WHERE status = 'active' ORDER BY random() LIMIT %s", (sample,))
+        rows = cursor.fetchall()
+        self.loan_ids = [row["id"] for row in rows]
+        self.client_ids = sorted({row["client_id"] for row in rows})
+        cursor.execute("""
+            SELECT loan_id, period FROM statements
+            WHERE status IN ('pending', 'partial')
+            ORDER BY random() LIMIT %s
+        """, (sample,))
+        self.pending = [(row["loan_id"], row["period"]) for row in cursor.fetchall()]
+        cursor.close()
+        conn.close()
+        if not self.loan_ids:
+            raise SystemExit("No hay préstamos activos en la base; carga datos antes de la prueba.")
+
+
+ARG_BUILDERS = {
+    "Get_loan_by_id": lambda f: {"loan_id": random.choice(f.loan_ids)},
+    "Get_loan_statements": lambda f: {"loan_id": random.choice(f.loan_ids)},
+    "Get_loan_movements": lambda f: {"loan_id": random.choice(f.loan_ids)},
+    "Get_loans_by_client": lambda f: {"client_id": random.choice(f.client_ids)},
+    "Get_client_by_id": lambda f: {"client_id": random.choice(f.client_ids)},
+    "Get_pending_interest_payments_by_client_id": lambda f: {"client_id": random.choice(f.client_ids)},
+    "Get_all_pending_interest_statements": lambda f: {},
+    "Check_overdue_statements": lambda f: {},
+    "Get_portfolio_metrics": lambda f: {},
+    "Register_interest_payment": lambda f: dict(zip(("loan_id", "period"), random.choice(f.pending)), amount=0.01),
+}
+
+
+def parse_mix(items):
+    mix = {}
+    for item in items:
+        tool, _, weight = item.partition("=")
+        if tool not in ARG_BUILDERS:
+            raise SystemExit(f"Herramienta sin generador de argumentos: {tool} (disponibles: {', '.join(ARG_BUILDERS)})")
+        mix[tool] = float(weight or 1)
+    return mix
+
+
+class DbSampler(threading.Thread):
+    """Muestrea conexiones del servidor en pg_stat_activity (por estado) cada --db-sample segundos."""
+
+    def __init__(self, interval: float):
+        super().__init__(name="db-sampler", daemon=True)
+        self.interval = interval
+        self.samples = []
+        self.stage = 0
+        self.stop = threading.Event()
+
+    def run(self):
+        conn = main.get_db_connection()
+        cursor = conn.cursor()
+        try:
+            while not self.stop.wait(self.interval):
+                cursor.execute("""
+                    SELECT COALESCE(state, 'unknown') AS state, COUNT(*) AS connections
+                    FROM pg_stat_activity
+                    WHERE datname = current_database() AND pid <> pg_backend_pid() AND backend_type = 'client backend'
+                    GROUP BY 1
+                """)
+                by_state = {row["state"]: row["connections"] for row in cursor.fetchall()}
+                conn.rollback()
+                self.samples.append((self.stage, by_state))
+        finally:
+            cursor.close()
+            conn.close()
+
+    def summary(self, stage: int) -> dict:
+        samples = [s for i, s in self.samples if i == stage]
+        if not samples:
+            return {}
+        totals = [sum(s.values()) for s in samples]
+        states = sorted({state for s in samples for state in s})
+        return {
+            "max": max(totals),
+            "avg": round(sum(totals) / len(totals), 1),
+            "max_by_state": {state: max(s.get(state, 0) for s in samples) for state in states}
+        }
+
+
+def percentile(values, pct: float):
+    if not values:
+        return None
+    index = max(0, min(len(values) - 1, int(round(pct / 100 * len(values) + 0.5)) - 1))
+    return round(values[index] * 1000, 2)
+
+
+def latency_summary(records) -> dict:
+    latencies = sorted(r[1] for r in records)
+    rejected = sum(1 for r in records if r[4])
+    errors = sum(1 for r in records if not r[2] and not r[4])
+    return {
+        "calls": len(records),
+        "errors": errors,
+        "error_rate": round(errors / len(records), 4) if records else 0.0,
+        "rejected": rejected,
+        "rejection_rate": round(rejected / len(records), 4) if records else 0.0,
+        "p50_ms": percentile(latencies, 50),
+        "p90_ms": percentile(latencies, 90),
+        "p99_ms": percentile(latencies, 99),
+        "max_ms": round(latencies[-1] * 1000, 2) if latencies else None,
+    }
+
+
+class LoadTest:
+    def __init__(self, url: str, mix: dict, fixtures: Fixtures, think_ms: float):
+        self.url = url
+        self.tools = list(mix)
+        self.weights = list(mix.values())
+        self.fixtures = fixtures
+        self.think = think_ms / 1000
+        self.stage = 0
+        self.records = []  # (stage, latency, ok, tool, rejected)
+        self.session_errors = {}
+        self.running = True
+
+    async def user(self):
+        from fastmcp import Client
+
+        try:
+            async with Client(self.url) as client:
+                while self.running:
+                    tool = random.choices(self.tools, self.weights)[0]
+                    stage = self.stage
+                    started = time.perf_counter()
+                    try:
+                        result = await client.call_tool(tool, ARG_BUILDERS[tool](self.fixtures), raise_on_error=False)
+                        data = result.structured_content or {}
+                        if isinstance(data, dict) and isinstance(data.get("result"), list) and data["result"]:
+                            data = data["result"][0]
+                        ok = not result.is_error and not (isinstance(data, dict) and "error" in data)
+                        # Rechazo del control de admisión (rate/cola/timeout), no una falla
+                        rejected = isinstance(data, dict) and "retry_after_seconds" in data
+                    except Exception:
+                        ok = rejected = False
+                    self.records.append((stage, time.perf_counter() - started, ok, tool, rejected))
+                    if self.think:
+                        await asyncio.sleep(self.think)
+        except Exception as e:
+            key = type(e).__name__
+            self.session_errors[key] = self.session_errors.get(key, 0) + 1
+
+    async def run(self, stages, stage_duration: float, sampler: DbSampler):
+        tasks = []
+        results = []
+        for index, clients in enumerate(stages):
+            self.stage = sampler.stage = index
+            while len(tasks) < clients:
+                tasks.append(asyncio.create_task(self.user()))
+            started = time.perf_counter()
+            await asyncio.sleep(stage_duration)
+            elapsed = time.perf_counter() - started
+            records = [r for r in self.records if r[0] == index]
+            stage = {"clients": clients, "seconds": round(elapsed, 1)}
+            stage.update(latency_summary(records))
+            stage["throughput_rps"] = round(len(records) / elapsed, 1)
+            stage["tools"] = {tool: latency_summary([r for r in records if r[3] == tool]) for tool in self.tools}
+            stage["db_connections"] = sampler.summary(index)
+            results.append(stage)
+            print(f"etapa {index + 1}/{len(stages)}: {clients} clientes, {stage['throughput_rps']} rps, "
+                  f"p99 {stage['p99_ms']} ms, errores {stage['error_rate']:.2%}, "
+                  f"rechazos {stage['rejection_rate']:.2%}, "
+                  f"conexiones BD máx {stage['db_connections'].get('max')}", file=sys.stderr)
+        self.running = False
+        await asyncio.wait(tasks, timeout=30)
+        return results
+
+
+def _wait_ready(port: int, timeout: float) -> None:
+    deadline = time.monotonic() + timeout
+    while True:
+        try:
+            with urllib.request.urlopen(f"http://127.0.0.1:{port}/ready", timeout=1) as resp:
+                if resp.status == 200:
+                    return
+        except Exception:
+            if time.monotonic() > deadline:
+                raise
+        time.sleep(0.2)
+
+
+def _git_commit() -> str:
+    try:
+        return subprocess.check_output(["git", "rev-parse", "--short", "HEAD"], cwd=ROOT, text=True).strip()
+    except Exception:
+        return "unknown"
+
+
+def compare(report: dict, baseline: dict) -> None:
+    print(f"\ncomparación con {baseline['meta']['commit']} ({baseline['meta']['started_at']}):", file=sys.stderr)
+    previous = {stage["clients"]: stage for stage in baseline["stages"]}
+    for stage in report["stages"]:
+        old = previous.get(stage["clients"])
+        if not old:
+            continue
+        rps_delta = (stage["throughput_rps"] / old["throughput_rps"] - 1) if old["throughput_rps"] else 0
+        print(f"  {stage['clients']:>4} clientes: rps {old['throughput_rps']} -> {stage['throughput_rps']} ({rps_delta:+.1%}), "
+              f"p99 {old['p99_ms']} -> {stage['p99_ms']} ms, errores {old['error_rate']:.2%} -> {stage['error_rate']:.2%}",
+              file=sys.stderr)
+
+
+def main_loadtest() -> int:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--url", help="Servidor ya levantado (p. ej. http://127.0.0.1:3000/sse); si no, se arranca uno")
+    parser.add_argument("--workers", type=int, default=1, help="MCP_WORKERS del servidor que se arranca")
+    parser.add_argument("--port", type=int, default=3920)
+    parser.add_argument("--stages", type=int, nargs="+", default=[10, 50, 100, 200])
+    parser.add_argument("--stage-duration", type=float, default=30.0)
+    parser.add_argument("--mix", nargs="+", default=DEFAULT_MIX, help="Herramienta=peso")
+    parser.add_argument("--think-ms", type=float, default=0.0, help="Pausa de cada cliente entre llamadas")
+    parser.add_argument("--sample", type=int, default=5000, help="Ids de la base para armar argumentos")
+    parser.add_argument("--db-sample", type=float, default=1.0, help="Segundos entre muestras de pg_stat_activity")
+    parser.add_argument("--report", help="Ruta del reporte JSON")
+    parser.add_argument("--compare", help="Reporte JSON previo para comparar")
+    parser.add_argument("--seed", type=int)
+    args = parser.parse_args()
+
+    random.seed(args.seed)
+    mix = parse_mix(args.mix)
+    fixtures = Fixtures(args.sample)
+    proc = None
+    url = args.url
+    if not url:
+        env = dict(os.environ, MCP_WORKERS=str(args.workers), MCP_HOST="127.0.0.1", MCP_PORT=str(args.port),
+                   MCP_WORKER_BASE_PORT=str(args.port + 100), LOG_LEVEL="WARNING",
+                   ADMISSION_LIMITS=os.environ.get("ADMISSION_LIMITS") or NO_RATE_LIMITS)
+        proc = subprocess.Popen([sys.executable, "-W", "ignore", "main.py"], cwd=ROOT, env=env,
+                                stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+        url = f"http://127.0.0.1:{args.port}/sse"
+
+    started_at = datetime.now()
+    sampler = DbSampler(args.db_sample)
+    try:
+        if proc:
+            _wait_ready(args.port, 60)
+        sampler.start()
+        test = LoadTest(url, mix, fixtures, args.think_ms)
+        stages = asyncio.run(test.run(args.stages, args.stage_duration, sampler))
+    finally:
+        sampler.stop.set()
+        if proc:
+            proc.terminate()
+            proc.wait(timeout=60)
+
+    report = {
+        "meta": {
+            "commit": _git_commit(),
+            "started_at": started_at.strftime("%Y-%m-%d %H:%M:%S"),
+            "python": sys.version.split()[0],
+        },
+        "config": {
+            "url": url,
+            "workers": None if args.url else args.workers,
+            "db_pool_max": int(os.getenv("DB_POOL_MAX", "10")),
+            "admission_limits": None if args.url else json.loads(os.environ.get("ADMISSION_LIMITS") or NO_RATE_LIMITS),
+            "stages": args.stages,
+            "stage_duration": args.stage_duration,
+            "mix": mix,
+            "think_ms": args.think_ms,
+        },
+        "stages": stages,
+        "session_errors": test.session_errors,
+    }
+    output = json.dumps(report, indent=2, ensure_ascii=False)
+    if args.report:
+        with open(args.report, "w", encoding="utf-8") as f:
+            f.write(output)
+    else:
+        print(output)
+    if args.compare:
+        with open(args.compare, encoding="utf-8") as f:
+            compare(report, json.load(f))
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main_loadtest())
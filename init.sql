@@ -107,4 +107,414 @@ CREATE INDEX IF NOT EXISTS idx_rate_config_dates ON rate_configuration(effective
 -- Insertar configuración de tasas por defecto (si no existe)
 INSERT INTO rate_configuration (loan_type, interest_rate, effective_date, active) 
 VALUES ('interest_on_balance', 10.00, CURRENT_DATE, TRUE)
-ON CONFLICT DO NOTHING;
\ No newline at end of file
+ON CONFLICT DO NOTHING;
+
+-- ==================== AGREGADOS DEL PORTAFOLIO ====================
+-- Tablas de rollup mantenidas por triggers al escribir statements y loans.
+-- Cada fila acumula por (periodo, vencimiento, status) y un shard (pg_backend_pid() % 64):
+-- cada conexión escribe en su propio shard, así transacciones concurrentes sobre préstamos
+-- distintos no compiten por la misma fila ni se bloquean en orden cruzado (deadlocks).
+-- Los shards no tienen otro significado; las lecturas suman todos.
+
+CREATE TABLE IF NOT EXISTS portfolio_statement_rollup (
+    period VARCHAR(20) NOT NULL,
+    due_date DATE NOT NULL,
+    status VARCHAR(10) NOT NULL,
+    shard SMALLINT NOT NULL,
+    statement_count INTEGER NOT NULL DEFAULT 0,
+    initial_balance NUMERIC(16,2) NOT NULL DEFAULT 0,
+    interest_generated NUMERIC(16,2) NOT NULL DEFAULT 0,
+    interest_paid NUMERIC(16,2) NOT NULL DEFAULT 0,
+    principal_paid NUMERIC(16,2) NOT NULL DEFAULT 0,
+    late_fee_generated NUMERIC(16,2) NOT NULL DEFAULT 0,
+    PRIMARY KEY (period, due_date, status, shard)
+);
+
+CREATE TABLE IF NOT EXISTS portfolio_loan_rollup (
+    status VARCHAR(15) NOT NULL,
+    shard SMALLINT NOT NULL,
+    loan_count INTEGER NOT NULL DEFAULT 0,
+    original_amount NUMERIC(16,2) NOT NULL DEFAULT 0,
+    current_balance NUMERIC(16,2) NOT NULL DEFAULT 0,
+    PRIMARY KEY (status, shard)
+);
+
+-- Triggers por sentencia: agrupan las tablas de transición y hacen un solo upsert por
+-- clave, en vez de reescribir la misma fila de rollup una vez por fila modificada (un
+-- corte de N préstamos dejaría N versiones de la fila en una sola transacción).
+-- TG_OP elige qué tablas de transición existen; las claves sin cambio neto no se escriben.
+CREATE OR REPLACE FUNCTION trg_statements_rollup() RETURNS TRIGGER AS $$
+DECLARE
+    changes TEXT := CASE TG_OP
+        WHEN 'INSERT' THEN 'SELECT 1 AS sign, * FROM new_rows'
+        WHEN 'DELETE' THEN 'SELECT -1 AS sign, * FROM old_rows'
+        ELSE 'SELECT -1 AS sign, * FROM old_rows UNION ALL SELECT 1, * FROM new_rows'
+    END;
+BEGIN
+    EXECUTE format($sql$
+        INSERT INTO portfolio_statement_rollup AS r (
+            period, due_date, status, shard, statement_count, initial_balance,
+            interest_generated, interest_paid, principal_paid, late_fee_generated
+        )
+        SELECT period, due_date, status, pg_backend_pid() %% 64, SUM(sign), SUM(sign * initial_balance),
+               SUM(sign * interest_generated), SUM(sign * COALESCE(interest_paid, 0)),
+               SUM(sign * COALESCE(principal_paid, 0)), SUM(sign * COALESCE(late_fee_generated, 0))
+        FROM (%s) c
+        GROUP BY period, due_date, status
+        HAVING SUM(sign) <> 0 OR SUM(sign * initial_balance) <> 0 OR SUM(sign * interest_generated) <> 0
+            OR SUM(sign * COALESCE(interest_paid, 0)) <> 0 OR SUM(sign * COALESCE(principal_paid, 0)) <> 0
+            OR SUM(sign * COALESCE(late_fee_generated, 0)) <> 0
+        ON CONFLICT (period, due_date, status, shard) DO UPDATE SET
+            statement_count = r.statement_count + EXCLUDED.statement_count,
+            initial_balance = r.initial_balance + EXCLUDED.initial_balance,
+            interest_generated = r.interest_generated + EXCLUDED.interest_generated,
+            interest_paid = r.interest_paid + EXCLUDED.interest_paid,
+            principal_paid = r.principal_paid + EXCLUDED.principal_paid,
+            late_fee_generated = r.late_fee_generated + EXCLUDED.late_fee_generated
+    $sql$, changes);
+    RETURN NULL;
+END;
+$$ LANGUAGE plpgsql;
+
+CREATE OR REPLACE FUNCTION trg_loans_rollup() RETURNS TRIGGER AS $$
+DECLARE
+    changes TEXT := CASE TG_OP
+        WHEN 'INSERT' THEN 'SELECT 1 AS sign, * FROM new_rows'
+        WHEN 'DELETE' THEN 'SELECT -1 AS sign, * FROM old_rows'
+        ELSE 'SELECT -1 AS sign, * FROM old_rows UNION ALL SELECT 1, * FROM new_rows'
+    END;
+BEGIN
+    EXECUTE format($sql$
+        INSERT INTO portfolio_loan_rollup AS r (status, shard, loan_count, original_amount, current_balance)
+        SELECT status, pg_backend_pid() %% 64, SUM(sign), SUM(sign * original_amount), SUM(sign * current_balance)
+        FROM (%s) c
+        GROUP BY status
+        HAVING SUM(sign) <> 0 OR SUM(sign * original_amount) <> 0 OR SUM(sign * current_balance) <> 0
+        ON CONFLICT (status, shard) DO UPDATE SET
+            loan_count = r.loan_count + EXCLUDED.loan_count,
+            original_amount = r.original_amount + EXCLUDED.original_amount,
+            current_balance = r.current_balance + EXCLUDED.current_balance
+    $sql$, changes);
+    RETURN NULL;
+END;
+$$ LANGUAGE plpgsql;
+
+-- Backfill inicial (solo si los rollups están vacíos), en el shard de esta conexión como los triggers
+INSERT INTO portfolio_statement_rollup (
+    period, due_date, status, shard, statement_count, initial_balance,
+    interest_generated, interest_paid, principal_paid, late_fee_generated
+)
+SELECT period, due_date, status, pg_backend_pid() % 64, COUNT(*), SUM(initial_balance),
+       SUM(interest_generated), SUM(COALESCE(interest_paid, 0)),
+       SUM(COALESCE(principal_paid, 0)), SUM(COALESCE(late_fee_generated, 0))
+FROM statements
+WHERE NOT EXISTS (SELECT 1 FROM portfolio_statement_rollup)
+GROUP BY period, due_date, status;
+
+INSERT INTO portfolio_loan_rollup (status, shard, loan_count, original_amount, current_balance)
+SELECT status, pg_backend_pid() % 64, COUNT(*), SUM(original_amount), SUM(current_balance)
+FROM loans
+WHERE NOT EXISTS (SELECT 1 FROM portfolio_loan_rollup)
+GROUP BY status;
+
+-- Las tablas de transición no admiten triggers de varios eventos: uno por evento
+DROP TRIGGER IF EXISTS statements_rollup ON statements;
+DROP TRIGGER IF EXISTS loans_rollup ON loans;
+
+CREATE OR REPLACE TRIGGER statements_rollup_insert
+    AFTER INSERT ON statements REFERENCING NEW TABLE AS new_rows
+    FOR EACH STATEMENT EXECUTE FUNCTION trg_statements_rollup();
+
+CREATE OR REPLACE TRIGGER statements_rollup_update
+    AFTER UPDATE ON statements REFERENCING OLD TABLE AS old_rows NEW TABLE AS new_rows
+    FOR EACH STATEMENT EXECUTE FUNCTION trg_statements_rollup();
+
+CREATE OR REPLACE TRIGGER statements_rollup_delete
+    AFTER DELETE ON statements REFERENCING OLD TABLE AS old_rows
+    FOR EACH STATEMENT EXECUTE FUNCTION trg_statements_rollup();
+
+CREATE OR REPLACE TRIGGER loans_rollup_insert
+    AFTER INSERT ON loans REFERENCING NEW TABLE AS new_rows
+    FOR EACH STATEMENT EXECUTE FUNCTION trg_loans_rollup();
+
+CREATE OR REPLACE TRIGGER loans_rollup_update
+    AFTER UPDATE ON loans REFERENCING OLD TABLE AS old_rows NEW TABLE AS new_rows
+    FOR EACH STATEMENT EXECUTE FUNCTION trg_loans_rollup();
+
+CREATE OR REPLACE TRIGGER loans_rollup_delete
+    AFTER DELETE ON loans REFERENCING OLD TABLE AS old_rows
+    FOR EACH STATEMENT EXECUTE FUNCTION trg_loans_rollup();
+
+
+-- ==================== CHECKPOINTS DE SALDO ====================
+-- Snapshot acumulado por préstamo a una fecha (se escribe en cada corte).
+-- Un movimiento está incluido en el checkpoint si movement_date <= as_of_date
+-- y id <= last_movement_id; el resto se reproduce a partir del checkpoint.
+
+CREATE TABLE IF NOT EXISTS loan_checkpoints (
+    loan_id INTEGER NOT NULL REFERENCES loans(id),
+    as_of_date DATE NOT NULL,
+    last_movement_id INTEGER NOT NULL DEFAULT 0,
+    balance NUMERIC(12,2) NOT NULL,
+    interest_charged NUMERIC(14,2) NOT NULL DEFAULT 0,
+    late_fees_charged NUMERIC(14,2) NOT NULL DEFAULT 0,
+    interest_paid NUMERIC(14,2) NOT NULL DEFAULT 0,
+    principal_paid NUMERIC(14,2) NOT NULL DEFAULT 0,
+    adjustments NUMERIC(14,2) NOT NULL DEFAULT 0,
+    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+    PRIMARY KEY (loan_id, as_of_date)
+);
+
+-- Índices para reproducir solo los movimientos posteriores a un checkpoint
+CREATE INDEX IF NOT EXISTS idx_movements_loan_date ON movements(loan_id, movement_date, id);
+CREATE INDEX IF NOT EXISTS idx_movements_loan_id_id ON movements(loan_id, id);
+
+
+-- ==================== VERIFICACIÓN DEL LEDGER ====================
+-- Historial de corridas de Verify_ledger. MAX(to_movement_id) es la marca de agua:
+-- la siguiente corrida solo revisa préstamos con movimientos posteriores.
+
+CREATE TABLE IF NOT EXISTS ledger_verification_runs (
+    id SERIAL PRIMARY KEY,
+    from_movement_id INTEGER NOT NULL,
+    to_movement_id INTEGER NOT NULL,
+    loans_checked INTEGER NOT NULL DEFAULT 0,
+    discrepancies INTEGER NOT NULL DEFAULT 0,
+    details JSONB,
+    started_at TIMESTAMP NOT NULL,
+    finished_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+);
+
+
+-- ==================== VERSIONES DE DATOS ====================
+-- Contadores transaccionales para invalidar cachés en memoria del servidor.
+
+CREATE TABLE IF NOT EXISTS data_versions (
+    name VARCHAR(50) PRIMARY KEY,
+    version BIGINT NOT NULL DEFAULT 0,
+    updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+);
+
+INSERT INTO data_versions (name, version) VALUES ('rate_configuration', 0)
+ON CONFLICT DO NOTHING;
+
+CREATE OR REPLACE FUNCTION trg_rate_configuration_version() RETURNS TRIGGER AS $$
+BEGIN
+    UPDATE data_versions SET version = version + 1, updated_at = CURRENT_TIMESTAMP
+    WHERE name = 'rate_configuration';
+    RETURN NULL;
+END;
+$$ LANGUAGE plpgsql;
+
+CREATE OR REPLACE TRIGGER rate_configuration_version
+    AFTER INSERT OR UPDATE OR DELETE OR TRUNCATE ON rate_configuration
+    FOR EACH STATEMENT EXECUTE FUNCTION trg_rate_configuration_version();
+
+-- Tipo de préstamo para resolver la tasa desde rate_configuration
+ALTER TABLE loans ADD COLUMN IF NOT EXISTS loan_type VARCHAR(50) NOT NULL DEFAULT 'interest_on_balance';
+
+
+-- ==================== TAREAS PROGRAMADAS ====================
+-- Historial del programador interno. La fila única por (job_name, scheduled_for)
+-- evita que dos réplicas ejecuten el mismo disparo.
+
+CREATE TABLE IF NOT EXISTS job_runs (
+    id SERIAL PRIMARY KEY,
+    job_name VARCHAR(50) NOT NULL,
+    scheduled_for TIMESTAMP NOT NULL,
+    started_at TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP,
+    finished_at TIMESTAMP,
+    status VARCHAR(20) NOT NULL DEFAULT 'running', -- running, succeeded, interrupted, failed, abandoned
+    processed INTEGER NOT NULL DEFAULT 0,
+    summary JSONB,
+    error TEXT,
+    host VARCHAR(255),
+    UNIQUE (job_name, scheduled_for)
+);
+
+CREATE INDEX IF NOT EXISTS idx_job_runs_job_started ON job_runs(job_name, started_at DESC);
+
+
+-- ==================== OUTBOX DE EVENTOS ====================
+-- Cada mutación agrega eventos compactos en la misma transacción (triggers por sentencia
+-- con tablas de transición: un solo INSERT por sentencia, también en los caminos masivos).
+-- El dispatcher entrega en orden (txid, id) y solo eventos con txid < xmin del snapshot
+-- actual: así ninguna transacción aún abierta puede confirmar después un evento "anterior".
+
+CREATE TABLE IF NOT EXISTS outbox_events (
+    id BIGSERIAL PRIMARY KEY,
+    txid BIGINT NOT NULL DEFAULT txid_current(),
+    event_type VARCHAR(50) NOT NULL,
+    loan_id INTEGER,
+    payload JSONB NOT NULL,
+    created_at TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP
+);
+
+CREATE INDEX IF NOT EXISTS idx_outbox_events_txid_id ON outbox_events(txid, id);
+
+-- Posición de cada consumidor (sink) del dispatcher
+CREATE TABLE IF NOT EXISTS outbox_consumers (
+    name VARCHAR(50) PRIMARY KEY,
+    last_txid BIGINT NOT NULL DEFAULT 0,
+    last_event_id BIGINT NOT NULL DEFAULT 0,
+    delivered BIGINT NOT NULL DEFAULT 0,
+    last_error TEXT,
+    updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+);
+
+CREATE OR REPLACE FUNCTION trg_outbox_movements() RETURNS TRIGGER AS $$
+BEGIN
+    INSERT INTO outbox_events (event_type, loan_id, payload)
+    SELECT 'movement.' || n.movement_type, n.loan_id, jsonb_build_object(
+        'movement_id', n.id, 'loan_id', n.loan_id, 'amount', n.amount,
+        'new_balance', n.new_balance, 'movement_date', n.movement_date,
+        'period', n.application_period, 'reference', n.reference
+    )
+    FROM new_rows n
+    ORDER BY n.id;
+    RETURN NULL;
+END;
+$$ LANGUAGE plpgsql;
+
+CREATE OR REPLACE FUNCTION trg_outbox_loans_insert() RETURNS TRIGGER AS $$
+BEGIN
+    INSERT INTO outbox_events (event_type, loan_id, payload)
+    SELECT 'loan.created', n.id, jsonb_build_object(
+        'loan_id', n.id, 'client_id', n.client_id, 'folio', n.folio, 'loan_type', n.loan_type,
+        'original_amount', n.original_amount, 'interest_rate', n.interest_rate,
+        'granting_date', n.granting_date
+    )
+    FROM new_rows n
+    ORDER BY n.id;
+    RETURN NULL;
+END;
+$$ LANGUAGE plpgsql;
+
+CREATE OR REPLACE FUNCTION trg_outbox_loans_update() RETURNS TRIGGER AS $$
+BEGIN
+    INSERT INTO outbox_events (event_type, loan_id, payload)
+    SELECT 'loan.status_changed', n.id, jsonb_build_object(
+        'loan_id', n.id, 'old_status', o.status, 'status', n.status, 'current_balance', n.current_balance
+    )
+    FROM new_rows n
+    JOIN old_rows o ON o.id = n.id
+    WHERE o.status IS DISTINCT FROM n.status
+    ORDER BY n.id;
+    RETURN NULL;
+END;
+$$ LANGUAGE plpgsql;
+
+CREATE OR REPLACE FUNCTION trg_outbox_statements() RETURNS TRIGGER AS $$
+BEGIN
+    INSERT INTO outbox_events (event_type, loan_id, payload)
+    SELECT 'statement.generated', n.loan_id, jsonb_build_object(
+        'statement_id', n.id, 'loan_id', n.loan_id, 'period', n.period,
+        'interest_generated', n.interest_generated, 'cut_off_date', n.cut_off_date, 'due_date', n.due_date
+    )
+    FROM new_rows n
+    ORDER BY n.id;
+    RETURN NULL;
+END;
+$$ LANGUAGE plpgsql;
+
+CREATE OR REPLACE TRIGGER movements_outbox
+    AFTER INSERT ON movements REFERENCING NEW TABLE AS new_rows
+    FOR EACH STATEMENT EXECUTE FUNCTION trg_outbox_movements();
+
+CREATE OR REPLACE TRIGGER loans_outbox_insert
+    AFTER INSERT ON loans REFERENCING NEW TABLE AS new_rows
+    FOR EACH STATEMENT EXECUTE FUNCTION trg_outbox_loans_insert();
+
+CREATE OR REPLACE TRIGGER loans_outbox_update
+    AFTER UPDATE ON loans REFERENCING OLD TABLE AS old_rows NEW TABLE AS new_rows
+    FOR EACH STATEMENT EXECUTE FUNCTION trg_outbox_loans_update();
+
+CREATE OR REPLACE TRIGGER statements_outbox
+    AFTER INSERT ON statements REFERENCING NEW TABLE AS new_rows
+    FOR EACH STATEMENT EXECUTE FUNCTION trg_outbox_statements();
+
+-- ==================== APLICACIÓN DE PAGOS ====================
+-- Apply_client_payment reparte un pago en cascada (mora, interés, capital). La mora pagada
+-- se lleva por statement y en movimientos 'late_fee_payment' (sin cambio de saldo).
+ALTER TABLE statements ADD COLUMN IF NOT EXISTS late_fee_paid NUMERIC(12,2) NOT NULL DEFAULT 0.00;
+ALTER TABLE loan_checkpoints ADD COLUMN IF NOT EXISTS late_fees_paid NUMERIC(14,2) NOT NULL DEFAULT 0;
+
+ALTER TABLE movements DROP CONSTRAINT IF EXISTS movements_movement_type_check;
+ALTER TABLE movements ADD CONSTRAINT movements_movement_type_check CHECK (
+    movement_type IN (
+        'interest_payment',
+        'principal_payment',
+        'interest_charge',
+        'late_fee_charge',
+        'late_fee_payment',
+        'adjustment'
+    )
+);
+
+
+-- ==================== CACHÉ DE REPORTES ====================
+-- Versión de los datos de cartera (clients, loans, statements) para la caché de reportes.
+-- Un solo contador serializaría a todos los escritores sobre la misma fila, así que se
+-- reparte en 64 filas elegidas por backend: la versión es la suma y se lee en el mismo
+-- snapshot que el reporte.
+CREATE TABLE IF NOT EXISTS data_version_shards (
+    name VARCHAR(50) NOT NULL,
+    shard SMALLINT NOT NULL,
+    version BIGINT NOT NULL DEFAULT 0,
+    PRIMARY KEY (name, shard)
+);
+
+INSERT INTO data_version_shards (name, shard)
+SELECT 'portfolio', g FROM generate_series(0, 63) AS g
+ON CONFLICT DO NOTHING;
+
+CREATE OR REPLACE FUNCTION trg_portfolio_version() RETURNS TRIGGER AS $$
+BEGIN
+    UPDATE data_version_shards SET version = version + 1
+    WHERE name = 'portfolio' AND shard = pg_backend_pid() % 64;
+    RETURN NULL;
+END;
+$$ LANGUAGE plpgsql;
+
+CREATE OR REPLACE TRIGGER clients_portfolio_version
+    AFTER INSERT OR UPDATE OR DELETE OR TRUNCATE ON clients
+    FOR EACH STATEMENT EXECUTE FUNCTION trg_portfolio_version();
+
+CREATE OR REPLACE TRIGGER loans_portfolio_version
+    AFTER INSERT OR UPDATE OR DELETE OR TRUNCATE ON loans
+    FOR EACH STATEMENT EXECUTE FUNCTION trg_portfolio_version();
+
+CREATE OR REPLACE TRIGGER statements_portfolio_version
+    AFTER INSERT OR UPDATE OR DELETE OR TRUNCATE ON statements
+    FOR EACH STATEMENT EXECUTE FUNCTION trg_portfolio_version();
+
+
+-- ==================== ARCHIVO DE PRÉSTAMOS CERRADOS ====================
+-- Archive_closed_loans mueve préstamos cerrados (con sus movements y statements) a estas
+-- tablas frías. Tienen las mismas columnas, en el mismo orden, que la tabla caliente
+-- (se copian con INSERT ... SELECT *): una columna nueva en una va también en la otra.
+-- Los checkpoints de saldo se descartan (se recalculan desde los movimientos).
+CREATE TABLE IF NOT EXISTS loans_archive (
+    LIKE loans,
+    archived_at TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP,
+    PRIMARY KEY (id)
+);
+CREATE INDEX IF NOT EXISTS idx_loans_archive_client_id ON loans_archive(client_id);
+
+CREATE TABLE IF NOT EXISTS movements_archive (LIKE movements, PRIMARY KEY (id));
+CREATE INDEX IF NOT EXISTS idx_movements_archive_loan_id ON movements_archive(loan_id);
+
+CREATE TABLE IF NOT EXISTS statements_archive (LIKE statements, PRIMARY KEY (id));
+CREATE INDEX IF NOT EXISTS idx_statements_archive_loan_id ON statements_archive(loan_id);
+
+-- El archivo no cambia la historia del portafolio: mientras la transacción tenga
+-- loans.archiving = 'on' los rollups no restan lo que sale de las tablas calientes.
+CREATE OR REPLACE TRIGGER statements_rollup_delete
+    AFTER DELETE ON statements REFERENCING OLD TABLE AS old_rows
+    FOR EACH STATEMENT WHEN (current_setting('loans.archiving', true) IS DISTINCT FROM 'on')
+    EXECUTE FUNCTION trg_statements_rollup();
+
+CREATE OR REPLACE TRIGGER loans_rollup_delete
+    AFTER DELETE ON loans REFERENCING OLD TABLE AS old_rows
+    FOR EACH STATEMENT WHEN (current_setting('loans.archiving', true) IS DISTINCT FROM 'on')
+    EXECUTE FUNCTION trg_loans_rollup();
@@ -1,22 +1,1113 @@
 import os
+import sys
+import re
+import signal
+import asyncio
+import contextlib
+import contextvars
+import functools
+import inspect
+import json
+import logging
+import subprocess
+import threading
+import time
+import typing
 from typing import List, Optional, Any, Dict
 from datetime import datetime, timedelta
-import psycopg2
-from psycopg2.extras import RealDictCursor
+import anyio
 from fastmcp import FastMCP
+from starlette.requests import Request
+from starlette.responses import JSONResponse
 
-app = FastMCP("Loans-db-server")
+MCP_TOOL_THREADS = int(os.getenv("MCP_TOOL_THREADS", os.getenv("DB_POOL_MAX", "10")))
+_TOOL_NAMES = set()
+
+def _run_in_thread(fn, cost: str = "light"):
+    """
+    Convierte una herramienta síncrona en asíncrona que se ejecuta en un hilo del pool,
+    para que una consulta lenta no bloquee el event loop (ni los streams SSE) del worker.
+    Cada tenant tiene su propio límite de hilos: un corte de mes pesado de un tenant
+    no deja sin hilos (ni sin conexiones) a los demás. Antes pasa por el control de
+    admisión de su clase de costo (ver CONTROL DE ADMISIÓN).
+    """
+    _TOOL_NAMES.add(fn.__name__)
+    returns_list = typing.get_origin(inspect.signature(fn).return_annotation) is list
+
+    @functools.wraps(fn)
+    async def wrapper(*args, **kwargs):
+        started = time.perf_counter()
+        tenant = result = None
+        try:
+            tenant = get_tenant(_request_tenant())
+            async with _admit(tenant, cost):
+                target = _profiled_call(fn.__name__, fn) if _profile_requests else fn
+                call = functools.partial(_run_as_tenant, tenant.name, target, *args, **kwargs)
+                with tenant.track_call():
+                    result = await anyio.to_thread.run_sync(call, limiter=tenant.get_limiter())
+                    return result
+        except _AdmissionRejected as e:
+            result = {"error": f"Error en {fn.__name__}: {e}", "retry_after_seconds": round(e.retry_after, 1)}
+            return [result] if returns_list else result
+        except ValueError as e:
+            if tenant is not None:
+                raise
+            # Tenant faltante o desconocido: mismo formato de error que las herramientas
+            result = {"error": f"Error en {fn.__name__}: {e}"}
+            return [result] if returns_list else result
+        finally:
+            # Sin tenant válido la llamada (fallida) se imputa al tenant por defecto, si existe
+            metrics_tenant = tenant or _TENANTS.get(DB_DEFAULT_TENANT)
+            if metrics_tenant is not None:
+                metrics_tenant.record_call(time.perf_counter() - started, result)
+    return wrapper
+
+class LoansMCP(FastMCP):
+    def tool(self, name_or_fn=None, *, cost: str = "light", **kwargs):
+        if cost not in ADMISSION_LIMITS:
+            raise ValueError(f"Clase de costo desconocida: {cost}.")
+        if not inspect.isroutine(name_or_fn):
+            # @app.tool(...) con argumentos: se registra cuando llegue la función
+            if isinstance(name_or_fn, str):
+                kwargs["name"] = name_or_fn
+            return lambda fn: self.tool(fn, cost=cost, **kwargs)
+        if not inspect.iscoroutinefunction(name_or_fn):
+            name_or_fn = _run_in_thread(name_or_fn, cost)
+        return super().tool(name_or_fn, **kwargs)
+
+app = LoansMCP("Loans-db-server")
+logger = logging.getLogger("loans-mcp")
+
+# ==================== CONEXIÓN A BASE DE DATOS ====================
+# psycopg2 se importa de forma diferida: solo se carga cuando se abre el pool.
+
+DB_POOL_MIN = int(os.getenv("DB_POOL_MIN", "1"))
+DB_POOL_MAX = int(os.getenv("DB_POOL_MAX", "10"))
+DB_POOL_TIMEOUT = float(os.getenv("DB_POOL_TIMEOUT", "30"))
+
+# Un mismo proceso puede atender varias bases (o schemas) de préstamos. DB_TENANTS (JSON)
+# define cada tenant; las claves que falten se toman de DB_*, p. ej.
+# {"norte": {"database": "loans_norte"}, "sur": {"schema": "sur", "pool_max": 5}}
+# Claves: host, port, user, password, database, schema, pool_min, pool_max y tool_threads.
+# DB_POOL_MAX (que el supervisor ya reparte entre workers) es el presupuesto por base: los
+# tenants de una misma base (p. ej. por schema) se lo reparten; los que no fijan pool_max
+# se dividen en partes iguales lo que dejan los que sí, y si no alcanza no se arranca. Sin DB_TENANTS hay un único
+# tenant "default" con DB_*. Cada petición elige su tenant con la cabecera X-Tenant (o
+# _meta.tenant); sin ella se usa DB_DEFAULT_TENANT.
+DB_TENANTS = os.getenv("DB_TENANTS", "").strip()
+DB_DEFAULT_TENANT = os.getenv("DB_DEFAULT_TENANT", "" if DB_TENANTS else "default")
+
+_TENANT_NAME = re.compile(r"^[A-Za-z0-9_-]+$")
+_SCHEMA_NAME = re.compile(r"^[a-z_][a-z0-9_]*$")
+_current_tenant = contextvars.ContextVar("loans_tenant", default=None)
+_ready = threading.Event()
+
+class _Tenant:
+    """
+    Pool de conexiones acotado, cachés y métricas de un tenant. El pool se abre al primer uso.
+    """
+
+    def __init__(self, name: str, config: Dict[str, Any]):
+        schema = config.get("schema")
+        if schema is not None and not _SCHEMA_NAME.match(schema):
+            raise ValueError(f"Schema inválido para el tenant {name}: {schema}.")
+        self.name = name
+        self.schema = schema
+        self.pool_max = max(1, min(int(config.get("pool_max", DB_POOL_MAX)), DB_POOL_MAX))
+        self.pool_min = min(int(config.get("pool_min", DB_POOL_MIN)), self.pool_max)
+        self.tool_threads = int(config.get("tool_threads", MCP_TOOL_THREADS))
+        self._connect_kwargs = {
+            "host": config.get("host", os.getenv("DB_HOST")),
+            "user": config.get("user", os.getenv("DB_USER")),
+            "port": config.get("port", os.getenv("DB_PORT")),
+            "password": config.get("password", os.getenv("DB_PASSWORD")),
+            "database": config.get("database", os.getenv("DB_NAME"))
+        }
+        if schema:
+            self._connect_kwargs["options"] = f"-c search_path={schema}"
+        self.pool = None
+        self.slots = None
+        self._limiter = None
+        self._lock = threading.Lock()
+        self.ready = threading.Event()
+        # Cachés por tenant
+        self.rate_index = None
+        self.rate_index_checked_at = 0.0
+        self.rate_index_lock = threading.Lock()
+        self.loans_id_sequence = None
+        self.report_cache = None
+        self.admission = {}
+        # Métricas
+        self.calls = 0
+        self.errors = 0
+        self.busy_seconds = 0.0
+        self.in_flight = 0
+        self.connections_in_use = 0
+        self.pool_timeouts = 0
+
+    def get_pool(self):
+        if self.pool is None:
+            with self._lock:
+                if self.pool is None:
+                    from psycopg2.pool import ThreadedConnectionPool
+                    from psycopg2.extras import RealDictCursor
+                    self.slots = threading.BoundedSemaphore(self.pool_max)
+                    self.pool = ThreadedConnectionPool(
+                        self.pool_min,
+                        self.pool_max,
+                        cursor_factory=RealDictCursor,
+                        **self._connect_kwargs
+                    )
+        return self.pool, self.slots
+
+    def connect(self):
+        """
+        Conexión propia, fuera del pool y de pool_max, para quien retiene un lock de sesión
+        mientras su trabajo pide conexiones del pool (tareas programadas). Se cierra con close().
+        """
+        import psycopg2
+        from psycopg2.extras import RealDictCursor
+        return psycopg2.connect(cursor_factory=RealDictCursor, **self._connect_kwargs)
+
+    def get_limiter(self):
+        # Se crea dentro del event loop del worker
+        if self._limiter is None:
+            self._limiter = anyio.CapacityLimiter(self.tool_threads)
+        return self._limiter
+
+    def get_admission(self, cost: str):
+        # Se crea dentro del event loop del worker
+        if cost not in self.admission:
+            self.admission[cost] = _AdmissionClass(cost, ADMISSION_LIMITS[cost])
+        return self.admission[cost]
+
+    def get_report_cache(self):
+        if self.report_cache is None:
+            with self._lock:
+                if self.report_cache is None:
+                    self.report_cache = _ReportCache(int(REPORT_CACHE_MB * 2**20))
+        return self.report_cache
+
+    def acquire(self):
+        pool, slots = self.get_pool()
+        if not slots.acquire(timeout=DB_POOL_TIMEOUT):
+            with self._lock:
+                self.pool_timeouts += 1
+            raise TimeoutError(f"No hay conexiones disponibles en el pool del tenant {self.name} después de {DB_POOL_TIMEOUT}s.")
+        try:
+            raw = pool.getconn()
+            if raw.closed:
+                pool.putconn(raw, close=True)
+                raw = pool.getconn()
+        except Exception:
+            slots.release()
+            raise
+        with self._lock:
+            self.connections_in_use += 1
+        return raw
+
+    def release(self, raw):
+        try:
+            if not raw.closed:
+                raw.rollback()
+            self.pool.putconn(raw, close=bool(raw.closed))
+        except Exception:
+            self.pool.putconn(raw, close=True)
+        finally:
+            with self._lock:
+                self.connections_in_use -= 1
+            self.slots.release()
+
+    @contextlib.contextmanager
+    def track_call(self):
+        with self._lock:
+            self.in_flight += 1
+        try:
+            yield
+        finally:
+            with self._lock:
+                self.in_flight -= 1
+
+    def record_call(self, seconds: float, result) -> None:
+        failed = result is None or (isinstance(result, dict) and "error" in result) or (
+            isinstance(result, list) and len(result) == 1 and isinstance(result[0], dict) and "error" in result[0]
+        )
+        with self._lock:
+            self.calls += 1
+            self.errors += failed
+            self.busy_seconds += seconds
+
+    def lock_key(self, key: str) -> str:
+        # Advisory locks distintos por tenant aunque compartan base (tenants por schema)
+        return key if self.name == "default" else f"{key}.{self.name}"
+
+    def status(self) -> Dict[str, Any]:
+        with self._lock:
+            return {
+                "ready": self.ready.is_set(),
+                "schema": self.schema,
+                "pool_max": self.pool_max,
+                "tool_threads": self.tool_threads,
+                "connections_in_use": self.connections_in_use,
+                "pool_timeouts": self.pool_timeouts,
+                "in_flight": self.in_flight,
+                "calls": self.calls,
+                "errors": self.errors,
+                "busy_seconds": round(self.busy_seconds, 3),
+                "rate_index_version": self.rate_index.version if self.rate_index else None,
+                "report_cache": self.report_cache.stats() if self.report_cache else None,
+                "admission": {cost: admission.status() for cost, admission in self.admission.items()}
+            }
+
+def _split_pool_budget(configs: Dict[str, Dict[str, Any]]) -> Dict[str, int]:
+    """pool_max de cada tenant, repartiendo DB_POOL_MAX entre los que comparten base."""
+    groups: Dict[tuple, List[str]] = {}
+    for name, config in configs.items():
+        key = (config.get("host", os.getenv("DB_HOST")), str(config.get("port", os.getenv("DB_PORT"))),
+               config.get("database", os.getenv("DB_NAME")))
+        groups.setdefault(key, []).append(name)
+    sizes = {}
+    for (host, port, database), names in groups.items():
+        fixed = {name: int(configs[name]["pool_max"]) for name in names if "pool_max" in configs[name]}
+        if any(size < 1 for size in fixed.values()):
+            raise ValueError(f"pool_max debe ser al menos 1 (tenants: {', '.join(sorted(fixed))}).")
+        shared = [name for name in names if name not in fixed]
+        free = DB_POOL_MAX - sum(fixed.values())
+        if free < len(shared):
+            raise ValueError(
+                f"Los tenants de la base {database} en {host}:{port} ({', '.join(sorted(names))}) "
+                f"necesitan más de DB_POOL_MAX={DB_POOL_MAX} conexiones."
+            )
+        sizes.update(fixed)
+        sizes.update({name: free // len(shared) for name in shared})
+    return sizes
+
+def _load_tenants() -> Dict[str, _Tenant]:
+    configs = json.loads(DB_TENANTS) if DB_TENANTS else {"default": {}}
+    if not isinstance(configs, dict) or not configs:
+        raise ValueError("DB_TENANTS debe ser un objeto JSON {tenant: configuración}.")
+    for name in configs:
+        if not _TENANT_NAME.match(name):
+            raise ValueError(f"Nombre de tenant inválido: {name}.")
+    if DB_DEFAULT_TENANT and DB_DEFAULT_TENANT not in configs:
+        raise ValueError(f"DB_DEFAULT_TENANT={DB_DEFAULT_TENANT} no está en DB_TENANTS.")
+    configs = {name: dict(config or {}) for name, config in configs.items()}
+    for name, pool_max in _split_pool_budget(configs).items():
+        configs[name]["pool_max"] = pool_max
+    return {name: _Tenant(name, config) for name, config in configs.items()}
+
+_TENANTS = _load_tenants()
+
+def get_tenant(name: Optional[str] = None) -> _Tenant:
+    name = name or _current_tenant.get() or DB_DEFAULT_TENANT
+    if not name:
+        raise ValueError("Se requiere un tenant (cabecera X-Tenant).")
+    tenant = _TENANTS.get(name)
+    if tenant is None:
+        raise ValueError(f"Tenant desconocido: {name}.")
+    return tenant
+
+def _request_tenant() -> Optional[str]:
+    # Cabecera X-Tenant de la petición HTTP (POST de la sesión SSE) o _meta.tenant de la petición MCP
+    from fastmcp.server.dependencies import get_context, get_http_headers
+    tenant = get_http_headers().get("x-tenant")
+    if not tenant:
+        try:
+            meta = get_context().request_context.meta
+            tenant = getattr(meta, "tenant", None) if meta else None
+        except (RuntimeError, ValueError, AttributeError):
+            tenant = None
+    return tenant
+
+def _run_as_tenant(name: str, fn, /, *args, **kwargs):
+    """Ejecuta fn con el tenant activo (hilos de herramientas, del programador y de los executors)."""
+    token = _current_tenant.set(name)
+    try:
+        return fn(*args, **kwargs)
+    finally:
+        _current_tenant.reset(token)
+
+def _start_tenant_thread(tenant: _Tenant, target, name: str) -> threading.Thread:
+    thread = threading.Thread(target=_run_as_tenant, args=(tenant.name, target), daemon=True,
+                              name=name if tenant.name == "default" else f"{name}-{tenant.name}")
+    thread.start()
+    return thread
+
+# Consultas calientes que se ejecutan en cada conexión del pool durante el warm-up
+# para cargar catálogos, planes e índices antes de recibir tráfico.
+_WARMUP_STATEMENTS = [
+    ("SELECT id, name, email, phone, createdate FROM clients WHERE id = %s", (0,)),
+    ("""SELECT l.id, l.client_id, l.original_amount, l.current_balance, l.granting_date,
+               l.interest_rate, l.start_date, l.folio, l.status, c.name as client_name
+        FROM loans l JOIN clients c ON l.client_id = c.id WHERE l.id = %s""", (0,)),
+    ("SELECT id FROM statements WHERE loan_id = %s AND period = %s", (0, "")),
+    ("SELECT id FROM movements WHERE loan_id = %s ORDER BY movement_date DESC, id DESC LIMIT 1", (0,)),
+]
+
+class _PooledConnection:
+    """
+    Envoltura de una conexión del pool. close() devuelve la conexión al pool
+    (haciendo rollback de cualquier transacción abierta) en lugar de cerrarla.
+    """
+
+    def __init__(self, tenant, raw):
+        self._tenant = tenant
+        self._raw = raw
+
+    def __getattr__(self, name):
+        return getattr(self._raw, name)
+
+    def cursor(self, *args, **kwargs):
+        # Solo durante una llamada perfilada se cambia la clase del cursor (ver PERFILADO)
+        if _profiling_active and "cursor_factory" not in kwargs and _profile_session.get() is not None:
+            kwargs["cursor_factory"] = _profiled_cursor_class()
+        return self._raw.cursor(*args, **kwargs)
+
+    def close(self):
+        raw, self._raw = self._raw, None
+        if raw is not None:
+            self._tenant.release(raw)
+
+    def __del__(self):
+        # Red de seguridad para herramientas que salen por excepción sin cerrar
+        if self.__dict__.get("_raw") is not None:
+            self.close()
 
 def get_db_connection():
-    conn = psycopg2.connect(
-        host=os.getenv("DB_HOST"),
-        user=os.getenv("DB_USER"),
-        port=os.getenv("DB_PORT"),
-        password=os.getenv("DB_PASSWORD"),
-        database=os.getenv("DB_NAME"),
-        cursor_factory=RealDictCursor
-    )
-    return conn
+    """Conexión del pool del tenant activo."""
+    tenant = get_tenant()
+    return _PooledConnection(tenant, tenant.acquire())
+
+def _warm_up_tenant(tenant: _Tenant) -> Dict[str, Any]:
+    started = time.perf_counter()
+    conns = [get_db_connection() for _ in range(max(tenant.pool_min, 1))]
+    try:
+        for conn in conns:
+            cursor = conn.cursor()
+            for sql, params in _WARMUP_STATEMENTS:
+                cursor.execute(sql, params)
+                cursor.fetchall()
+            cursor.close()
+        cursor = conns[0].cursor()
+        get_rate_index(cursor)
+        cursor.close()
+    finally:
+        for conn in conns:
+            conn.close()
+    tenant.ready.set()
+    return {
+        "connections": len(conns),
+        "statements": len(_WARMUP_STATEMENTS),
+        "elapsed_ms": round((time.perf_counter() - started) * 1000, 1)
+    }
+
+def warm_up_db() -> Dict[str, Any]:
+    """
+    Abre las conexiones mínimas del pool de cada tenant y ejecuta las consultas calientes en
+    cada una. Marca el servidor como listo (/ready) cuando todos los tenants terminaron.
+    """
+    stats, failed = {}, {}
+    for tenant in _TENANTS.values():
+        if tenant.ready.is_set():
+            continue
+        try:
+            stats[tenant.name] = _run_as_tenant(tenant.name, _warm_up_tenant, tenant)
+        except Exception as e:
+            failed[tenant.name] = str(e)
+    if failed:
+        raise RuntimeError(f"Tenants sin warm-up: {failed}")
+    _ready.set()
+    return stats["default"] if list(stats) == ["default"] else stats
+
+def _warm_up_until_ready(retry_seconds: float = 2.0):
+    while not _ready.is_set():
+        try:
+            stats = warm_up_db()
+            logger.info("Warm-up de base de datos completado: %s", stats)
+        except Exception as e:
+            logger.warning("Warm-up de base de datos falló, reintentando: %s", e)
+            time.sleep(retry_seconds)
+
+@app.custom_route("/health", methods=["GET"])
+async def health_check(request: Request) -> JSONResponse:
+    return JSONResponse({"status": "ok"})
+
+@app.custom_route("/ready", methods=["GET"])
+async def readiness_check(request: Request) -> JSONResponse:
+    if not _ready.is_set():
+        return JSONResponse({
+            "status": "warming_up",
+            "tenants": {name: tenant.ready.is_set() for name, tenant in _TENANTS.items()}
+        }, status_code=503)
+    return JSONResponse({"status": "ready"})
+
+@app.custom_route("/tenants", methods=["GET"])
+async def tenants_status(request: Request) -> JSONResponse:
+    return JSONResponse({"default_tenant": DB_DEFAULT_TENANT or None,
+                         "tenants": {name: tenant.status() for name, tenant in _TENANTS.items()}})
+
+# ==================== CONTROL DE ADMISIÓN ====================
+# Cada herramienta tiene una clase de costo (@app.tool(cost=...)): "light" (lecturas y
+# escrituras puntuales), "report" (recorren la cartera) y "batch" (procesos masivos).
+# Antes de tomar hilo y conexión, cada llamada pasa por:
+# - un token bucket por sesión MCP y clase (rate llamadas/s, ráfaga burst): sin tokens se
+#   rechaza al instante con retry_after_seconds;
+# - un límite de concurrencia por tenant y clase: si está lleno la llamada espera en una
+#   cola de hasta `queue` llamadas y como máximo `timeout` segundos; si no, se rechaza.
+# ADMISSION_LIMITS (JSON) sobrescribe claves por clase, p. ej. {"batch": {"concurrency": 2}}.
+# concurrency/rate en 0 desactivan ese control. Los límites son por worker.
+
+_ADMISSION_DEFAULTS = {
+    "light": {"concurrency": 0, "queue": 0, "timeout": 0, "rate": 20, "burst": 40},
+    "report": {"concurrency": 4, "queue": 16, "timeout": 10, "rate": 1, "burst": 5},
+    "batch": {"concurrency": 1, "queue": 4, "timeout": 30, "rate": 0.1, "burst": 3}
+}
+
+def _load_admission_limits() -> Dict[str, Dict[str, float]]:
+    overrides = json.loads(os.getenv("ADMISSION_LIMITS", "").strip() or "{}")
+    unknown = set(overrides) - set(_ADMISSION_DEFAULTS)
+    if unknown:
+        raise ValueError(f"ADMISSION_LIMITS tiene clases desconocidas: {', '.join(sorted(unknown))}.")
+    return {cost: {**limits, **overrides.get(cost, {})} for cost, limits in _ADMISSION_DEFAULTS.items()}
+
+ADMISSION_LIMITS = _load_admission_limits()
+_ADMISSION_MAX_BUCKETS = 10000
+
+class _AdmissionRejected(Exception):
+    def __init__(self, message: str, retry_after: float):
+        super().__init__(message)
+        self.retry_after = retry_after
+
+class _AdmissionClass:
+    """
+    Límites de una clase de costo en un tenant. Solo se usa desde el event loop del worker,
+    así que los contadores y buckets no necesitan lock.
+    """
+
+    def __init__(self, cost: str, limits: Dict[str, float]):
+        self.cost = cost
+        self.concurrency = int(limits["concurrency"])
+        self.queue = int(limits["queue"])
+        self.timeout = float(limits["timeout"])
+        self.rate = float(limits["rate"])
+        self.burst = max(1.0, float(limits["burst"]))
+        self._limiter = None
+        self._buckets = {}
+        self.running = 0
+        self.queued = 0
+        self.admitted = 0
+        self.rejected = {"rate": 0, "queue_full": 0, "timeout": 0}
+
+    def take_token(self, session: str) -> None:
+        if self.rate <= 0:
+            return
+        now = time.monotonic()
+        tokens, updated = self._buckets.get(session, (self.burst, now))
+        tokens = min(self.burst, tokens + (now - updated) * self.rate)
+        if tokens < 1:
+            self.rejected["rate"] += 1
+            retry_after = (1 - tokens) / self.rate
+            raise _AdmissionRejected(
+                f"límite de {self.rate:g} llamadas/s (ráfaga {self.burst:g}) para herramientas '{self.cost}' "
+                f"excedido en esta sesión; reintentar en {retry_after:.1f}s", retry_after)
+        self._buckets[session] = (tokens - 1, now)
+        if len(self._buckets) > _ADMISSION_MAX_BUCKETS:
+            # Un bucket ya relleno equivale a no tenerlo
+            self._buckets = {
+                key: (t, u) for key, (t, u) in self._buckets.items()
+                if t + (now - u) * self.rate < self.burst
+            }
+
+    @contextlib.asynccontextmanager
+    async def slot(self):
+        if self.concurrency <= 0:
+            self.admitted += 1
+            self.running += 1
+            try:
+                yield
+            finally:
+                self.running -= 1
+            return
+        if self._limiter is None:
+            self._limiter = anyio.CapacityLimiter(self.concurrency)
+        if self._limiter.available_tokens < 1 and self.queued >= self.queue:
+            self.rejected["queue_full"] += 1
+            raise _AdmissionRejected(
+                f"hay {self.running} herramientas '{self.cost}' en curso y {self.queued} en cola; "
+                "reintentar más tarde", self.timeout or 1.0)
+        self.queued += 1
+        try:
+            with anyio.fail_after(self.timeout or None):
+                await self._limiter.acquire()
+        except TimeoutError:
+            self.rejected["timeout"] += 1
+            raise _AdmissionRejected(
+                f"se esperaron {self.timeout:g}s un lugar para herramientas '{self.cost}' sin obtenerlo",
+                self.timeout) from None
+        finally:
+            self.queued -= 1
+        self.admitted += 1
+        self.running += 1
+        try:
+            yield
+        finally:
+            self.running -= 1
+            self._limiter.release()
+
+    def status(self) -> Dict[str, Any]:
+        return {
+            "concurrency": self.concurrency or None,
+            "rate": self.rate or None,
+            "burst": self.burst,
+            "running": self.running,
+            "queued": self.queued,
+            "admitted": self.admitted,
+            "rejected": dict(self.rejected),
+            "sessions": len(self._buckets)
+        }
+
+def _request_session() -> str:
+    from fastmcp.server.dependencies import get_context
+    try:
+        return get_context().session_id
+    except (RuntimeError, ValueError, AttributeError):
+        return "local"
+
+@contextlib.asynccontextmanager
+async def _admit(tenant: _Tenant, cost: str):
+    """Aplica el token bucket de la sesión y el límite de concurrencia de la clase."""
+    admission = tenant.get_admission(cost)
+    admission.take_token(_request_session())
+    async with admission.slot():
+        yield
+
+# ==================== PERFILADO ====================
+# Profile_tool arma el perfilado de las próximas N llamadas de una herramienta en este
+# worker. Sin nada armado el costo es revisar un dict vacío por llamada y un int por cursor.
+# Una llamada perfilada guarda en PROFILE_DIR:
+# - {base}.folded: pilas de Python muestreadas cada PROFILE_SAMPLE_INTERVAL (formato
+#   "a;b;c cuenta" de flamegraph.pl / speedscope), o {base}.pstats con mode="cprofile"
+# - {base}.sql.txt: cada sentencia ejecutada (veces, tiempo total/máximo) con su plan.
+#   Los SELECT sin efectos se re-ejecutan con EXPLAIN (ANALYZE, BUFFERS) en una transacción
+#   que se descarta; las escrituras y los SELECT con locks/efectos solo con EXPLAIN.
+
+PROFILE_DIR = os.getenv("PROFILE_DIR", "profiles")
+PROFILE_SAMPLE_INTERVAL = float(os.getenv("PROFILE_SAMPLE_INTERVAL", "0.005"))
+PROFILE_MAX_EXPLAINS = int(os.getenv("PROFILE_MAX_EXPLAINS", "20"))
+
+_profile_requests: Dict[str, Dict[str, Any]] = {}
+_profile_lock = threading.Lock()
+_profile_session = contextvars.ContextVar("loans_profile", default=None)
+_profiling_active = 0
+_profile_outputs = []
+_profiled_cursor = None
+
+_EXPLAINABLE = re.compile(r"^\s*(SELECT|WITH|INSERT|UPDATE|DELETE)\b", re.IGNORECASE)
+_EXPLAIN_UNSAFE = re.compile(
+    r"\b(INSERT|UPDATE|DELETE|FOR\s+SHARE|FOR\s+KEY\s+SHARE|FOR\s+NO\s+KEY\s+UPDATE|nextval|setval|"
+    r"pg_advisory\w*|pg_try_advisory\w*|pg_notify|pg_export_snapshot|set_config)\b",
+    re.IGNORECASE
+)
+
+def _profiled_cursor_class():
+    global _profiled_cursor
+    if _profiled_cursor is None:
+        from psycopg2.extras import RealDictCursor
+
+        class _ProfiledCursor(RealDictCursor):
+            def execute(self, query, vars=None):
+                started = time.perf_counter()
+                try:
+                    return super().execute(query, vars)
+                finally:
+                    session = _profile_session.get()
+                    if session is not None:
+                        session.record(query, self, time.perf_counter() - started)
+
+        _profiled_cursor = _ProfiledCursor
+    return _profiled_cursor
+
+class _StackSampler:
+    """Muestrea la pila de Python de un hilo y la acumula en formato colapsado."""
+
+    def __init__(self, thread_id: int, interval: float):
+        self.thread_id = thread_id
+        self.interval = interval
+        self.counts: Dict[str, int] = {}
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, name="profile-sampler", daemon=True)
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            frame = sys._current_frames().get(self.thread_id)
+            stack = []
+            while frame is not None:
+                code = frame.f_code
+                stack.append(f"{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})")
+                frame = frame.f_back
+            if stack:
+                key = ";".join(reversed(stack))
+                self.counts[key] = self.counts.get(key, 0) + 1
+
+    def start(self):
+        self._thread.start()
+
+    def stop(self) -> Dict[str, int]:
+        self._stop.set()
+        self._thread.join()
+        return self.counts
+
+class _ProfileSession:
+    """Sentencias agrupadas por texto SQL (sin parámetros); guarda la primera con parámetros para EXPLAIN."""
+    MAX_STATEMENTS = 500
+
+    def __init__(self):
+        self.statements: Dict[str, List[Any]] = {}
+
+    def record(self, query, cursor, seconds: float) -> None:
+        key = query if isinstance(query, str) else str(query)
+        entry = self.statements.get(key)
+        if entry is None:
+            if len(self.statements) >= self.MAX_STATEMENTS or not cursor.query:
+                return
+            entry = self.statements[key] = [0, 0.0, 0.0, cursor.query.decode("utf-8", "replace")]
+        entry[0] += 1
+        entry[1] += seconds
+        entry[2] = max(entry[2], seconds)
+
+def _profiled_call(tool_name: str, fn):
+    """Devuelve fn envuelta en el perfilador si hay perfilado armado para la herramienta."""
+    with _profile_lock:
+        request = _profile_requests.get(tool_name)
+        if request is None:
+            return fn
+        request["remaining"] -= 1
+        if request["remaining"] <= 0:
+            del _profile_requests[tool_name]
+        request = dict(request)
+    return functools.partial(_run_profiled, tool_name, request, fn)
+
+def _explain_statements(statements: Dict[str, List[float]]) -> List[str]:
+    lines = []
+    ranked = sorted(statements.items(), key=lambda item: item[1][1], reverse=True)
+    conn = get_db_connection()
+    cursor = conn.cursor()
+    try:
+        for i, (_, (calls, total, longest, query)) in enumerate(ranked):
+            lines.append(f"-- calls={calls} total_ms={total * 1000:.2f} max_ms={longest * 1000:.2f}")
+            lines.append(query.strip())
+            if i < PROFILE_MAX_EXPLAINS and _EXPLAINABLE.match(query):
+                options = "ANALYZE, BUFFERS" if not _EXPLAIN_UNSAFE.search(query) else "COSTS"
+                try:
+                    cursor.execute("SET LOCAL statement_timeout = '30s'")
+                    cursor.execute(f"EXPLAIN ({options}) {query}")
+                    lines.append(f"-- EXPLAIN ({options})")
+                    lines.extend(row["QUERY PLAN"] for row in cursor.fetchall())
+                except Exception as e:
+                    lines.append(f"-- EXPLAIN falló: {e}")
+                finally:
+                    conn.rollback()
+            lines.append("")
+    finally:
+        cursor.close()
+        conn.close()
+    return lines
+
+def _run_profiled(tool_name: str, request: Dict[str, Any], fn, /, *args, **kwargs):
+    global _profiling_active
+    session = _ProfileSession()
+    token = _profile_session.set(session)
+    with _profile_lock:
+        _profiling_active += 1
+    profiler = sampler = None
+    if request["mode"] == "cprofile":
+        import cProfile
+        profiler = cProfile.Profile()
+    else:
+        sampler = _StackSampler(threading.get_ident(), PROFILE_SAMPLE_INTERVAL)
+        sampler.start()
+    started = time.perf_counter()
+    try:
+        if profiler is not None:
+            return profiler.runcall(fn, *args, **kwargs)
+        return fn(*args, **kwargs)
+    finally:
+        elapsed = time.perf_counter() - started
+        samples = sampler.stop() if sampler is not None else None
+        _profile_session.reset(token)
+        with _profile_lock:
+            _profiling_active -= 1
+        try:
+            tenant = get_tenant()
+            output_dir = PROFILE_DIR if tenant.name == "default" else os.path.join(PROFILE_DIR, tenant.name)
+            os.makedirs(output_dir, exist_ok=True)
+            base = os.path.join(output_dir, f"{tool_name}-{datetime.now().strftime('%Y%m%d-%H%M%S-%f')}")
+            files = []
+            if profiler is not None:
+                profiler.dump_stats(f"{base}.pstats")
+                files.append(f"{base}.pstats")
+            else:
+                with open(f"{base}.folded", "w", encoding="utf-8") as f:
+                    for stack, count in sorted(samples.items()):
+                        f.write(f"{stack} {count}\n")
+                files.append(f"{base}.folded")
+            sql_seconds = sum(entry[1] for entry in session.statements.values())
+            lines = [f"-- {tool_name}: wall_ms={elapsed * 1000:.2f} sql_ms={sql_seconds * 1000:.2f} "
+                     f"statements={sum(entry[0] for entry in session.statements.values())}", ""]
+            lines.extend(_explain_statements(session.statements) if request["explain"] else [])
+            with open(f"{base}.sql.txt", "w", encoding="utf-8") as f:
+                f.write("\n".join(lines))
+            files.append(f"{base}.sql.txt")
+            summary = {
+                "tool": tool_name,
+                "at": datetime.now().strftime('%Y-%m-%d %H:%M:%S'),
+                "wall_ms": round(elapsed * 1000, 2),
+                "sql_ms": round(sql_seconds * 1000, 2),
+                "samples": sum(samples.values()) if samples is not None else None,
+                "files": files
+            }
+            with _profile_lock:
+                _profile_outputs.append(summary)
+                del _profile_outputs[:-50]
+            logger.info("Perfil de %s escrito: %s", tool_name, files)
+        except Exception as e:
+            logger.warning("No se pudo escribir el perfil de %s: %s", tool_name, e)
+
+@app.tool
+def Profile_tool(tool_name: Optional[str] = None, calls: int = 1, mode: str = "sampling", explain: bool = True) -> Dict[str, Any]:
+    """
+    Activa el perfilado de las próximas `calls` llamadas de tool_name en este worker
+    (calls=0 lo desactiva). mode: 'sampling' (pilas para flamegraph) o 'cprofile' (.pstats).
+    explain: guardar los planes de las sentencias SQL ejecutadas.
+    Sin tool_name solo devuelve lo armado y los últimos perfiles escritos.
+    """
+    try:
+        if tool_name is not None:
+            if tool_name not in _TOOL_NAMES:
+                return {"error": f"Herramienta desconocida: {tool_name}."}
+            if mode not in ("sampling", "cprofile"):
+                return {"error": "mode debe ser 'sampling' o 'cprofile'."}
+            with _profile_lock:
+                if calls > 0:
+                    _profile_requests[tool_name] = {"remaining": calls, "mode": mode, "explain": explain}
+                else:
+                    _profile_requests.pop(tool_name, None)
+        with _profile_lock:
+            return {
+                "success": True,
+                "output_dir": os.path.abspath(PROFILE_DIR),
+                "armed": {name: dict(request) for name, request in _profile_requests.items()},
+                "recent": list(reversed(_profile_outputs[-10:]))
+            }
+    except Exception as e:
+        return {"error": f"Error en Profile_tool: {str(e)}"}
+
+# ==================== SERIALIZACIÓN DE FILAS ====================
+# Las herramientas de lectura describen sus columnas como (clave, expresión SQL, tipo) y
+# Postgres arma el JSON de todas las filas con json_agg: psycopg2 entrega directamente la
+# lista de dicts (un solo json.loads en C) sin Decimal/date intermedios ni un segundo dict
+# por fila. El formato es el mismo que float(...) / strftime('%Y-%m-%d').
+
+_JSON_CASTS = {
+    "int": "{}",
+    "text": "{}",
+    # numeric con escala 2: json.loads devuelve float (1000.00 -> 1000.0), igual que float(Decimal)
+    "money": "round({}, 2)",
+    "date": "to_char({}, 'YYYY-MM-DD')",
+    "timestamp": "to_char({}, 'YYYY-MM-DD HH24:MI:SS')"
+}
+
+def _json_object(fields) -> str:
+    return "json_build_object(" + ", ".join(
+        f"'{key}', " + _JSON_CASTS[kind].format(expr) for key, expr, kind in fields
+    ) + ")"
+
+def _fetch_json_rows(cursor, fields, from_sql: str, params=None, order_by: Optional[str] = None) -> List[Dict[str, Any]]:
+    """Ejecuta SELECT json_agg(...) {from_sql} y devuelve las filas ya serializadas."""
+    order = f" ORDER BY {order_by}" if order_by else ""
+    cursor.execute(f"SELECT COALESCE(json_agg({_json_object(fields)}{order}), '[]'::json) AS rows {from_sql}", params)
+    return cursor.fetchone()["rows"]
+
+_CLIENT_JSON = [
+    ("id", "id", "int"), ("name", "name", "text"), ("email", "email", "text"),
+    ("phone", "phone", "text"), ("createdate", "createdate", "date")
+]
+
+_LOAN_JSON = [
+    ("id", "id", "int"), ("client_id", "client_id", "int"), ("folio", "folio", "text"),
+    ("original_amount", "original_amount", "money"), ("current_balance", "current_balance", "money"),
+    ("interest_rate", "interest_rate", "money"), ("granting_date", "granting_date", "date"),
+    ("start_date", "start_date", "date"), ("status", "status", "text")
+]
+
+_STATEMENT_JSON = [
+    ("id", "id", "int"), ("loan_id", "loan_id", "int"), ("period", "period", "text"),
+    ("initial_balance", "initial_balance", "money"), ("final_balance", "final_balance", "money"),
+    ("interest_generated", "interest_generated", "money"), ("interest_paid", "interest_paid", "money"),
+    ("principal_paid", "principal_paid", "money"), ("late_fee_generated", "late_fee_generated", "money"),
+    ("late_fee_paid", "late_fee_paid", "money"), ("cut_off_date", "cut_off_date", "date"), ("due_date", "due_date", "date"), ("status", "status", "text")
+]
+
+_MOVEMENT_JSON = [
+    ("id", "id", "int"), ("loan_id", "loan_id", "int"), ("movement_type", "movement_type", "text"),
+    ("amount", "amount", "money"), ("previous_balance", "previous_balance", "money"),
+    ("new_balance", "new_balance", "money"), ("movement_date", "movement_date", "date"),
+    ("application_period", "application_period", "text"), ("reference", "reference", "text"),
+    ("note", "note", "text")
+]
+
+# Statement pendiente con datos del préstamo (s = statements, l = loans, c = clients)
+_PENDING_STATEMENT_JSON = [
+    ("statement_id", "s.id", "int"), ("loan_id", "s.loan_id", "int"), ("folio", "l.folio", "text"),
+    ("original_amount", "l.original_amount", "money"), ("current_balance", "l.current_balance", "money"),
+    ("period", "s.period", "text"), ("interest_generated", "s.interest_generated", "money"),
+    ("interest_paid", "s.interest_paid", "money"),
+    ("pending_interest", "s.interest_generated - s.interest_paid", "money"),
+    ("due_date", "s.due_date", "date"), ("status", "s.status", "text")
+]
+
+_OVERDUE_STATEMENT_JSON = [
+    ("statement_id", "s.id", "int"), ("loan_id", "s.loan_id", "int"), ("folio", "l.folio", "text"),
+    ("client_id", "l.client_id", "int"), ("client_name", "c.name", "text"), ("period", "s.period", "text"),
+    ("due_date", "s.due_date", "date"), ("days_overdue", "%(as_of)s::date - s.due_date", "int"),
+    ("interest_generated", "s.interest_generated", "money"), ("interest_paid", "s.interest_paid", "money"),
+    ("pending_interest", "s.interest_generated - s.interest_paid", "money"),
+    ("late_fee_generated", "s.late_fee_generated", "money"), ("status", "s.status", "text")
+]
+
+# ==================== CACHÉ DE REPORTES ====================
+# Los reportes de cartera se guardan en memoria por (herramienta, parámetros, versión).
+# La versión es la suma de data_version_shards('portfolio'), que incrementan triggers por
+# sentencia en clients, loans y statements (ver init.sql). Versión y reporte se leen en el
+# mismo snapshot REPEATABLE READ, así que un resultado nunca queda guardado con una versión
+# más nueva que sus datos. Un acierto cuesta una consulta sobre 64 filas en vez del join.
+# Los resultados guardados se comparten entre llamadas: no se deben modificar.
+
+REPORT_CACHE_MB = float(os.getenv("REPORT_CACHE_MB", "64"))
+
+_PORTFOLIO_VERSION_SQL = """
+    SELECT COALESCE(SUM(version), 0)::bigint AS version
+    FROM data_version_shards
+    WHERE name = 'portfolio'
+"""
+
+class _ReportCache:
+    """LRU acotada en bytes (el tamaño se estima por el JSON del resultado)."""
+
+    def __init__(self, max_bytes: int):
+        from collections import OrderedDict
+        self.max_bytes = max_bytes
+        self._entries = OrderedDict()
+        self._bytes = 0
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, key, version: int):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and entry[0] == version:
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return entry[2]
+            if entry is not None and entry[0] < version:
+                del self._entries[key]
+                self._bytes -= entry[1]
+            self.misses += 1
+            return None
+
+    def put(self, key, version: int, size: int, value) -> None:
+        if size > self.max_bytes:
+            return
+        with self._lock:
+            old = self._entries.get(key)
+            if old is not None:
+                # Otro hilo pudo guardar antes el resultado de un snapshot más nuevo
+                if old[0] > version:
+                    return
+                del self._entries[key]
+                self._bytes -= old[1]
+            self._entries[key] = (version, size, value)
+            self._bytes += size
+            while self._bytes > self.max_bytes:
+                _, (_, evicted_size, _) = self._entries.popitem(last=False)
+                self._bytes -= evicted_size
+                self.evictions += 1
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            return {
+                "entries": len(self._entries),
+                "bytes": self._bytes,
+                "max_bytes": self.max_bytes,
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions
+            }
+
+def _cached_report(tool_name: str, params: tuple, compute):
+    """
+    Devuelve compute(cursor) para el tenant activo, desde la caché si la versión de cartera
+    no cambió desde que se guardó (params debe identificar el reporte, fechas ya resueltas).
+    """
+    conn = get_db_connection()
+    try:
+        if REPORT_CACHE_MB <= 0:
+            cursor = conn.cursor()
+            result = compute(cursor)
+            cursor.close()
+            return result
+        cache = get_tenant().get_report_cache()
+        conn.set_session(isolation_level="REPEATABLE READ", readonly=True)
+        cursor = conn.cursor()
+        cursor.execute(_PORTFOLIO_VERSION_SQL)
+        version = cursor.fetchone()["version"]
+        key = (tool_name, params)
+        result = cache.get(key, version)
+        if result is None:
+            result = compute(cursor)
+            cache.put(key, version, len(json.dumps(result)), result)
+        cursor.close()
+        return result
+    finally:
+        conn.rollback()
+        conn.set_session(isolation_level="DEFAULT", readonly="DEFAULT")
+        conn.close()
+
+# ==================== TASAS ====================
+# Índice en memoria sobre rate_configuration: por loan_type, rangos de fechas de vigencia
+# y, dentro de cada uno, rangos de monto con la configuración ganadora ya resuelta.
+# Se carga en el warm-up y se recarga cuando cambia data_versions('rate_configuration').
+
+RATE_REFRESH_SECONDS = float(os.getenv("RATE_REFRESH_SECONDS", "30"))
+DEFAULT_LOAN_TYPE = "interest_on_balance"
+
+class RateIndex:
+    def __init__(self, rows, version: int):
+        from bisect import bisect_right
+        from decimal import Decimal
+
+        self._bisect = bisect_right
+        self._decimal = Decimal
+        self.version = version
+        self.size = len(rows)
+        self._types = {}
+
+        by_type = {}
+        for row in rows:
+            by_type.setdefault(row["loan_type"], []).append(row)
+
+        one_day = timedelta(days=1)
+        cent = Decimal("0.01")
+        for loan_type, type_rows in by_type.items():
+            date_points = sorted(
+                {r["effective_date"] for r in type_rows}
+                | {r["expiration_date"] + one_day for r in type_rows if r["expiration_date"]}
+            )
+            segments = []
+            for start in date_points:
+                active = [
+                    r for r in type_rows
+                    if r["effective_date"] <= start and (r["expiration_date"] is None or start <= r["expiration_date"])
+                ]
+                amount_points = sorted(
+                    {Decimal("-Infinity")}
+                    | {r["min_amount"] for r in active if r["min_amount"] is not None}
+                    | {r["max_amount"] + cent for r in active if r["max_amount"] is not None}
+                )
+                winners = []
+                for low in amount_points:
+                    candidates = [
+                        r for r in active
+                        if (r["min_amount"] is None or r["min_amount"] <= low)
+                        and (r["max_amount"] is None or low <= r["max_amount"])
+                    ]
+                    # Ante traslapes gana la configuración vigente más reciente
+                    winners.append(max(candidates, key=lambda r: (r["effective_date"], r["id"])) if candidates else None)
+                segments.append((amount_points, winners))
+            self._types[loan_type] = (date_points, segments)
+
+    def lookup(self, loan_type: str, amount, on_date) -> Optional[Dict[str, Any]]:
+        entry = self._types.get(loan_type)
+        if entry is None:
+            return None
+        date_points, segments = entry
+        i = self._bisect(date_points, on_date) - 1
+        if i < 0:
+            return None
+        amount_points, winners = segments[i]
+        j = self._bisect(amount_points, self._decimal(str(amount))) - 1
+        return winners[j] if j >= 0 else None
+
+def _load_rate_index(cursor) -> RateIndex:
+    # Se lee la versión antes que las filas: si hay un cambio entre ambas lecturas,
+    # la siguiente verificación ve una versión nueva y recarga otra vez.
+    cursor.execute("SELECT version FROM data_versions WHERE name = 'rate_configuration'")
+    row = cursor.fetchone()
+    version = row["version"] if row else 0
+    cursor.execute("""
+        SELECT id, loan_type, min_amount, max_amount, interest_rate, term_months,
+               effective_date, expiration_date
+        FROM rate_configuration
+        WHERE active
+    """)
+    return RateIndex(cursor.fetchall(), version)
+
+def get_rate_index(cursor=None) -> RateIndex:
+    """Devuelve el índice de tasas del tenant activo, recargándolo si rate_configuration cambió."""
+    tenant = get_tenant()
+    if tenant.rate_index is not None and time.monotonic() - tenant.rate_index_checked_at < RATE_REFRESH_SECONDS:
+        return tenant.rate_index
+    with tenant.rate_index_lock:
+        if tenant.rate_index is not None and time.monotonic() - tenant.rate_index_checked_at < RATE_REFRESH_SECONDS:
+            return tenant.rate_index
+        conn = None
+        if cursor is None:
+            conn = get_db_connection()
+            cur = conn.cursor()
+        else:
+            cur = cursor
+        try:
+            cur.execute("SELECT version FROM data_versions WHERE name = 'rate_configuration'")
+            row = cur.fetchone()
+            if tenant.rate_index is None or (row["version"] if row else 0) != tenant.rate_index.version:
+                tenant.rate_index = _load_rate_index(cur)
+            tenant.rate_index_checked_at = time.monotonic()
+        finally:
+            if conn is not None:
+                cur.close()
+                conn.close()
+        return tenant.rate_index
+
+def _rate_to_dict(rate: Dict[str, Any]) -> Dict[str, Any]:
+    return {
+        "rate_configuration_id": rate["id"],
+        "loan_type": rate["loan_type"],
+        "interest_rate": float(rate["interest_rate"]),
+        "term_months": rate["term_months"],
+        "min_amount": float(rate["min_amount"]) if rate["min_amount"] is not None else None,
+        "max_amount": float(rate["max_amount"]) if rate["max_amount"] is not None else None,
+        "effective_date": rate["effective_date"].strftime('%Y-%m-%d'),
+        "expiration_date": rate["expiration_date"].strftime('%Y-%m-%d') if rate["expiration_date"] else None
+    }
+
+@app.tool
+def Quote_rate(original_amount: float, loan_type: str = DEFAULT_LOAN_TYPE, date: Optional[str] = None) -> Dict[str, Any]:
+    """
+    Cotiza la tasa de interés aplicable según rate_configuration para un monto, tipo de préstamo
+    y fecha (YYYY-MM-DD, por defecto hoy). Usa el índice de tasas en memoria.
+    """
+    try:
+        if original_amount <= 0:
+            return {"error": "El monto debe ser mayor a 0."}
+        on_date = datetime.strptime(date, "%Y-%m-%d").date() if date else datetime.now().date()
+        rate = get_rate_index().lookup(loan_type, original_amount, on_date)
+        if not rate:
+            return {"error": f"No hay tasa configurada para loan_type={loan_type}, monto={original_amount}, fecha={on_date.strftime('%Y-%m-%d')}."}
+        return {"success": True, "original_amount": original_amount, "date": on_date.strftime('%Y-%m-%d'), **_rate_to_dict(rate)}
+    except Exception as e:
+        return {"error": f"Error en Quote_rate: {str(e)}"}
 
 # ==================== CLIENTES ====================
 
@@ -49,23 +1140,13 @@ def Add_client(name: str, email: str, phone: str) -> Dict[str, Any]:
     except Exception as e:
         return {"error": f'Error al agregar un cliente: {str(e)}'}
 
-@app.tool
+@app.tool(cost="report")
 def Get_clients() -> List[Dict[str, Any]]:
     """Esta herramienta obtiene la lista de clientes"""
     try:
         conn = get_db_connection()
         cursor = conn.cursor()
-        cursor.execute("SELECT id, name, email, phone, createdate FROM clients")
-        rows = cursor.fetchall()
-        clients = []
-        for row in rows:
-            clients.append({
-                "id": row["id"],
-                "name": row["name"],
-                "email": row["email"],
-                "phone": row["phone"],
-                "createdate": row["createdate"].strftime('%Y-%m-%d') if row["createdate"] else None
-            })
+        clients = _fetch_json_rows(cursor, _CLIENT_JSON, "FROM clients")
         cursor.close()
         conn.close()
         return clients
@@ -98,96 +1179,225 @@ def Get_client_by_id(client_id: int) -> Dict[str, Any]:
 
 # ==================== PRÉSTAMOS ====================
 
+# El id sale de la secuencia dentro de la misma sentencia, así el folio F-{id:07d} se
+# escribe en el INSERT (sin UPDATE posterior) y un cliente inexistente no produce filas.
+_INSERT_LOAN_SQL = """
+    INSERT INTO loans (
+        id, client_id, original_amount, current_balance, granting_date,
+        interest_rate, start_date, loan_type, folio, status
+    )
+    SELECT n.id, c.id, %(original_amount)s, %(original_amount)s, %(granting_date)s,
+           %(interest_rate)s, %(start_date)s, %(loan_type)s,
+           'F-' || lpad(n.id::text, GREATEST(7, length(n.id::text)), '0'), 'active'
+    FROM clients c
+    CROSS JOIN LATERAL (SELECT nextval(%(sequence)s)::int AS id) n
+    WHERE c.id = %(client_id)s
+    RETURNING id, client_id, original_amount, current_balance, granting_date,
+              interest_rate, start_date, folio, loan_type, status,
+              (SELECT name FROM clients WHERE id = loans.client_id) AS client_name
+"""
+
+# Variante multi-fila para Add_loans: VALUES con un índice por elemento para
+# poder reportar qué elementos no se insertaron (cliente inexistente).
+_INSERT_LOANS_SQL = """
+    WITH data (idx, client_id, original_amount, interest_rate, granting_date, start_date, loan_type) AS (
+        VALUES %s
+    ),
+    valid AS (
+        SELECT d.*, c.name AS client_name, nextval({sequence})::int AS id
+        FROM data d
+        JOIN clients c ON c.id = d.client_id
+    ),
+    ins AS (
+        INSERT INTO loans (
+            id, client_id, original_amount, current_balance, granting_date,
+            interest_rate, start_date, loan_type, folio, status
+        )
+        SELECT id, client_id, original_amount, original_amount, granting_date,
+               interest_rate, start_date, loan_type,
+               'F-' || lpad(id::text, GREATEST(7, length(id::text)), '0'), 'active'
+        FROM valid
+        RETURNING id, client_id, original_amount, current_balance, granting_date,
+                  interest_rate, start_date, folio, loan_type, status
+    )
+    SELECT v.idx, v.client_name, ins.*
+    FROM ins
+    JOIN valid v ON v.id = ins.id
+    ORDER BY v.idx
+"""
+_INSERT_LOANS_TEMPLATE = "(%s::int, %s::int, %s::numeric, %s::numeric, %s::date, %s::date, %s::varchar)"
+MAX_LOANS_PER_BATCH = int(os.getenv("MAX_LOANS_PER_BATCH", "5000"))
+
+def _get_loans_id_sequence(cursor) -> str:
+    # Se resuelve una vez por tenant: pg_get_serial_sequence en cada INSERT cuesta una consulta al catálogo
+    tenant = get_tenant()
+    if tenant.loans_id_sequence is None:
+        cursor.execute("SELECT pg_get_serial_sequence('loans', 'id') AS seq")
+        tenant.loans_id_sequence = cursor.fetchone()["seq"]
+    return tenant.loans_id_sequence
+
+def _insert_loan(cursor, client_id, original_amount, interest_rate, granting_date, start_date, loan_type):
+    cursor.execute(_INSERT_LOAN_SQL, {
+        "sequence": _get_loans_id_sequence(cursor),
+        "client_id": client_id,
+        "original_amount": original_amount,
+        "interest_rate": interest_rate,
+        "granting_date": granting_date,
+        "start_date": start_date,
+        "loan_type": loan_type
+    })
+    return cursor.fetchone()
+
+def _insert_loans(cursor, values) -> List[Dict[str, Any]]:
+    from psycopg2.extras import execute_values
+    from psycopg2.extensions import QuotedString
+    sql = _INSERT_LOANS_SQL.replace("{sequence}", QuotedString(_get_loans_id_sequence(cursor)).getquoted().decode())
+    return execute_values(cursor, sql, values, template=_INSERT_LOANS_TEMPLATE,
+                          page_size=max(len(values), 1), fetch=True)
+
+def _loan_row_to_dict(row) -> Dict[str, Any]:
+    return {
+        "id": row["id"],
+        "folio": row["folio"],
+        "client": row["client_name"],
+        "original_amount": float(row["original_amount"]),
+        "current_balance": float(row["current_balance"]),
+        "interest_rate": float(row["interest_rate"]),
+        "loan_type": row["loan_type"],
+        "granting_date": row["granting_date"].strftime('%Y-%m-%d') if row["granting_date"] else None,
+        "start_date": row["start_date"].strftime('%Y-%m-%d') if row["start_date"] else None,
+        "status": row["status"]
+    }
+
 @app.tool
 def Add_loan(
     client_id: int,
     original_amount: float,
-    interest_rate: float,
+    interest_rate: Optional[float] = None,
     granting_date: Optional[str] = None,
-    start_date: Optional[str] = None
+    start_date: Optional[str] = None,
+    loan_type: str = DEFAULT_LOAN_TYPE
 ) -> Dict[str, Any]:
-    """Esta herramienta agrega un nuevo préstamo para un cliente"""
+    """
+    Esta herramienta agrega un nuevo préstamo para un cliente.
+    Si no se pasa interest_rate, se resuelve desde rate_configuration según loan_type,
+    monto y fecha de otorgamiento.
+    """
     try:
-        if original_amount <= 0 or interest_rate < 0:
+        if original_amount <= 0 or (interest_rate is not None and interest_rate < 0):
             return {"error": "El monto y la tasa de interés deben ser valores positivos."}
         if not granting_date:
             granting_date = datetime.now().strftime('%Y-%m-%d')
         if not start_date:
             start_date = datetime.now().strftime('%Y-%m-%d')
+        if interest_rate is None:
+            rate = get_rate_index().lookup(loan_type, original_amount, datetime.strptime(granting_date, "%Y-%m-%d").date())
+            if not rate:
+                return {"error": f"No hay tasa configurada para loan_type={loan_type}, monto={original_amount}, fecha={granting_date}."}
+            interest_rate = float(rate["interest_rate"])
 
+        # Un solo round trip: validación del cliente, folio e INSERT en la misma sentencia
         conn = get_db_connection()
         cursor = conn.cursor()
-
-        cursor.execute("SELECT id, name FROM clients WHERE id = %s", (client_id,))
-        cliente = cursor.fetchone()
-        if not cliente:
+        row = _insert_loan(cursor, client_id, original_amount, interest_rate, granting_date, start_date, loan_type)
+        if not row:
             cursor.close()
             conn.close()
             return {"error": f'No se encontró un cliente con ID {client_id}.'}
-
-        # El saldo actual es igual al monto original al crear el préstamo
-        cursor.execute(
-            "INSERT INTO loans (client_id, original_amount, current_balance, granting_date, interest_rate, start_date, status) VALUES (%s, %s, %s, %s, %s, %s, 'active') RETURNING id",
-            (client_id, original_amount, original_amount, granting_date, interest_rate, start_date)
-        )
-        row = cursor.fetchone()
-        loan_id = row["id"]
-        folio = f"F-{loan_id:07d}"
-
-        # Actualizar el folio
-        cursor.execute(
-            "UPDATE loans SET folio = %s WHERE id = %s RETURNING id, client_id, original_amount, current_balance, granting_date, interest_rate, start_date, folio, status",
-            (folio, loan_id)
-        )
-        row = cursor.fetchone()
         conn.commit()
         cursor.close()
         conn.close()
+        return {"success": True, "loan": _loan_row_to_dict(row)}
+    except Exception as e:
+        return {"error": f'Error al agregar un préstamo: {str(e)}'}
+
+@app.tool(cost="batch")
+def Add_loans(loans: List[Dict[str, Any]]) -> Dict[str, Any]:
+    """
+    Agrega muchos préstamos en una sola sentencia (INSERT multi-fila) y devuelve todos los folios.
+    Cada elemento acepta: client_id, original_amount, interest_rate (opcional, se resuelve desde
+    rate_configuration), granting_date, start_date (YYYY-MM-DD, por defecto hoy) y loan_type.
+    Los elementos inválidos o con cliente inexistente se reportan en 'errors' y no se insertan.
+    """
+    try:
+        if not loans:
+            return {"error": "La lista de préstamos está vacía."}
+        if len(loans) > MAX_LOANS_PER_BATCH:
+            return {"error": f"Máximo {MAX_LOANS_PER_BATCH} préstamos por llamada."}
+
+        today = datetime.now().strftime('%Y-%m-%d')
+        values = []
+        errors = []
+        rate_index = None
+        for idx, item in enumerate(loans):
+            try:
+                client_id = int(item["client_id"])
+                original_amount = float(item["original_amount"])
+                interest_rate = item.get("interest_rate")
+                if interest_rate is not None:
+                    interest_rate = float(interest_rate)
+                granting_date = item.get("granting_date") or today
+                start_date = item.get("start_date") or today
+                loan_type = item.get("loan_type") or DEFAULT_LOAN_TYPE
+                granting_dt = datetime.strptime(granting_date, "%Y-%m-%d").date()
+                datetime.strptime(start_date, "%Y-%m-%d")
+            except (KeyError, TypeError, ValueError) as e:
+                errors.append({"index": idx, "error": f"Datos inválidos: {str(e)}"})
+                continue
+            if original_amount <= 0 or (interest_rate is not None and interest_rate < 0):
+                errors.append({"index": idx, "error": "El monto y la tasa de interés deben ser valores positivos."})
+                continue
+            if interest_rate is None:
+                rate_index = rate_index or get_rate_index()
+                rate = rate_index.lookup(loan_type, original_amount, granting_dt)
+                if not rate:
+                    errors.append({"index": idx, "error": f"No hay tasa configurada para loan_type={loan_type}, monto={original_amount}, fecha={granting_date}."})
+                    continue
+                interest_rate = rate["interest_rate"]
+            values.append((idx, client_id, original_amount, interest_rate, granting_date, start_date, loan_type))
+
+        created = []
+        if values:
+            conn = get_db_connection()
+            cursor = conn.cursor()
+            rows = _insert_loans(cursor, values)
+            conn.commit()
+            cursor.close()
+            conn.close()
+
+            inserted = {row["idx"] for row in rows}
+            for value in values:
+                if value[0] not in inserted:
+                    errors.append({"index": value[0], "error": f"No se encontró un cliente con ID {value[1]}."})
+            created = [{"index": row["idx"], **_loan_row_to_dict(row)} for row in rows]
+
+        errors.sort(key=lambda e: e["index"])
         return {
             "success": True,
-            "loan": {
-                "id": row["id"],
-                "folio": row["folio"],
-                "client": cliente["name"],
-                "original_amount": float(row["original_amount"]),
-                "current_balance": float(row["current_balance"]),
-                "interest_rate": float(row["interest_rate"]),
-                "granting_date": row["granting_date"].strftime('%Y-%m-%d') if row["granting_date"] else None,
-                "start_date": row["start_date"].strftime('%Y-%m-%d') if row["start_date"] else None,
-                "status": row["status"]
-            }
+            "created": len(created),
+            "failed": len(errors),
+            "loans": created,
+            "errors": errors
         }
     except Exception as e:
-        return {"error": f'Error al agregar un préstamo: {str(e)}'}
+        return {"error": f"Error en Add_loans: {str(e)}"}
 
 @app.tool
 def Get_loans_by_client(client_id: int) -> List[Dict[str, Any]]:
-    """Lista los préstamos de un cliente con saldos y folios"""
+    """Lista los préstamos de un cliente con saldos y folios (incluye los archivados)"""
     try:
         conn = get_db_connection()
         cursor = conn.cursor()
-        cursor.execute("""
-            SELECT id, client_id, original_amount, current_balance, granting_date, 
-                   interest_rate, start_date, folio, status
-            FROM loans WHERE client_id = %s ORDER BY id DESC
-        """, (client_id,))
-        rows = cursor.fetchall()
+        columns = ", ".join(expr for _, expr, _ in _LOAN_JSON)
+        loans = _fetch_json_rows(cursor, _LOAN_JSON, f"""
+            FROM (
+                SELECT {columns} FROM loans WHERE client_id = %(client_id)s
+                UNION ALL
+                SELECT {columns} FROM loans_archive WHERE client_id = %(client_id)s
+            ) l
+        """, {"client_id": client_id}, "id DESC")
         cursor.close()
         conn.close()
-        
-        loans = []
-        for row in rows:
-            loans.append({
-                "id": row["id"],
-                "client_id": row["client_id"],
-                "folio": row["folio"],
-                "original_amount": float(row["original_amount"]),
-                "current_balance": float(row["current_balance"]),
-                "interest_rate": float(row["interest_rate"]),
-                "granting_date": row["granting_date"].strftime('%Y-%m-%d') if row["granting_date"] else None,
-                "start_date": row["start_date"].strftime('%Y-%m-%d') if row["start_date"] else None,
-                "status": row["status"]
-            })
         return loans
     except Exception as e:
         return [{"error": f"Error en Get_loans_by_client: {str(e)}"}]
@@ -198,21 +1408,25 @@ def Get_loan_by_id(loan_id: int) -> Dict[str, Any]:
     try:
         conn = get_db_connection()
         cursor = conn.cursor()
-        cursor.execute("""
-            SELECT l.id, l.client_id, l.original_amount, l.current_balance, l.granting_date,
-                   l.interest_rate, l.start_date, l.folio, l.status, c.name as client_name
-            FROM loans l
-            JOIN clients c ON l.client_id = c.id
-            WHERE l.id = %s
-        """, (loan_id,))
-        row = cursor.fetchone()
+        # Si no está en loans se busca en el archivo (ver ARCHIVO DE PRÉSTAMOS CERRADOS)
+        for table, archived_at in (("loans", ""), ("loans_archive", ", l.archived_at")):
+            cursor.execute(f"""
+                SELECT l.id, l.client_id, l.original_amount, l.current_balance, l.granting_date,
+                       l.interest_rate, l.start_date, l.folio, l.status, c.name as client_name{archived_at}
+                FROM {table} l
+                JOIN clients c ON l.client_id = c.id
+                WHERE l.id = %s
+            """, (loan_id,))
+            row = cursor.fetchone()
+            if row:
+                break
         cursor.close()
         conn.close()
         
         if not row:
             return {"error": f"No se encontró el préstamo con ID {loan_id}"}
         
-        return {
+        loan = {
             "id": row["id"],
             "client_id": row["client_id"],
             "client_name": row["client_name"],
@@ -224,13 +1438,16 @@ def Get_loan_by_id(loan_id: int) -> Dict[str, Any]:
             "start_date": row["start_date"].strftime('%Y-%m-%d') if row["start_date"] else None,
             "status": row["status"]
         }
+        if "archived_at" in row:
+            loan["archived_at"] = row["archived_at"].strftime('%Y-%m-%d %H:%M:%S')
+        return loan
     except Exception as e:
         return {"error": f'Error al obtener préstamo: {str(e)}'}
 
 # ==================== ESTADOS DE CUENTA ====================
 
 @app.tool
-def Generate_monthly_cutoff(loan_id: int, due_days: int = 10) -> Dict[str, Any]:
+def Generate_monthly_cutoff(loan_id: int, due_days: int = 10, dry_run: bool = False) -> Dict[str, Any]:
     """
     Genera el corte mensual para un préstamo:
     - La fecha de corte se calcula automáticamente: mismo día que el start_date, mes/año actual.
@@ -239,6 +1456,7 @@ def Generate_monthly_cutoff(loan_id: int, due_days: int = 10) -> Dict[str, Any]:
     - Crea/inserta statements (period, saldos, interés generado, fechas).
     - Evita duplicados por periodo (si ya existe, retorna error).
     - NO genera statement si el periodo coincide con el mes del start_date.
+    - dry_run=True: valida y calcula igual, pero no escribe nada.
     """
     try:
         conn = get_db_connection()
@@ -301,8 +1519,33 @@ def Generate_monthly_cutoff(loan_id: int, due_days: int = 10) -> Dict[str, Any]:
             return {"error": f"Ya existe un estado de cuenta para el periodo {period} del préstamo {loan_id}."}
 
         current_balance = float(loan["current_balance"])
-        interest_rate = float(loan["interest_rate"])  # mensual %
-        interest_generated = round(current_balance * (interest_rate / 100.0), 2)
+        interest_generated, _ = _period_interest(loan, cutoff_dt)
+
+        if dry_run:
+            # Misma estimación por préstamo que la corrida de toda la cartera
+            estimate = _estimate_runtime(
+                cursor, "monthly_cutoff", 1, "generated", 3,
+                "SELECT id FROM statements WHERE loan_id = %s AND period = %s", [(loan_id, period)]
+            )
+            cursor.close()
+            conn.close()
+            return {
+                "success": True,
+                "dry_run": True,
+                "loan_id": loan_id,
+                "period": period,
+                "interest_generated": interest_generated,
+                "estimate": estimate,
+                "statement": {
+                    "period": period,
+                    "initial_balance": current_balance,
+                    "final_balance": current_balance,
+                    "interest_generated": interest_generated,
+                    "cut_off_date": cutoff_dt.strftime('%Y-%m-%d'),
+                    "due_date": due_date.strftime('%Y-%m-%d'),
+                    "status": "pending"
+                }
+            }
 
         # 4) Insertar movimiento de cargo de interés (no cambia saldo capital)
         cursor.execute("""
@@ -343,6 +1586,9 @@ def Generate_monthly_cutoff(loan_id: int, due_days: int = 10) -> Dict[str, Any]:
         ))
         statement_row = cursor.fetchone()
 
+        # 6) Checkpoint de saldos a la fecha de corte
+        _write_loan_checkpoints(cursor, cutoff_dt, [loan_id])
+
         conn.commit()
         cursor.close()
         conn.close()
@@ -368,7 +1614,7 @@ def Generate_monthly_cutoff(loan_id: int, due_days: int = 10) -> Dict[str, Any]:
     except Exception as e:
         return {"error": f"Error en Generate_monthly_cutoff: {str(e)}"}
 
-@app.tool
+@app.tool(cost="batch")
 def Generate_statements_for_active_loans(cutoff_date: Optional[str] = None, due_days: int = 10) -> Dict[str, Any]:
     """
     Genera estados de cuenta mensuales para TODOS los préstamos activos.
@@ -489,41 +1735,13 @@ def Get_loan_statements(loan_id: int, period: Optional[str] = None) -> List[Dict
         conn = get_db_connection()
         cursor = conn.cursor()
         if period:
-            cursor.execute("""
-                SELECT id, loan_id, period, initial_balance, final_balance, interest_generated,
-                       interest_paid, principal_paid, late_fee_generated, cut_off_date, due_date, status
-                FROM statements
-                WHERE loan_id = %s AND period = %s
-                ORDER BY period DESC
-            """, (loan_id, period))
+            statements = _fetch_loan_rows(cursor, _STATEMENT_JSON, "statements", loan_id,
+                                          "loan_id = %s AND period = %s", (loan_id, period), "period DESC")
         else:
-            cursor.execute("""
-                SELECT id, loan_id, period, initial_balance, final_balance, interest_generated,
-                       interest_paid, principal_paid, late_fee_generated, cut_off_date, due_date, status
-                FROM statements
-                WHERE loan_id = %s
-                ORDER BY period DESC
-            """, (loan_id,))
-        rows = cursor.fetchall()
+            statements = _fetch_loan_rows(cursor, _STATEMENT_JSON, "statements", loan_id,
+                                          "loan_id = %s", (loan_id,), "period DESC")
         cursor.close()
         conn.close()
-        
-        statements = []
-        for row in rows:
-            statements.append({
-                "id": row["id"],
-                "loan_id": row["loan_id"],
-                "period": row["period"],
-                "initial_balance": float(row["initial_balance"]),
-                "final_balance": float(row["final_balance"]),
-                "interest_generated": float(row["interest_generated"]),
-                "interest_paid": float(row["interest_paid"]),
-                "principal_paid": float(row["principal_paid"]),
-                "late_fee_generated": float(row["late_fee_generated"]),
-                "cut_off_date": row["cut_off_date"].strftime('%Y-%m-%d'),
-                "due_date": row["due_date"].strftime('%Y-%m-%d'),
-                "status": row["status"]
-            })
         return statements
     except Exception as e:
         return [{"error": f"Error en Get_loan_statements: {str(e)}"}]
@@ -550,32 +1768,39 @@ def Register_interest_payment(
         if amount <= 0:
             return {"error": "El monto debe ser mayor a 0."}
 
+        pay_date = datetime.strptime(payment_date, "%Y-%m-%d").date() if payment_date else datetime.now().date()
+        amount = round(amount, 2)
+
         conn = get_db_connection()
         cursor = conn.cursor()
 
-        cursor.execute("SELECT id, current_balance FROM loans WHERE id = %s", (loan_id,))
+        # Orden de locks en todas las escrituras: préstamo -> statement. FOR SHARE permite pagos
+        # de interés concurrentes del mismo préstamo; un abono a capital (cambia el saldo) espera.
+        cursor.execute("SELECT id, current_balance FROM loans WHERE id = %s FOR SHARE", (loan_id,))
         loan = cursor.fetchone()
         if not loan:
             cursor.close()
             conn.close()
             return {"error": f"No existe el préstamo {loan_id}."}
 
+        # Incremento atómico: sin leer-modificar-escribir en Python, los pagos concurrentes no se pisan
         cursor.execute("""
-            SELECT id, interest_generated, interest_paid, status
-            FROM statements
-            WHERE loan_id = %s AND period = %s
-        """, (loan_id, period))
-        stmt = cursor.fetchone()
-        if not stmt:
+            UPDATE statements
+            SET interest_paid = interest_paid + %(amount)s,
+                status = CASE
+                    WHEN abs(interest_paid + %(amount)s - interest_generated) < 0.01 THEN 'paid'
+                    WHEN interest_paid + %(amount)s > 0 THEN 'partial'
+                    ELSE status
+                END
+            WHERE loan_id = %(loan_id)s AND period = %(period)s
+            RETURNING id, period, interest_generated, interest_paid, principal_paid, status
+        """, {"amount": amount, "loan_id": loan_id, "period": period})
+        updated_stmt = cursor.fetchone()
+        if not updated_stmt:
             cursor.close()
             conn.close()
             return {"error": f"No existe statement para loan_id={loan_id}, period={period}. Genera el corte primero."}
 
-        new_interest_paid = round(float(stmt["interest_paid"]) + amount, 2)
-        interest_generated = float(stmt["interest_generated"])
-
-        pay_date = datetime.strptime(payment_date, "%Y-%m-%d").date() if payment_date else datetime.now().date()
-
         # Movimiento de pago de interés
         prev_bal = float(loan["current_balance"])
         cursor.execute("""
@@ -590,16 +1815,6 @@ def Register_interest_payment(
         ))
         mov = cursor.fetchone()
 
-        # Actualizar statement
-        new_status = "paid" if abs(new_interest_paid - interest_generated) < 0.01 else ("partial" if new_interest_paid > 0 else stmt["status"])
-        cursor.execute("""
-            UPDATE statements
-            SET interest_paid = %s, status = %s
-            WHERE id = %s
-            RETURNING id, period, interest_generated, interest_paid, principal_paid, status
-        """, (new_interest_paid, new_status, stmt["id"]))
-        updated_stmt = cursor.fetchone()
-
         conn.commit()
         cursor.close()
         conn.close()
@@ -638,25 +1853,33 @@ def Register_principal_payment(
         if amount <= 0:
             return {"error": "El monto debe ser mayor a 0."}
 
+        pay_date = datetime.strptime(payment_date, "%Y-%m-%d").date() if payment_date else datetime.now().date()
+        amount = round(amount, 2)
+
         conn = get_db_connection()
         cursor = conn.cursor()
 
-        cursor.execute("SELECT id, current_balance, status FROM loans WHERE id = %s FOR UPDATE", (loan_id,))
-        loan = cursor.fetchone()
-        if not loan:
-            cursor.close()
-            conn.close()
-            return {"error": f"No existe el préstamo {loan_id}."}
-
-        prev_balance = float(loan["current_balance"])
-        if amount > prev_balance:
+        # Decremento atómico del saldo: el lock de la fila se toma en el UPDATE y dura solo
+        # hasta el INSERT del movimiento y el commit
+        cursor.execute("""
+            UPDATE loans
+            SET current_balance = current_balance - %(amount)s,
+                status = CASE WHEN current_balance - %(amount)s = 0 THEN 'closed' ELSE status END
+            WHERE id = %(loan_id)s AND current_balance >= %(amount)s
+            RETURNING id, current_balance + %(amount)s AS previous_balance, current_balance, status, folio
+        """, {"amount": amount, "loan_id": loan_id})
+        updated_loan = cursor.fetchone()
+        if not updated_loan:
+            cursor.execute("SELECT current_balance FROM loans WHERE id = %s", (loan_id,))
+            loan = cursor.fetchone()
             cursor.close()
             conn.close()
-            return {"error": f"El abono ({amount}) no puede exceder el saldo actual ({prev_balance})."}
-
-        new_balance = round(prev_balance - amount, 2)
-        pay_date = datetime.strptime(payment_date, "%Y-%m-%d").date() if payment_date else datetime.now().date()
+            if not loan:
+                return {"error": f"No existe el préstamo {loan_id}."}
+            return {"error": f"El abono ({amount}) no puede exceder el saldo actual ({float(loan['current_balance'])})."}
 
+        prev_balance = float(updated_loan["previous_balance"])
+        new_balance = float(updated_loan["current_balance"])
         cursor.execute("""
             INSERT INTO movements (
                 loan_id, movement_type, amount, previous_balance, new_balance,
@@ -669,15 +1892,6 @@ def Register_principal_payment(
         ))
         mov = cursor.fetchone()
 
-        # Actualizar saldo del préstamo
-        new_status = 'closed' if new_balance == 0 else loan["status"]
-        cursor.execute("""
-            UPDATE loans SET current_balance = %s, status = %s 
-            WHERE id = %s 
-            RETURNING id, current_balance, status, folio
-        """, (new_balance, new_status, loan_id))
-        updated_loan = cursor.fetchone()
-
         conn.commit()
         cursor.close()
         conn.close()
@@ -696,63 +1910,267 @@ def Register_principal_payment(
     except Exception as e:
         return {"error": f"Error en Register_principal_payment: {str(e)}"}
 
+# Cascada por defecto de Apply_client_payment (pasos: late_fees, interest, principal)
+PAYMENT_WATERFALL = [step.strip() for step in os.getenv("PAYMENT_WATERFALL", "late_fees,interest,principal").split(",") if step.strip()]
+_WATERFALL_STEPS = ("late_fees", "interest", "principal")
+
+@app.tool
+def Apply_client_payment(
+    amount: float,
+    client_id: Optional[int] = None,
+    loan_id: Optional[int] = None,
+    waterfall: Optional[List[str]] = None,
+    payment_date: Optional[str] = None,
+    reference: Optional[str] = None,
+    note: Optional[str] = None
+) -> Dict[str, Any]:
+    """
+    Aplica un solo pago de un cliente (todos sus préstamos) o de un préstamo, repartido en cascada
+    sobre todos los estados de cuenta abiertos, del vencimiento más antiguo al más reciente:
+    - late_fees: mora pendiente (movement 'late_fee_payment')
+    - interest: interés pendiente (movement 'interest_payment')
+    - principal: abono a capital, préstamo más antiguo primero (movement 'principal_payment')
+    El orden se toma de waterfall (o PAYMENT_WATERFALL). Todo en una transacción; si el pago
+    excede lo que la cascada puede aplicar no se registra nada.
+    """
+    try:
+        from decimal import Decimal
+        from psycopg2.extras import execute_values
+
+        if amount <= 0:
+            return {"error": "El monto debe ser mayor a 0."}
+        if (client_id is None) == (loan_id is None):
+            return {"error": "Indica client_id o loan_id (solo uno)."}
+        steps = list(waterfall or PAYMENT_WATERFALL)
+        if not steps or any(step not in _WATERFALL_STEPS for step in steps) or len(set(steps)) != len(steps):
+            return {"error": f"Cascada inválida: {steps} (pasos: {', '.join(_WATERFALL_STEPS)})."}
+
+        pay_date = datetime.strptime(payment_date, "%Y-%m-%d").date() if payment_date else datetime.now().date()
+        remaining = Decimal(str(round(amount, 2)))
+
+        conn = get_db_connection()
+        cursor = conn.cursor()
+
+        # Orden de locks en todas las escrituras: préstamos -> statements
+        cursor.execute("""
+            SELECT l.id, l.folio, l.current_balance, l.status, l.granting_date
+            FROM loans l
+            WHERE (%(client_id)s::int IS NULL OR l.client_id = %(client_id)s::int)
+              AND (%(loan_id)s::int IS NULL OR l.id = %(loan_id)s::int)
+              AND (l.status = 'active' OR EXISTS (
+                  SELECT 1 FROM statements s
+                  WHERE s.loan_id = l.id
+                    AND (s.interest_generated > s.interest_paid OR s.late_fee_generated > s.late_fee_paid)
+              ))
+            ORDER BY l.id
+            FOR UPDATE
+        """, {"client_id": client_id, "loan_id": loan_id})
+        loans = {row["id"]: row for row in cursor.fetchall()}
+        if not loans:
+            cursor.close()
+            conn.close()
+            target = f"el cliente {client_id}" if client_id is not None else f"el préstamo {loan_id}"
+            return {"error": f"No hay préstamos con adeudo para {target}."}
+
+        cursor.execute("""
+            SELECT id, loan_id, period,
+                   interest_generated - interest_paid AS interest_due,
+                   late_fee_generated - late_fee_paid AS late_fee_due
+            FROM statements
+            WHERE loan_id = ANY(%s)
+              AND (interest_generated > interest_paid OR late_fee_generated > late_fee_paid)
+            ORDER BY due_date, period, loan_id
+            FOR UPDATE
+        """, (list(loans),))
+        statements = cursor.fetchall()
+
+        # Reparto en memoria (pocas filas, ya bloqueadas); la escritura es por lotes
+        balances = {lid: loan["current_balance"] for lid, loan in loans.items()}
+        statement_alloc = {}
+        movements = []
+        allocated = {step: Decimal("0") for step in _WATERFALL_STEPS}
+        for step in steps:
+            if step == "principal":
+                for loan in sorted(loans.values(), key=lambda r: (r["granting_date"], r["id"])):
+                    take = min(remaining, balances[loan["id"]]) if loan["status"] == "active" else Decimal("0")
+                    if take <= 0:
+                        continue
+                    previous = balances[loan["id"]]
+                    balances[loan["id"]] = previous - take
+                    movements.append((loan["id"], "principal_payment", take, previous, previous - take,
+                                      pay_date, pay_date.strftime("%Y-%m"), reference, note or "Abono a capital"))
+                    remaining -= take
+                    allocated[step] += take
+                continue
+            due_key, movement_type, default_note = (
+                ("late_fee_due", "late_fee_payment", "Pago de mora") if step == "late_fees"
+                else ("interest_due", "interest_payment", "Pago de interés")
+            )
+            for stmt in statements:
+                take = min(remaining, stmt[due_key])
+                if take <= 0:
+                    continue
+                fee, interest = statement_alloc.get(stmt["id"], (Decimal("0"), Decimal("0")))
+                statement_alloc[stmt["id"]] = (fee + take, interest) if step == "late_fees" else (fee, interest + take)
+                balance = balances[stmt["loan_id"]]
+                movements.append((stmt["loan_id"], movement_type, take, balance, balance,
+                                  pay_date, stmt["period"], reference, note or default_note))
+                remaining -= take
+                allocated[step] += take
+
+        if remaining > 0:
+            cursor.close()
+            conn.close()
+            return {"error": f"El pago excede en {float(remaining)} lo que la cascada {steps} puede aplicar "
+                             f"(adeudo aplicable: {float(sum(allocated.values()))})."}
+
+        updated_statements = []
+        if statement_alloc:
+            updated_statements = execute_values(cursor, """
+                UPDATE statements s
+                SET late_fee_paid = s.late_fee_paid + v.fee,
+                    interest_paid = s.interest_paid + v.interest,
+                    status = CASE
+                        WHEN s.interest_paid + v.interest >= s.interest_generated
+                             AND s.late_fee_paid + v.fee >= s.late_fee_generated THEN 'paid'
+                        ELSE 'partial'
+                    END
+                FROM (VALUES %s) AS v(id, fee, interest)
+                WHERE s.id = v.id
+                RETURNING s.id, s.loan_id, s.period, s.interest_generated, s.interest_paid,
+                          s.late_fee_generated, s.late_fee_paid, s.status
+            """, [(sid, fee, interest) for sid, (fee, interest) in statement_alloc.items()],
+                template="(%s::int, %s::numeric, %s::numeric)", fetch=True)
+
+        principal = {lid: loans[lid]["current_balance"] - balance for lid, balance in balances.items()
+                     if balance != loans[lid]["current_balance"]}
+        updated_loans = []
+        if principal:
+            updated_loans = execute_values(cursor, """
+                UPDATE loans l
+                SET current_balance = l.current_balance - v.amount,
+                    status = CASE WHEN l.current_balance - v.amount = 0 THEN 'closed' ELSE l.status END
+                FROM (VALUES %s) AS v(id, amount)
+                WHERE l.id = v.id
+                RETURNING l.id, l.folio, l.current_balance, l.status
+            """, list(principal.items()), template="(%s::int, %s::numeric)", fetch=True)
+
+        # Los ids salen en el orden de la cascada: la cadena de saldos por préstamo queda en orden
+        inserted = execute_values(cursor, """
+            INSERT INTO movements (
+                loan_id, movement_type, amount, previous_balance, new_balance,
+                movement_date, application_period, reference, note
+            ) VALUES %s
+            RETURNING id, loan_id, movement_type, amount, application_period
+        """, movements, fetch=True)
+
+        conn.commit()
+        cursor.close()
+        conn.close()
+
+        return {
+            "success": True,
+            "amount": float(round(amount, 2)),
+            "client_id": client_id,
+            "loan_id": loan_id,
+            "payment_date": pay_date.strftime('%Y-%m-%d'),
+            "waterfall": steps,
+            "allocated": {step: float(allocated[step]) for step in _WATERFALL_STEPS},
+            "allocations": [{
+                "movement_id": row["id"],
+                "loan_id": row["loan_id"],
+                "folio": loans[row["loan_id"]]["folio"],
+                "movement_type": row["movement_type"],
+                "period": row["application_period"],
+                "amount": float(row["amount"])
+            } for row in sorted(inserted, key=lambda r: r["id"])],
+            "statements": [{
+                "id": row["id"],
+                "loan_id": row["loan_id"],
+                "period": row["period"],
+                "interest_generated": float(row["interest_generated"]),
+                "interest_paid": float(row["interest_paid"]),
+                "late_fee_generated": float(row["late_fee_generated"]),
+                "late_fee_paid": float(row["late_fee_paid"]),
+                "status": row["status"]
+            } for row in sorted(updated_statements, key=lambda r: r["id"])],
+            "loans": [{
+                "id": row["id"],
+                "folio": row["folio"],
+                "current_balance": float(row["current_balance"]),
+                "status": row["status"]
+            } for row in sorted(updated_loans, key=lambda r: r["id"])]
+        }
+    except Exception as e:
+        return {"error": f"Error en Apply_client_payment: {str(e)}"}
+
 # ==================== MOVIMIENTOS ====================
 
 @app.tool
 def Get_loan_movements(loan_id: int, movement_type: Optional[str] = None) -> List[Dict[str, Any]]:
     """
     Lista movimientos de un préstamo. Filtra opcionalmente por movement_type.
-    movement_type ∈ {'interest_payment','principal_payment','interest_charge','late_fee_charge','adjustment'}
+    movement_type ∈ {'interest_payment','principal_payment','interest_charge','late_fee_charge','late_fee_payment','adjustment'}
     """
     try:
         conn = get_db_connection()
         cursor = conn.cursor()
         if movement_type:
-            cursor.execute("""
-                SELECT id, loan_id, movement_type, amount, previous_balance, new_balance,
-                       movement_date, application_period, reference, note
-                FROM movements
-                WHERE loan_id = %s AND movement_type = %s
-                ORDER BY movement_date DESC, id DESC
-            """, (loan_id, movement_type))
+            movements = _fetch_loan_rows(cursor, _MOVEMENT_JSON, "movements", loan_id,
+                                         "loan_id = %s AND movement_type = %s", (loan_id, movement_type), "movement_date DESC, id DESC")
         else:
-            cursor.execute("""
-                SELECT id, loan_id, movement_type, amount, previous_balance, new_balance,
-                movement_date, application_period, reference, note
-                FROM movements
-                WHERE loan_id = %s
-                ORDER BY movement_date DESC, id DESC
-            """, (loan_id,))
-        rows = cursor.fetchall()
+            movements = _fetch_loan_rows(cursor, _MOVEMENT_JSON, "movements", loan_id,
+                                         "loan_id = %s", (loan_id,), "movement_date DESC, id DESC")
         cursor.close()
         conn.close()
-        
-        movements = []
-        for row in rows:
-            movements.append({
-                "id": row["id"],
-                "loan_id": row["loan_id"],
-                "movement_type": row["movement_type"],
-                "amount": float(row["amount"]),
-                "previous_balance": float(row["previous_balance"]),
-                "new_balance": float(row["new_balance"]),
-                "movement_date": row["movement_date"].strftime('%Y-%m-%d'),
-                "application_period": row["application_period"],
-                "reference": row["reference"],
-                "note": row["note"]
-            })
         return movements
     except Exception as e:
         return [{"error": f"Error en Get_loan_movements: {str(e)}"}]
 
 # ==================== MORA Y CARGOS ====================
 
+def _apply_late_fee(cursor, loan_id: int, current_balance, period: str, late_fee_amount: float, charge_dt,
+                    unbilled_only: bool = False):
+    """
+    Suma la mora al statement con un incremento atómico y registra el movement 'late_fee_charge'
+    (sin commit). Quien llama debe tener el préstamo bloqueado (FOR SHARE) antes: el orden
+    préstamo -> statement es el mismo en todas las escrituras. Retorna (None, None) si no hay
+    statement (o, con unbilled_only, si ya tenía mora o dejó de estar pendiente).
+    """
+    cursor.execute(f"""
+        UPDATE statements
+        SET late_fee_generated = late_fee_generated + %s, status = 'overdue'
+        WHERE loan_id = %s AND period = %s
+        {"AND late_fee_generated = 0 AND status IN ('pending', 'partial')" if unbilled_only else ""}
+        RETURNING id, period, late_fee_generated, status
+    """, (late_fee_amount, loan_id, period))
+    updated_stmt = cursor.fetchone()
+    if not updated_stmt:
+        return None, None
+
+    prev_bal = float(current_balance)
+    cursor.execute("""
+        INSERT INTO movements (
+            loan_id, movement_type, amount, previous_balance, new_balance,
+            movement_date, application_period, reference, note
+        ) VALUES (%s, 'late_fee_charge', %s, %s, %s, %s, %s, %s, %s)
+        RETURNING id
+    """, (
+        loan_id, late_fee_amount, prev_bal, prev_bal,
+        charge_dt, period, f"MORA-{period}", "Cargo por mora"
+    ))
+    return cursor.fetchone(), updated_stmt
+
 @app.tool
-def Generate_late_fee(loan_id: int, period: str, late_fee_amount: float, charge_date: Optional[str] = None) -> Dict[str, Any]:
+def Generate_late_fee(loan_id: int, period: str, late_fee_amount: float, charge_date: Optional[str] = None,
+                      dry_run: bool = False) -> Dict[str, Any]:
     """
     Genera un cargo por mora para un periodo específico.
     - Inserta movement 'late_fee_charge'
     - Actualiza statement: late_fee_generated y status a 'overdue'
+    - dry_run=True: solo una vista previa de cómo quedaría este statement, sin escribir nada.
+      Para totales de toda la cartera y estimación de duración usar
+      Generate_late_fees_for_overdue(dry_run=True).
     """
     try:
         if late_fee_amount <= 0:
@@ -761,51 +2179,47 @@ def Generate_late_fee(loan_id: int, period: str, late_fee_amount: float, charge_
         conn = get_db_connection()
         cursor = conn.cursor()
 
-        # Verificar que existe el préstamo
-        cursor.execute("SELECT id, current_balance FROM loans WHERE id = %s", (loan_id,))
+        charge_dt = datetime.strptime(charge_date, "%Y-%m-%d").date() if charge_date else datetime.now().date()
+
+        # FOR SHARE: otros pagos/cargos de interés del mismo préstamo no se bloquean entre sí,
+        # pero un abono a capital (que cambia el saldo) espera. Un dry_run no bloquea nada.
+        cursor.execute(f"SELECT id, current_balance FROM loans WHERE id = %s{'' if dry_run else ' FOR SHARE'}", (loan_id,))
         loan = cursor.fetchone()
         if not loan:
             cursor.close()
             conn.close()
             return {"error": f"No existe el préstamo {loan_id}."}
 
-        # Verificar que existe el statement
-        cursor.execute("""
-            SELECT id, late_fee_generated, status, due_date
-            FROM statements
-            WHERE loan_id = %s AND period = %s
-        """, (loan_id, period))
-        stmt = cursor.fetchone()
-        if not stmt:
+        if dry_run:
+            cursor.execute("SELECT id, period, late_fee_generated FROM statements WHERE loan_id = %s AND period = %s",
+                           (loan_id, period))
+            stmt = cursor.fetchone()
+            estimate = _estimate_runtime(
+                cursor, "late_fees", 1, "charged", 2,
+                "SELECT id FROM statements WHERE id = %s", [(stmt["id"],)]
+            ) if stmt else None
             cursor.close()
             conn.close()
-            return {"error": f"No existe statement para loan_id={loan_id}, period={period}."}
-
-        charge_dt = datetime.strptime(charge_date, "%Y-%m-%d").date() if charge_date else datetime.now().date()
-        
-        # Insertar movimiento de cargo por mora
-        prev_bal = float(loan["current_balance"])
-        cursor.execute("""
-            INSERT INTO movements (
-                loan_id, movement_type, amount, previous_balance, new_balance,
-                movement_date, application_period, reference, note
-            ) VALUES (%s, 'late_fee_charge', %s, %s, %s, %s, %s, %s, %s)
-            RETURNING id
-        """, (
-            loan_id, late_fee_amount, prev_bal, prev_bal,
-            charge_dt, period, f"MORA-{period}", "Cargo por mora"
-        ))
-        mov = cursor.fetchone()
+            if not stmt:
+                return {"error": f"No existe statement para loan_id={loan_id}, period={period}."}
+            return {
+                "success": True,
+                "dry_run": True,
+                "charge_date": charge_dt.strftime('%Y-%m-%d'),
+                "estimate": estimate,
+                "statement": {
+                    "id": stmt["id"],
+                    "period": stmt["period"],
+                    "late_fee_generated": round(float(stmt["late_fee_generated"]) + late_fee_amount, 2),
+                    "status": "overdue"
+                }
+            }
 
-        # Actualizar statement
-        new_late_fee = round(float(stmt["late_fee_generated"]) + late_fee_amount, 2)
-        cursor.execute("""
-            UPDATE statements
-            SET late_fee_generated = %s, status = 'overdue'
-            WHERE id = %s
-            RETURNING id, period, late_fee_generated, status
-        """, (new_late_fee, stmt["id"]))
-        updated_stmt = cursor.fetchone()
+        mov, updated_stmt = _apply_late_fee(cursor, loan_id, loan["current_balance"], period, late_fee_amount, charge_dt)
+        if not updated_stmt:
+            cursor.close()
+            conn.close()
+            return {"error": f"No existe statement para loan_id={loan_id}, period={period}."}
 
         conn.commit()
         cursor.close()
@@ -824,7 +2238,44 @@ def Generate_late_fee(loan_id: int, period: str, late_fee_amount: float, charge_
     except Exception as e:
         return {"error": f"Error en Generate_late_fee: {str(e)}"}
 
-@app.tool
+@app.tool(cost="batch")
+def Generate_late_fees_for_overdue(late_fee_amount: float, grace_days: int = 0, dry_run: bool = False) -> Dict[str, Any]:
+    """
+    Genera un cargo por mora (con fecha de hoy) para cada statement 'pending' o 'partial'
+    vencido hace más de grace_days días que aún no tiene mora. Es la misma corrida que la
+    tarea programada late_fees, sin ventana ni pausas, con commit por lote.
+    - dry_run=True: no escribe nada; sobre un snapshot REPEATABLE READ retorna cuántos
+      statements y préstamos se cargarían, el total de mora y la duración estimada.
+    """
+    try:
+        if late_fee_amount <= 0:
+            return {"error": "El monto de mora debe ser mayor a 0."}
+        if grace_days < 0:
+            return {"error": "grace_days no puede ser negativo."}
+        if dry_run:
+            return simulate_late_fees(late_fee_amount, grace_days)
+
+        started_at = datetime.now()
+        config = dict(load_job_config()["late_fees"], loans_per_second=0)
+        config["params"] = {"late_fee_amount": late_fee_amount, "grace_days": grace_days}
+        summary = _job_late_fees(_JobRun("late_fees", config, None, respect_window=False))
+        conn = get_db_connection()
+        cursor = conn.cursor()
+        _record_manual_run(cursor, "late_fees", "Generate_late_fees_for_overdue", started_at, summary)
+        conn.commit()
+        cursor.close()
+        conn.close()
+        return dict(success=True, **summary)
+    except Exception as e:
+        return {"error": f"Error en Generate_late_fees_for_overdue: {str(e)}"}
+
+# Filtro de vencidos compartido por Check_overdue_statements y overdue_check
+_OVERDUE_FILTER = "s.status IN ('pending', 'partial') AND s.due_date < %(as_of)s"
+# La antigüedad de cartera incluye además los 'overdue' (ya con mora), los más atrasados,
+# igual que Get_portfolio_metrics
+_AGING_FILTER = "s.status IN ('pending', 'partial', 'overdue') AND s.due_date < %(as_of)s"
+
+@app.tool(cost="report")
 def Check_overdue_statements(check_date: Optional[str] = None) -> List[Dict[str, Any]]:
     """
     Revisa todos los statements con status 'pending' o 'partial' cuya fecha de vencimiento ya pasó.
@@ -833,50 +2284,153 @@ def Check_overdue_statements(check_date: Optional[str] = None) -> List[Dict[str,
     check_date: 'YYYY-MM-DD' (si no se pasa, usa hoy)
     """
     try:
-        conn = get_db_connection()
-        cursor = conn.cursor()
-        
         check_dt = datetime.strptime(check_date, "%Y-%m-%d").date() if check_date else datetime.now().date()
         
-        cursor.execute("""
-            SELECT s.id, s.loan_id, s.period, s.interest_generated, s.interest_paid,
-                   s.late_fee_generated, s.due_date, s.status, l.folio, l.client_id, c.name as client_name
+        return _cached_report("Check_overdue_statements", (check_dt,), lambda cursor: _fetch_json_rows(
+            cursor, _OVERDUE_STATEMENT_JSON, f"""
             FROM statements s
             JOIN loans l ON s.loan_id = l.id
             JOIN clients c ON l.client_id = c.id
-            WHERE s.status IN ('pending', 'partial')
-              AND s.due_date < %s
-            ORDER BY s.due_date ASC
-        """, (check_dt,))
-        
+            WHERE {_OVERDUE_FILTER}
+        """, {"as_of": check_dt}, "s.due_date ASC"))
+    except Exception as e:
+        return [{"error": f"Error en Check_overdue_statements: {str(e)}"}]
+
+# Cada préstamo cae en el bucket de su statement vencido más antiguo. Una sola consulta devuelve
+# los buckets (más el total vía GROUPING SETS), los top-N clientes por exposición y los top-N
+# préstamos por interés pendiente, distinguidos por la columna kind.
+_AGING_REPORT_SQL = f"""
+    WITH overdue AS (
+        SELECT s.loan_id, l.client_id, c.name AS client_name, l.folio, l.current_balance,
+               %(as_of)s - s.due_date AS days_overdue,
+               s.interest_generated - s.interest_paid AS pending_interest,
+               s.late_fee_generated - s.late_fee_paid AS late_fee_outstanding
+        FROM statements s
+        JOIN loans l ON l.id = s.loan_id
+        JOIN clients c ON c.id = l.client_id
+        WHERE {_AGING_FILTER}
+          AND (%(client_id)s::int IS NULL OR l.client_id = %(client_id)s::int)
+    ),
+    by_loan AS (
+        SELECT loan_id, client_id, client_name, folio, current_balance,
+               COUNT(*) AS statements,
+               MAX(days_overdue) AS days_overdue,
+               SUM(pending_interest) AS pending_interest,
+               SUM(late_fee_outstanding) AS late_fees,
+               current_balance + SUM(pending_interest) + SUM(late_fee_outstanding) AS exposure,
+               CASE
+                   WHEN MAX(days_overdue) <= 30 THEN '1-30'
+                   WHEN MAX(days_overdue) <= 60 THEN '31-60'
+                   WHEN MAX(days_overdue) <= 90 THEN '61-90'
+                   ELSE '90+'
+               END AS bucket
+        FROM overdue
+        GROUP BY loan_id, client_id, client_name, folio, current_balance
+    ),
+    client_totals AS (
+        SELECT client_id, client_name,
+               COUNT(*) OVER w AS loans,
+               SUM(statements) OVER w AS statements,
+               MAX(days_overdue) OVER w AS days_overdue,
+               SUM(pending_interest) OVER w AS pending_interest,
+               SUM(late_fees) OVER w AS late_fees,
+               SUM(current_balance) OVER w AS balance,
+               SUM(exposure) OVER w AS exposure,
+               ROW_NUMBER() OVER (PARTITION BY client_id ORDER BY loan_id) AS client_row
+        FROM by_loan
+        WINDOW w AS (PARTITION BY client_id)
+    ),
+    ranked_clients AS (
+        SELECT *, ROW_NUMBER() OVER (ORDER BY exposure DESC, client_id) AS rank
+        FROM client_totals
+        WHERE client_row = 1
+    ),
+    ranked_loans AS (
+        SELECT *, ROW_NUMBER() OVER (ORDER BY pending_interest DESC, days_overdue DESC, loan_id) AS rank
+        FROM by_loan
+    )
+    SELECT 'bucket' AS kind, COALESCE(bucket, 'total') AS key, NULL AS label, NULL::int AS client_id,
+           COUNT(*) AS loans, SUM(statements) AS statements, MAX(days_overdue) AS days_overdue,
+           SUM(pending_interest) AS pending_interest, SUM(late_fees) AS late_fees,
+           SUM(current_balance) AS balance, SUM(exposure) AS exposure, NULL::bigint AS rank
+    FROM by_loan
+    GROUP BY GROUPING SETS ((bucket), ())
+    UNION ALL
+    SELECT 'client', client_id::text, client_name, client_id, loans, statements, days_overdue,
+           pending_interest, late_fees, balance, exposure, rank
+    FROM ranked_clients
+    WHERE rank <= %(top_n)s
+    UNION ALL
+    SELECT 'loan', loan_id::text, folio, client_id, 1, statements, days_overdue,
+           pending_interest, late_fees, current_balance, exposure, rank
+    FROM ranked_loans
+    WHERE rank <= %(top_n)s
+"""
+AGING_BUCKETS = ("1-30", "31-60", "61-90", "90+")
+
+def _aging_row(row) -> Dict[str, Any]:
+    return {
+        "loans": row["loans"],
+        "statements": int(row["statements"]),
+        "max_days_overdue": row["days_overdue"],
+        "pending_interest": float(row["pending_interest"]),
+        "late_fees": float(row["late_fees"]),
+        "balance": float(row["balance"]),
+        "exposure": float(row["exposure"])
+    }
+
+@app.tool(cost="report")
+def Get_aging_report(as_of_date: Optional[str] = None, top_n: int = 10, client_id: Optional[int] = None) -> Dict[str, Any]:
+    """
+    Reporte de antigüedad de la cartera vencida calculado en la base (una sola consulta):
+    - buckets por días de atraso del statement vencido más antiguo de cada préstamo: 1-30, 31-60, 61-90, 90+
+    - totales por bucket y total general (préstamos, statements, interés pendiente, moras pendientes, saldo, exposición)
+    - top_n clientes por exposición (saldo + interés pendiente + moras pendientes de sus préstamos vencidos)
+    - top_n préstamos por interés pendiente
+
+    as_of_date: 'YYYY-MM-DD' (por defecto hoy); cuenta los statements vencidos 'pending', 'partial' y
+    'overdue' (ya con mora), como Get_portfolio_metrics
+    client_id: opcional, limita el reporte a un cliente
+    """
+    try:
+        as_of = datetime.strptime(as_of_date, "%Y-%m-%d").date() if as_of_date else datetime.now().date()
+        conn = get_db_connection()
+        cursor = conn.cursor()
+        cursor.execute(_AGING_REPORT_SQL, {"as_of": as_of, "top_n": top_n, "client_id": client_id})
         rows = cursor.fetchall()
         cursor.close()
         conn.close()
-        
-        overdue = []
+
+        empty = {"loans": 0, "statements": 0, "max_days_overdue": None, "pending_interest": 0.0,
+                 "late_fees": 0.0, "balance": 0.0, "exposure": 0.0}
+        buckets = {bucket: dict(empty) for bucket in AGING_BUCKETS}
+        total = dict(empty)
+        top_clients = []
+        top_loans = []
         for row in rows:
-            days_overdue = (check_dt - row["due_date"]).days
-            pending_interest = float(row["interest_generated"]) - float(row["interest_paid"])
-            
-            overdue.append({
-                "statement_id": row["id"],
-                "loan_id": row["loan_id"],
-                "folio": row["folio"],
-                "client_id": row["client_id"],
-                "client_name": row["client_name"],
-                "period": row["period"],
-                "due_date": row["due_date"].strftime('%Y-%m-%d'),
-                "days_overdue": days_overdue,
-                "interest_generated": float(row["interest_generated"]),
-                "interest_paid": float(row["interest_paid"]),
-                "pending_interest": pending_interest,
-                "late_fee_generated": float(row["late_fee_generated"]),
-                "status": row["status"]
-            })
-        
-        return overdue
+            if row["kind"] == "bucket":
+                if row["key"] == "total":
+                    # GROUPING SETS devuelve la fila del total aunque no haya vencidos (sumas NULL)
+                    if row["loans"]:
+                        total = _aging_row(row)
+                else:
+                    buckets[row["key"]] = _aging_row(row)
+            elif row["kind"] == "client":
+                top_clients.append(dict(rank=row["rank"], client_id=row["client_id"], client_name=row["label"], **_aging_row(row)))
+            else:
+                item = _aging_row(row)
+                del item["loans"]
+                top_loans.append(dict(rank=row["rank"], loan_id=int(row["key"]), folio=row["label"], client_id=row["client_id"], **item))
+
+        return {
+            "as_of_date": as_of.strftime('%Y-%m-%d'),
+            "buckets": buckets,
+            "total": total,
+            "top_clients": sorted(top_clients, key=lambda r: r["rank"]),
+            "top_loans": sorted(top_loans, key=lambda r: r["rank"])
+        }
     except Exception as e:
-        return [{"error": f"Error en Check_overdue_statements: {str(e)}"}]
+        return {"error": f"Error en Get_aging_report: {str(e)}"}
 
 # ==================== CIERRE DE PRÉSTAMOS ====================
 
@@ -888,28 +2442,29 @@ def Close_loan_if_zero(loan_id: int, close_date: Optional[str] = None, note: Opt
     Actualiza el status del préstamo a 'closed'.
     """
     try:
+        cdate = datetime.strptime(close_date, "%Y-%m-%d").date() if close_date else datetime.now().date()
+
         conn = get_db_connection()
         cursor = conn.cursor()
 
-        cursor.execute("SELECT id, current_balance, status, folio FROM loans WHERE id = %s FOR UPDATE", (loan_id,))
-        loan = cursor.fetchone()
-        if not loan:
-            cursor.close()
-            conn.close()
-            return {"error": f"No existe el préstamo {loan_id}."}
-
-        if float(loan["current_balance"]) != 0.0:
-            cursor.close()
-            conn.close()
-            return {"error": f"El préstamo {loan['folio']} no tiene saldo cero (saldo actual: {loan['current_balance']}). No puede cerrarse."}
-
-        if loan["status"] == 'closed':
+        # Cierre condicional en una sola sentencia (sin SELECT ... FOR UPDATE previo)
+        cursor.execute("""
+            UPDATE loans SET status = 'closed'
+            WHERE id = %s AND current_balance = 0 AND status <> 'closed'
+            RETURNING id, folio, status
+        """, (loan_id,))
+        updated_loan = cursor.fetchone()
+        if not updated_loan:
+            cursor.execute("SELECT id, current_balance, status, folio FROM loans WHERE id = %s", (loan_id,))
+            loan = cursor.fetchone()
             cursor.close()
             conn.close()
+            if not loan:
+                return {"error": f"No existe el préstamo {loan_id}."}
+            if float(loan["current_balance"]) != 0.0:
+                return {"error": f"El préstamo {loan['folio']} no tiene saldo cero (saldo actual: {loan['current_balance']}). No puede cerrarse."}
             return {"error": f"El préstamo {loan['folio']} ya está cerrado."}
 
-        cdate = datetime.strptime(close_date, "%Y-%m-%d").date() if close_date else datetime.now().date()
-
         # Marca de cierre
         cursor.execute("""
             INSERT INTO movements (
@@ -920,13 +2475,6 @@ def Close_loan_if_zero(loan_id: int, close_date: Optional[str] = None, note: Opt
         """, (loan_id, cdate, cdate.strftime("%Y-%m"), "CLOSE", note or "Cierre de préstamo"))
         mov = cursor.fetchone()
 
-        # Actualizar status del préstamo
-        cursor.execute("""
-            UPDATE loans SET status = 'closed' WHERE id = %s
-            RETURNING id, folio, status
-        """, (loan_id,))
-        updated_loan = cursor.fetchone()
-
         conn.commit()
         cursor.close()
         conn.close()
@@ -953,62 +2501,190 @@ def Get_pending_interest_payments_by_client_id(client_id: int) -> List[Dict[str,
     try:
         conn = get_db_connection()
         cursor = conn.cursor()
-        cursor.execute("""
-            SELECT s.id AS statement_id, s.loan_id, l.folio, l.original_amount, l.current_balance,
-                   s.period, s.interest_generated, s.interest_paid, s.due_date, s.status
+        pending_payments = _fetch_json_rows(cursor, _PENDING_STATEMENT_JSON, """
             FROM statements s
             JOIN loans l ON s.loan_id = l.id
             WHERE l.client_id = %s
               AND s.status IN ('pending', 'partial')
               AND s.due_date >= CURRENT_DATE
-            ORDER BY s.due_date ASC
-        """, (client_id,))
-        rows = cursor.fetchall()
+        """, (client_id,), "s.due_date ASC")
         cursor.close()
         conn.close()
-        
-        pending_payments = []
-        for row in rows:
-            pending_interest = float(row["interest_generated"]) - float(row["interest_paid"])
-            pending_payments.append({
-                "statement_id": row["statement_id"],
-                "loan_id": row["loan_id"],
-                "folio": row["folio"],
-                "original_amount": float(row["original_amount"]),
-                "current_balance": float(row["current_balance"]),
-                "period": row["period"],
-                "interest_generated": float(row["interest_generated"]),
-                "interest_paid": float(row["interest_paid"]),
-                "pending_interest": pending_interest,
-                "due_date": row["due_date"].strftime('%Y-%m-%d'),
-                "status": row["status"]
-            })
         return pending_payments
     except Exception as e:
         return [{"error": f"Error en Get_pending_interest_payments: {str(e)}"}]
 
-@app.tool
-def Generate_monthly_cutoff_for_period(period: str, due_days: int = 10) -> Dict[str, Any]:
+def _period_cutoff_date(cutoff_month: datetime, start_date):
+    # Mismo día que el start_date, pero en el mes/año del periodo
+    try:
+        return cutoff_month.replace(day=start_date.day).date()
+    except ValueError:
+        # Día fuera de rango, usar último día del mes
+        next_month = cutoff_month.replace(day=28) + timedelta(days=4)
+        last_day = (next_month - timedelta(days=next_month.day)).day
+        return cutoff_month.replace(day=last_day).date()
+
+def _period_interest(loan, cutoff_dt, rate_index=None):
     """
-    Genera el corte mensual para TODOS los préstamos activos en el periodo especificado (YYYY-MM).
-    - La fecha de corte se calcula automáticamente: mismo día que el start_date, pero con mes/año del periodo.
-    - No genera corte si el periodo coincide con el mes del start_date.
-    - Solo genera un corte por préstamo y periodo.
-    - Retorna resumen de resultados.
+    Interés del periodo sobre current_balance. Con rate_index la tasa se resuelve desde
+    rate_configuration; retorna (interés, tasa nueva o None si no cambió).
     """
-    try:
-        # Validar formato del periodo
-        try:
-            cutoff_month = datetime.strptime(period, "%Y-%m")
-        except ValueError:
-            return {"error": "El periodo debe tener formato YYYY-MM."}
+    interest_rate = float(loan["interest_rate"])
+    new_rate = None
+    if rate_index is not None:
+        rate = rate_index.lookup(loan["loan_type"], loan["original_amount"], cutoff_dt)
+        if rate and float(rate["interest_rate"]) != interest_rate:
+            interest_rate = float(rate["interest_rate"])
+            new_rate = rate["interest_rate"]
+    return round(float(loan["current_balance"]) * (interest_rate / 100.0), 2), new_rate
 
-        conn = get_db_connection()
-        cursor = conn.cursor()
+def _generate_period_cutoffs(cursor, period: str, loans, due_days: int, results: Dict[str, Any], rate_index=None) -> int:
+    """
+    Genera el statement y el cargo de interés del periodo para cada préstamo de la lista,
+    acumulando en results. No hace commit (lo decide quien llama). Retorna cuántos préstamos
+    cambiaron de tasa cuando se pasa rate_index.
+    """
+    cutoff_month = datetime.strptime(period, "%Y-%m")
+    checkpoints = {}
+    repriced = []
+
+    for loan in loans:
+        loan_id = loan["id"]
+        start_date = loan["start_date"]
+        start_period = start_date.strftime("%Y-%m")
+        folio = loan["folio"]
+
+        # Saltar si el periodo es el mismo mes/año que el start_date
+        if period == start_period:
+            results["skipped"] += 1
+            results["details"].append({
+                "loan_id": loan_id,
+                "folio": folio,
+                "status": "skipped",
+                "reason": "skipped_same_month_as_start"
+            })
+            continue
+
+        cutoff_dt = _period_cutoff_date(cutoff_month, start_date)
+
+        # Fecha de vencimiento
+        due_date = cutoff_dt + timedelta(days=due_days)
+
+        # Verificar si ya existe statement para ese periodo
+        cursor.execute("""
+            SELECT id FROM statements WHERE loan_id = %s AND period = %s
+        """, (loan_id, period))
+        existing = cursor.fetchone()
+        if existing:
+            results["skipped"] += 1
+            results["details"].append({
+                "loan_id": loan_id,
+                "folio": folio,
+                "status": "skipped",
+                "reason": "already_exists"
+            })
+            continue
+
+        current_balance = float(loan["current_balance"])
+        interest_generated, new_rate = _period_interest(loan, cutoff_dt, rate_index)
+        if new_rate is not None:
+            repriced.append((loan_id, new_rate))
+
+        # Insertar movimiento de cargo de interés
+        cursor.execute("""
+            INSERT INTO movements (
+                loan_id, movement_type, amount, previous_balance, new_balance,
+                movement_date, application_period, reference, note
+            )
+            VALUES (%s, 'interest_charge', %s, %s, %s, %s, %s, %s, %s)
+            RETURNING id
+        """, (
+            loan_id,
+            interest_generated,
+            current_balance,
+            current_balance,
+            cutoff_dt,
+            period,
+            f"INT-{period}",
+            "Cargo de interés mensual"
+        ))
+        movement_row = cursor.fetchone()
+
+        # Insertar statement
+        cursor.execute("""
+            INSERT INTO statements (
+                loan_id, period, initial_balance, final_balance,
+                interest_generated, interest_paid, principal_paid,
+                cut_off_date, due_date, status
+            )
+            VALUES (%s, %s, %s, %s, %s, 0, 0, %s, %s, 'pending')
+            RETURNING id, period, initial_balance, final_balance, interest_generated, 
+                      cut_off_date, due_date, status
+        """, (
+            loan_id, period,
+            current_balance,
+            current_balance,
+            interest_generated,
+            cutoff_dt, due_date
+        ))
+        statement_row = cursor.fetchone()
+
+        checkpoints.setdefault(cutoff_dt, []).append(loan_id)
+        results["generated"] += 1
+        results["details"].append({
+            "loan_id": loan_id,
+            "folio": folio,
+            "status": "generated",
+            "statement_id": statement_row["id"],
+            "interest_generated": interest_generated
+        })
+
+    # Checkpoints de saldos, agrupados por fecha de corte
+    for checkpoint_date, loan_ids in checkpoints.items():
+        _write_loan_checkpoints(cursor, checkpoint_date, loan_ids)
+
+    # Persistir las tasas re-calculadas en un solo UPDATE
+    if repriced:
+        from psycopg2.extras import execute_values
+        execute_values(cursor, """
+            UPDATE loans SET interest_rate = v.interest_rate
+            FROM (VALUES %s) AS v(id, interest_rate)
+            WHERE loans.id = v.id
+        """, repriced)
+    return len(repriced)
+
+@app.tool(cost="batch")
+def Generate_monthly_cutoff_for_period(period: str, due_days: int = 10, reprice: bool = False,
+                                       dry_run: bool = False) -> Dict[str, Any]:
+    """
+    Genera el corte mensual para TODOS los préstamos activos en el periodo especificado (YYYY-MM).
+    - La fecha de corte se calcula automáticamente: mismo día que el start_date, pero con mes/año del periodo.
+    - No genera corte si el periodo coincide con el mes del start_date.
+    - Solo genera un corte por préstamo y periodo.
+    - reprice=True: resuelve la tasa de cada préstamo desde rate_configuration (índice en memoria)
+      a la fecha de corte y actualiza loans.interest_rate si cambió.
+    - dry_run=True: no escribe nada; hace el mismo cálculo sobre un snapshot REPEATABLE READ y
+      retorna totales (statements a generar, interés, omitidos) y una estimación de duración.
+    - Retorna resumen de resultados.
+    """
+    try:
+        # Validar formato del periodo
+        try:
+            cutoff_month = datetime.strptime(period, "%Y-%m")
+        except ValueError:
+            return {"error": "El periodo debe tener formato YYYY-MM."}
+
+        if dry_run:
+            return simulate_period_cutoff(period, due_days, reprice)
+
+        started_at = datetime.now()
+        started = time.perf_counter()
+        conn = get_db_connection()
+        cursor = conn.cursor()
 
         # Obtener todos los préstamos activos
         cursor.execute("""
-            SELECT id, client_id, original_amount, current_balance, interest_rate, start_date, status, folio
+            SELECT id, client_id, original_amount, current_balance, interest_rate, start_date, status, folio, loan_type
             FROM loans
             WHERE status = 'active'
         """)
@@ -1022,156 +2698,2170 @@ def Generate_monthly_cutoff_for_period(period: str, due_days: int = 10) -> Dict[
             "errors": 0,
             "details": []
         }
+        rate_index = get_rate_index(cursor) if reprice else None
+        repriced = _generate_period_cutoffs(cursor, period, loans, due_days, results, rate_index)
+        if reprice:
+            results["repriced"] = repriced
 
-        for loan in loans:
-            loan_id = loan["id"]
-            start_date = loan["start_date"]
-            start_period = start_date.strftime("%Y-%m")
-            folio = loan["folio"]
+        summary = {key: value for key, value in results.items() if key not in ("success", "details")}
+        summary.update(processed=len(loans), work_seconds=round(time.perf_counter() - started, 3))
+        _record_manual_run(cursor, "monthly_cutoff", "Generate_monthly_cutoff_for_period", started_at, summary)
+        conn.commit()
+        cursor.close()
+        conn.close()
+        return results
 
-            # Saltar si el periodo es el mismo mes/año que el start_date
-            if period == start_period:
-                results["skipped"] += 1
-                results["details"].append({
-                    "loan_id": loan_id,
-                    "folio": folio,
-                    "status": "skipped",
-                    "reason": "skipped_same_month_as_start"
-                })
-                continue
+    except Exception as e:
+        return {"error": f"Error en Generate_monthly_cutoff_for_period: {str(e)}"}
 
-            # Calcular fecha de corte: mismo día que el start_date, pero en el mes/año del periodo
-            start_day = start_date.day
-            try:
-                cutoff_dt = cutoff_month.replace(day=start_day).date()
-            except ValueError:
-                # Día fuera de rango, usar último día del mes
-                next_month = cutoff_month.replace(day=28) + timedelta(days=4)
-                last_day = (next_month - timedelta(days=next_month.day)).day
-                cutoff_dt = cutoff_month.replace(day=last_day).date()
+@app.tool(cost="report")
+def Get_all_pending_interest_statements() -> List[Dict[str, Any]]:
+    """
+    Obtiene todos los estados de cuenta (statements) pendientes de pagar en el sistema.
+    Devuelve los resultados ordenados de menor a mayor por fecha de vencimiento.
+    """
+    try:
+        fields = _PENDING_STATEMENT_JSON[:3] + [("client_id", "l.client_id", "int"), ("client_name", "c.name", "text")] + _PENDING_STATEMENT_JSON[3:]
+        return _cached_report("Get_all_pending_interest_statements", (), lambda cursor: _fetch_json_rows(cursor, fields, """
+            FROM statements s
+            JOIN loans l ON s.loan_id = l.id
+            JOIN clients c ON l.client_id = c.id
+            WHERE s.status IN ('pending', 'partial')
+        """, None, "s.due_date ASC"))
+    except Exception as e:
+        return [{"error": f"Error en Get_all_pending_interest_statements: {str(e)}"}]
 
-            # Fecha de vencimiento
-            due_date = cutoff_dt + timedelta(days=due_days)
+# ==================== PORTAFOLIO ====================
 
-            # Verificar si ya existe statement para ese periodo
-            cursor.execute("""
-                SELECT id FROM statements WHERE loan_id = %s AND period = %s
-            """, (loan_id, period))
-            existing = cursor.fetchone()
-            if existing:
-                results["skipped"] += 1
-                results["details"].append({
-                    "loan_id": loan_id,
-                    "folio": folio,
-                    "status": "skipped",
-                    "reason": "already_exists"
-                })
-                continue
+@app.tool(cost="report")
+def Get_portfolio_metrics(period: Optional[str] = None, as_of_date: Optional[str] = None) -> Dict[str, Any]:
+    """
+    Obtiene métricas agregadas del portafolio desde las tablas de rollup
+    (portfolio_loan_rollup y portfolio_statement_rollup), sin recorrer préstamos ni statements.
+    - Préstamos por status: cantidad, monto original y saldo (capital pendiente total)
+    - Por periodo: interés facturado vs. cobrado, mora y desglose por status
+    - Antigüedad de saldos vencidos por bucket: current, 1-30, 31-60, 61-90, 90+
+
+    period: 'YYYY-MM' (si no se pasa, incluye todos los periodos)
+    as_of_date: 'YYYY-MM-DD' fecha de referencia para la antigüedad (si no se pasa, usa hoy)
+    """
+    try:
+        as_of_dt = datetime.strptime(as_of_date, "%Y-%m-%d").date() if as_of_date else datetime.now().date()
+
+        conn = get_db_connection()
+        cursor = conn.cursor()
 
-            current_balance = float(loan["current_balance"])
-            interest_rate = float(loan["interest_rate"])
-            interest_generated = round(current_balance * (interest_rate / 100.0), 2)
+        cursor.execute("""
+            SELECT status, SUM(loan_count) AS loan_count, SUM(original_amount) AS original_amount,
+                   SUM(current_balance) AS current_balance
+            FROM portfolio_loan_rollup
+            GROUP BY status
+            HAVING SUM(loan_count) > 0
+            ORDER BY status
+        """)
+        loan_rows = cursor.fetchall()
+
+        cursor.execute("""
+            SELECT period, status, SUM(statement_count) AS statements,
+                   SUM(interest_generated) AS interest_generated, SUM(interest_paid) AS interest_paid,
+                   SUM(principal_paid) AS principal_paid, SUM(late_fee_generated) AS late_fee_generated
+            FROM portfolio_statement_rollup
+            WHERE (%s::text IS NULL OR period = %s)
+            GROUP BY period, status
+            HAVING SUM(statement_count) > 0
+            ORDER BY period DESC, status
+        """, (period, period))
+        period_rows = cursor.fetchall()
+
+        cursor.execute("""
+            SELECT CASE
+                       WHEN due_date >= %s THEN 'current'
+                       WHEN %s - due_date <= 30 THEN '1-30'
+                       WHEN %s - due_date <= 60 THEN '31-60'
+                       WHEN %s - due_date <= 90 THEN '61-90'
+                       ELSE '90+'
+                   END AS bucket,
+                   SUM(statement_count) AS statements,
+                   SUM(interest_generated - interest_paid) AS pending_interest,
+                   SUM(late_fee_generated) AS late_fee_generated
+            FROM portfolio_statement_rollup
+            WHERE status IN ('pending', 'partial', 'overdue')
+              AND (%s::text IS NULL OR period = %s)
+            GROUP BY 1
+            HAVING SUM(statement_count) > 0
+        """, (as_of_dt, as_of_dt, as_of_dt, as_of_dt, period, period))
+        aging_rows = cursor.fetchall()
+
+        cursor.close()
+        conn.close()
+
+        loans_by_status = {}
+        outstanding_principal = 0.0
+        for row in loan_rows:
+            loans_by_status[row["status"]] = {
+                "count": int(row["loan_count"]),
+                "original_amount": float(row["original_amount"]),
+                "current_balance": float(row["current_balance"])
+            }
+            if row["status"] in ('active', 'defaulted'):
+                outstanding_principal += float(row["current_balance"])
+
+        periods = {}
+        for row in period_rows:
+            entry = periods.setdefault(row["period"], {
+                "period": row["period"],
+                "statements": 0,
+                "interest_billed": 0.0,
+                "interest_collected": 0.0,
+                "principal_paid": 0.0,
+                "late_fee_generated": 0.0,
+                "by_status": {}
+            })
+            entry["statements"] += int(row["statements"])
+            entry["interest_billed"] = round(entry["interest_billed"] + float(row["interest_generated"]), 2)
+            entry["interest_collected"] = round(entry["interest_collected"] + float(row["interest_paid"]), 2)
+            entry["principal_paid"] = round(entry["principal_paid"] + float(row["principal_paid"]), 2)
+            entry["late_fee_generated"] = round(entry["late_fee_generated"] + float(row["late_fee_generated"]), 2)
+            entry["by_status"][row["status"]] = int(row["statements"])
+
+        aging = {bucket: {"statements": 0, "pending_interest": 0.0, "late_fee_generated": 0.0}
+                 for bucket in ('current', '1-30', '31-60', '61-90', '90+')}
+        for row in aging_rows:
+            aging[row["bucket"]] = {
+                "statements": int(row["statements"]),
+                "pending_interest": float(row["pending_interest"]),
+                "late_fee_generated": float(row["late_fee_generated"])
+            }
+
+        return {
+            "success": True,
+            "as_of_date": as_of_dt.strftime('%Y-%m-%d'),
+            "period": period,
+            "loans": {
+                "by_status": loans_by_status,
+                "total_outstanding_principal": round(outstanding_principal, 2)
+            },
+            "periods": list(periods.values()),
+            "aging": aging
+        }
+    except Exception as e:
+        return {"error": f"Error en Get_portfolio_metrics: {str(e)}"}
+
+# ==================== SALDOS HISTÓRICOS ====================
+
+# Estado de préstamos a una fecha: checkpoint más cercano (<= fecha) + movimientos
+# posteriores a él. Los movimientos con fecha retroactiva (id > last_movement_id)
+# también se reproducen, así el resultado no depende de cuándo se registraron.
+# Incluye los préstamos archivados: sus checkpoints se borran al archivar, así que su
+# estado se reproduce completo desde movements_archive.
+_LOAN_STATE_SQL = """
+    SELECT l.id AS loan_id, l.folio, l.client_id, l.original_amount, l.granting_date,
+           c.as_of_date AS checkpoint_date,
+           COALESCE(c.balance, l.original_amount) + COALESCE(d.balance_delta, 0) AS balance,
+           COALESCE(c.interest_charged, 0) + COALESCE(d.interest_charged, 0) AS interest_charged,
+           COALESCE(c.late_fees_charged, 0) + COALESCE(d.late_fees_charged, 0) AS late_fees_charged,
+           COALESCE(c.late_fees_paid, 0) + COALESCE(d.late_fees_paid, 0) AS late_fees_paid,
+           COALESCE(c.interest_paid, 0) + COALESCE(d.interest_paid, 0) AS interest_paid,
+           COALESCE(c.principal_paid, 0) + COALESCE(d.principal_paid, 0) AS principal_paid,
+           COALESCE(c.adjustments, 0) + COALESCE(d.adjustments, 0) AS adjustments,
+           GREATEST(COALESCE(c.last_movement_id, 0), COALESCE(d.last_movement_id, 0)) AS last_movement_id,
+           COALESCE(d.movements, 0) AS replayed_movements
+    FROM (
+        SELECT id, folio, client_id, original_amount, granting_date, FALSE AS archived FROM loans
+        UNION ALL
+        SELECT id, folio, client_id, original_amount, granting_date, TRUE FROM loans_archive
+    ) l
+    LEFT JOIN LATERAL (
+        SELECT as_of_date, last_movement_id, balance, interest_charged, late_fees_charged,
+               late_fees_paid, interest_paid, principal_paid, adjustments
+        FROM loan_checkpoints
+        WHERE loan_id = l.id AND as_of_date <= %(as_of)s
+        ORDER BY as_of_date DESC
+        LIMIT 1
+    ) c ON TRUE
+    LEFT JOIN LATERAL (
+        SELECT COUNT(*) AS movements,
+               MAX(m.id) AS last_movement_id,
+               SUM(m.new_balance - m.previous_balance) AS balance_delta,
+               SUM(m.amount) FILTER (WHERE m.movement_type = 'interest_charge') AS interest_charged,
+               SUM(m.amount) FILTER (WHERE m.movement_type = 'late_fee_charge') AS late_fees_charged,
+               SUM(m.amount) FILTER (WHERE m.movement_type = 'late_fee_payment') AS late_fees_paid,
+               SUM(m.amount) FILTER (WHERE m.movement_type = 'interest_payment') AS interest_paid,
+               SUM(m.amount) FILTER (WHERE m.movement_type = 'principal_payment') AS principal_paid,
+               SUM(m.amount) FILTER (
+                   WHERE m.movement_type = 'adjustment' AND m.new_balance = m.previous_balance
+               ) AS adjustments
+        FROM (
+            SELECT id, loan_id, movement_type, amount, previous_balance, new_balance, movement_date
+            FROM movements WHERE NOT l.archived
+            UNION ALL
+            SELECT id, loan_id, movement_type, amount, previous_balance, new_balance, movement_date
+            FROM movements_archive WHERE l.archived
+        ) m
+        WHERE m.loan_id = l.id
+          AND m.movement_date <= %(as_of)s
+          AND (c.as_of_date IS NULL OR m.movement_date > c.as_of_date OR m.id > c.last_movement_id)
+    ) d ON TRUE
+    WHERE l.granting_date <= %(as_of)s
+      AND (%(loan_ids)s::int[] IS NULL OR l.id = ANY(%(loan_ids)s::int[]))
+"""
+
+def _write_loan_checkpoints(cursor, as_of, loan_ids: List[int]) -> None:
+    """Escribe (o actualiza) el checkpoint de los préstamos indicados a la fecha as_of."""
+    if not loan_ids:
+        return
+    # Los abonos toman el préstamo FOR SHARE antes de insertar su movimiento: con el lock
+    # (en orden de id) ya confirmaron los abonos en curso y el estado leído después los
+    # incluye. Sin él, un movimiento con id menor confirmado después del checkpoint
+    # quedaría por debajo de last_movement_id y no se reproduciría nunca.
+    cursor.execute("SELECT id FROM loans WHERE id = ANY(%s) ORDER BY id FOR UPDATE", (list(loan_ids),))
+    cursor.execute(f"""
+        INSERT INTO loan_checkpoints (
+            loan_id, as_of_date, last_movement_id, balance, interest_charged,
+            late_fees_charged, late_fees_paid, interest_paid, principal_paid, adjustments
+        )
+        SELECT loan_id, %(as_of)s, last_movement_id, balance, interest_charged,
+               late_fees_charged, late_fees_paid, interest_paid, principal_paid, adjustments
+        FROM ({_LOAN_STATE_SQL}) s
+        ON CONFLICT (loan_id, as_of_date) DO UPDATE SET
+            last_movement_id = EXCLUDED.last_movement_id,
+            balance = EXCLUDED.balance,
+            interest_charged = EXCLUDED.interest_charged,
+            late_fees_charged = EXCLUDED.late_fees_charged,
+            late_fees_paid = EXCLUDED.late_fees_paid,
+            interest_paid = EXCLUDED.interest_paid,
+            principal_paid = EXCLUDED.principal_paid,
+            adjustments = EXCLUDED.adjustments,
+            created_at = CURRENT_TIMESTAMP
+    """, {"as_of": as_of, "loan_ids": list(loan_ids)})
+
+def _outstanding_interest(row) -> float:
+    return round(
+        float(row["interest_charged"]) + float(row["late_fees_charged"]) + float(row["adjustments"])
+        - float(row["interest_paid"]) - float(row["late_fees_paid"]), 2
+    )
+
+@app.tool
+def Get_loan_state_at(loan_id: int, date: str) -> Dict[str, Any]:
+    """
+    Reconstruye el saldo de capital y el interés pendiente de un préstamo a una fecha (YYYY-MM-DD).
+    Parte del checkpoint más cercano anterior a la fecha (generado en cada corte) y
+    reproduce solo los movimientos posteriores, sin recorrer toda la historia.
+    """
+    try:
+        try:
+            as_of = datetime.strptime(date, "%Y-%m-%d").date()
+        except ValueError:
+            return {"error": "La fecha debe tener formato YYYY-MM-DD."}
+
+        conn = get_db_connection()
+        cursor = conn.cursor()
+        cursor.execute("""
+            SELECT id, granting_date FROM loans WHERE id = %s
+            UNION ALL
+            SELECT id, granting_date FROM loans_archive WHERE id = %s
+        """, (loan_id, loan_id))
+        loan = cursor.fetchone()
+        if not loan:
+            cursor.close()
+            conn.close()
+            return {"error": f"No existe el préstamo {loan_id}."}
+        if loan["granting_date"] > as_of:
+            cursor.close()
+            conn.close()
+            return {"error": f"El préstamo {loan_id} fue otorgado el {loan['granting_date'].strftime('%Y-%m-%d')}, después de {date}."}
+
+        cursor.execute(_LOAN_STATE_SQL, {"as_of": as_of, "loan_ids": [loan_id]})
+        row = cursor.fetchone()
+        cursor.close()
+        conn.close()
+
+        return {
+            "loan_id": row["loan_id"],
+            "folio": row["folio"],
+            "as_of_date": as_of.strftime('%Y-%m-%d'),
+            "balance": float(row["balance"]),
+            "outstanding_interest": _outstanding_interest(row),
+            "interest_charged": float(row["interest_charged"]),
+            "late_fees_charged": float(row["late_fees_charged"]),
+            "late_fees_paid": float(row["late_fees_paid"]),
+            "interest_paid": float(row["interest_paid"]),
+            "principal_paid": float(row["principal_paid"]),
+            "adjustments": float(row["adjustments"]),
+            "checkpoint_date": row["checkpoint_date"].strftime('%Y-%m-%d') if row["checkpoint_date"] else None,
+            "replayed_movements": int(row["replayed_movements"])
+        }
+    except Exception as e:
+        return {"error": f"Error en Get_loan_state_at: {str(e)}"}
+
+@app.tool(cost="report")
+def Get_portfolio_state_at(date: str, client_id: Optional[int] = None) -> Dict[str, Any]:
+    """
+    Reconstruye el saldo de capital y el interés pendiente de todo el portafolio
+    (o de los préstamos de un cliente) a una fecha (YYYY-MM-DD), usando checkpoints.
+    """
+    try:
+        try:
+            as_of = datetime.strptime(date, "%Y-%m-%d").date()
+        except ValueError:
+            return {"error": "La fecha debe tener formato YYYY-MM-DD."}
+
+        conn = get_db_connection()
+        cursor = conn.cursor()
+        cursor.execute(f"""
+            SELECT COUNT(*) AS loans,
+                   COUNT(*) FILTER (WHERE balance > 0) AS loans_with_balance,
+                   COALESCE(SUM(balance), 0) AS balance,
+                   COALESCE(SUM(interest_charged), 0) AS interest_charged,
+                   COALESCE(SUM(late_fees_charged), 0) AS late_fees_charged,
+                   COALESCE(SUM(late_fees_paid), 0) AS late_fees_paid,
+                   COALESCE(SUM(interest_paid), 0) AS interest_paid,
+                   COALESCE(SUM(principal_paid), 0) AS principal_paid,
+                   COALESCE(SUM(adjustments), 0) AS adjustments,
+                   COALESCE(SUM(replayed_movements), 0) AS replayed_movements
+            FROM ({_LOAN_STATE_SQL}) s
+            WHERE (%(client_id)s::int IS NULL OR client_id = %(client_id)s::int)
+        """, {"as_of": as_of, "loan_ids": None, "client_id": client_id})
+        row = cursor.fetchone()
+        cursor.close()
+        conn.close()
+
+        return {
+            "as_of_date": as_of.strftime('%Y-%m-%d'),
+            "client_id": client_id,
+            "loans": int(row["loans"]),
+            "loans_with_balance": int(row["loans_with_balance"]),
+            "balance": float(row["balance"]),
+            "outstanding_interest": _outstanding_interest(row),
+            "interest_charged": float(row["interest_charged"]),
+            "late_fees_charged": float(row["late_fees_charged"]),
+            "late_fees_paid": float(row["late_fees_paid"]),
+            "interest_paid": float(row["interest_paid"]),
+            "principal_paid": float(row["principal_paid"]),
+            "adjustments": float(row["adjustments"]),
+            "replayed_movements": int(row["replayed_movements"])
+        }
+    except Exception as e:
+        return {"error": f"Error en Get_portfolio_state_at: {str(e)}"}
+
+# ==================== RECÁLCULO RETROACTIVO ====================
+# Los cortes toman loans.current_balance al momento de correr. Un abono con fecha anterior
+# a cortes ya generados deja mal su interés: aquí se recalcula, para cada statement con
+# cut_off_date igual o posterior a la fecha, el saldo al cierre de su fecha de corte
+# (original_amount + deltas de los movimientos hasta el corte inclusive, como los checkpoints
+# y el corte mismo, que toma el saldo vigente del día) y el interés con la tasa con la que se
+# generó. Solo se tocan los statements que cambian; la diferencia de interés queda como
+# movimiento 'adjustment' (sin cambio de saldo) fechado al corte, así los saldos históricos
+# y el ledger siguen cuadrando. Cada préstamo se corrige en una sola transacción.
+
+_RECALC_STATEMENTS_SQL = """
+    SELECT s.id, s.period, s.cut_off_date, s.initial_balance, s.final_balance, s.interest_generated,
+           s.interest_paid, s.status,
+           l.original_amount + COALESCE((
+               SELECT SUM(m.new_balance - m.previous_balance)
+               FROM movements m
+               WHERE m.loan_id = s.loan_id AND m.movement_date <= s.cut_off_date
+           ), 0) AS balance_at_cutoff
+    FROM statements s
+    JOIN loans l ON l.id = s.loan_id
+    WHERE s.loan_id = %s AND s.cut_off_date >= %s
+    ORDER BY s.cut_off_date
+    FOR UPDATE OF s
+"""
+
+# Préstamos con movimientos que cambian el saldo registrados después de un corte con fecha
+# de corte igual o posterior al movimiento (depósitos bancarios tardíos, capturas retroactivas)
+_BACKDATED_LOANS_SQL = """
+    SELECT m.loan_id, MIN(m.movement_date) AS from_date
+    FROM movements m
+    WHERE m.created_at >= %s
+      AND m.new_balance <> m.previous_balance
+      AND EXISTS (
+          SELECT 1 FROM statements s
+          WHERE s.loan_id = m.loan_id AND s.cut_off_date >= m.movement_date AND s.created_at <= m.created_at
+      )
+    GROUP BY m.loan_id
+    ORDER BY m.loan_id
+"""
+
+def _statement_rate(initial_balance: float, interest_generated: float, loan_rate: float) -> float:
+    # La tasa del préstamo si reproduce el interés del statement; si no (se re-calculó la tasa
+    # después del corte), la tasa implícita en el statement.
+    if round(initial_balance * (loan_rate / 100.0), 2) == interest_generated or initial_balance <= 0:
+        return loan_rate
+    return round(interest_generated / initial_balance * 100.0, 2)
+
+def _recalculate_loan(cursor, loan_id: int, from_date) -> Dict[str, Any]:
+    """Recalcula los statements del préstamo con corte igual o posterior a from_date. No hace commit."""
+    # Orden de locks: préstamo -> statements (el ajuste lleva el saldo vigente del préstamo)
+    cursor.execute("SELECT id, current_balance, interest_rate FROM loans WHERE id = %s FOR UPDATE", (loan_id,))
+    loan = cursor.fetchone()
+    if not loan:
+        raise ValueError(f"No existe el préstamo {loan_id}.")
+    current_balance = float(loan["current_balance"])
+    loan_rate = float(loan["interest_rate"])
+
+    cursor.execute(_RECALC_STATEMENTS_SQL, (loan_id, from_date))
+    statements = cursor.fetchall()
+    details = []
+    for stmt in statements:
+        old_balance = float(stmt["initial_balance"])
+        old_interest = float(stmt["interest_generated"])
+        balance = float(stmt["balance_at_cutoff"])
+        rate = _statement_rate(old_balance, old_interest, loan_rate)
+        interest = round(balance * (rate / 100.0), 2)
+        if balance == old_balance and balance == float(stmt["final_balance"]) and interest == old_interest:
+            continue
+
+        interest_paid = float(stmt["interest_paid"] or 0)
+        status = stmt["status"]
+        if interest_paid >= interest - 0.005:
+            status = "paid"
+        elif status == "paid":
+            status = "partial" if interest_paid > 0 else "pending"
 
-            # Insertar movimiento de cargo de interés
+        cursor.execute("""
+            UPDATE statements
+            SET initial_balance = %s, final_balance = %s, interest_generated = %s, status = %s
+            WHERE id = %s
+        """, (balance, balance, interest, status, stmt["id"]))
+
+        delta = round(interest - old_interest, 2)
+        movement_id = None
+        if delta:
             cursor.execute("""
                 INSERT INTO movements (
                     loan_id, movement_type, amount, previous_balance, new_balance,
                     movement_date, application_period, reference, note
-                )
-                VALUES (%s, 'interest_charge', %s, %s, %s, %s, %s, %s, %s)
+                ) VALUES (%s, 'adjustment', %s, %s, %s, %s, %s, %s, %s)
                 RETURNING id
             """, (
-                loan_id,
-                interest_generated,
-                current_balance,
-                current_balance,
-                cutoff_dt,
-                period,
-                f"INT-{period}",
-                "Cargo de interés mensual"
+                loan_id, delta, current_balance, current_balance, stmt["cut_off_date"], stmt["period"],
+                f"RECALC-{stmt['period']}", f"Recálculo de interés por movimiento retroactivo (saldo {old_balance} -> {balance})"
             ))
-            movement_row = cursor.fetchone()
+            movement_id = cursor.fetchone()["id"]
 
-            # Insertar statement
-            cursor.execute("""
-                INSERT INTO statements (
-                    loan_id, period, initial_balance, final_balance,
-                    interest_generated, interest_paid, principal_paid,
-                    cut_off_date, due_date, status
-                )
-                VALUES (%s, %s, %s, %s, %s, 0, 0, %s, %s, 'pending')
-                RETURNING id, period, initial_balance, final_balance, interest_generated, 
-                          cut_off_date, due_date, status
-            """, (
-                loan_id, period,
-                current_balance,
-                current_balance,
-                interest_generated,
-                cutoff_dt, due_date
-            ))
-            statement_row = cursor.fetchone()
+        details.append({
+            "statement_id": stmt["id"],
+            "period": stmt["period"],
+            "previous_initial_balance": old_balance,
+            "initial_balance": balance,
+            "previous_interest_generated": old_interest,
+            "interest_generated": interest,
+            "interest_delta": delta,
+            "status": status,
+            "overpaid": round(interest_paid - interest, 2) if interest_paid > interest + 0.005 else 0.0,
+            "adjustment_movement_id": movement_id
+        })
 
-            results["generated"] += 1
-            results["details"].append({
-                "loan_id": loan_id,
-                "folio": folio,
-                "status": "generated",
-                "statement_id": statement_row["id"],
-                "interest_generated": interest_generated
-            })
+    return {
+        "loan_id": loan_id,
+        "from_date": from_date.strftime('%Y-%m-%d'),
+        "statements_checked": len(statements),
+        "statements_corrected": len(details),
+        "interest_delta": round(sum((d["interest_delta"] for d in details), 0.0), 2),
+        "details": details
+    }
 
+@app.tool
+def Recalculate_from(loan_id: int, date: str) -> Dict[str, Any]:
+    """
+    Recalcula los estados de cuenta de un préstamo con fecha de corte igual o posterior a date (YYYY-MM-DD),
+    p. ej. después de registrar un abono a capital con fecha retroactiva: saldos inicial/final,
+    interest_generated y status. La diferencia de interés se registra como movimiento 'adjustment'.
+    """
+    try:
+        from_date = datetime.strptime(date, "%Y-%m-%d").date()
+        conn = get_db_connection()
+        cursor = conn.cursor()
+        try:
+            result = _recalculate_loan(cursor, loan_id, from_date)
+        except ValueError as e:
+            cursor.close()
+            conn.close()
+            return {"error": str(e)}
         conn.commit()
         cursor.close()
         conn.close()
-        return results
-
+        return {"success": True, **result}
     except Exception as e:
-        return {"error": f"Error en Generate_monthly_cutoff_for_period: {str(e)}"}
+        return {"error": f"Error en Recalculate_from: {str(e)}"}
 
-@app.tool
-def Get_all_pending_interest_statements() -> List[Dict[str, Any]]:
+@app.tool(cost="batch")
+def Recalculate_from_batch(items: Optional[List[Dict[str, Any]]] = None, posted_since: Optional[str] = None) -> Dict[str, Any]:
     """
-    Obtiene todos los estados de cuenta (statements) pendientes de pagar en el sistema.
-    Devuelve los resultados ordenados de menor a mayor por fecha de vencimiento.
+    Recalcula varios préstamos, cada uno en su propia transacción.
+    - items: [{"loan_id": 1, "date": "YYYY-MM-DD"}, ...]
+    - posted_since (YYYY-MM-DD): además detecta los préstamos con movimientos de saldo registrados
+      desde esa fecha con fecha anterior a un corte ya generado, y recalcula desde el más antiguo.
     """
     try:
+        if not items and not posted_since:
+            return {"error": "Indica items o posted_since."}
         conn = get_db_connection()
         cursor = conn.cursor()
-        cursor.execute("""
-            SELECT s.id AS statement_id, s.loan_id, l.folio, l.original_amount, l.current_balance,
-                   s.period, s.interest_generated, s.interest_paid, s.due_date, s.status,
-                   l.client_id, c.name as client_name
-            FROM statements s
-            JOIN loans l ON s.loan_id = l.id
-            JOIN clients c ON l.client_id = c.id
-            WHERE s.status IN ('pending', 'partial')
-            ORDER BY s.due_date ASC
-        """)
-        rows = cursor.fetchall()
+
+        targets = {}
+        for item in items or []:
+            item_date = datetime.strptime(item["date"], "%Y-%m-%d").date()
+            targets[item["loan_id"]] = min(item_date, targets.get(item["loan_id"], item_date))
+        if posted_since:
+            cursor.execute(_BACKDATED_LOANS_SQL, (datetime.strptime(posted_since, "%Y-%m-%d"),))
+            for row in cursor.fetchall():
+                targets[row["loan_id"]] = min(row["from_date"], targets.get(row["loan_id"], row["from_date"]))
+            conn.commit()
+        if len(targets) > MAX_LOANS_PER_BATCH:
+            cursor.close()
+            conn.close()
+            return {"error": f"Máximo {MAX_LOANS_PER_BATCH} préstamos por lote (se recibieron {len(targets)})."}
+
+        results = {"success": True, "processed": 0, "corrected": 0, "errors": 0, "interest_delta": 0.0, "details": []}
+        for loan_id, from_date in sorted(targets.items()):
+            try:
+                result = _recalculate_loan(cursor, loan_id, from_date)
+                conn.commit()
+            except Exception as e:
+                conn.rollback()
+                results["errors"] += 1
+                results["details"].append({"loan_id": loan_id, "error": str(e)})
+                continue
+            results["processed"] += 1
+            if result["statements_corrected"]:
+                results["corrected"] += 1
+                results["interest_delta"] = round(results["interest_delta"] + result["interest_delta"], 2)
+                results["details"].append(result)
         cursor.close()
         conn.close()
-        
-        pending_statements = []
-        for row in rows:
-            pending_interest = float(row["interest_generated"]) - float(row["interest_paid"])
-            pending_statements.append({
-                "statement_id": row["statement_id"],
-                "loan_id": row["loan_id"],
-                "folio": row["folio"],
-                "client_id": row["client_id"],
-                "client_name": row["client_name"],
-                "original_amount": float(row["original_amount"]),
+        return results
+    except Exception as e:
+        return {"error": f"Error en Recalculate_from_batch: {str(e)}"}
+
+# ==================== ARCHIVO DE PRÉSTAMOS CERRADOS ====================
+# Los préstamos cerrados, con todos sus statements pagados y sin movimientos en los
+# últimos ARCHIVE_RETENTION_DAYS, se mueven con sus movements y statements a las tablas
+# *_archive (ver init.sql), así los índices calientes solo cargan cartera viva.
+# Get_loan_by_id, Get_loan_movements y Get_loan_statements leen del archivo cuando el
+# préstamo ya no está en las tablas calientes; Get_loans_by_client lista ambos. Los saldos
+# históricos (Get_loan_state_at, Get_portfolio_state_at), los rollups del portafolio y
+# Export_period también los incluyen. Solo la verificación del ledger se limita a las
+# tablas calientes: lo archivado ya no cambia.
+
+ARCHIVE_RETENTION_DAYS = int(os.getenv("ARCHIVE_RETENTION_DAYS", "365"))
+
+_ARCHIVE_CANDIDATES_SQL = """
+    SELECT l.id
+    FROM loans l
+    WHERE l.status = 'closed' AND l.id > %(after)s AND l.start_date < %(limit)s
+      AND NOT EXISTS (SELECT 1 FROM statements s WHERE s.loan_id = l.id AND s.status <> 'paid')
+      AND NOT EXISTS (SELECT 1 FROM movements m WHERE m.loan_id = l.id AND m.movement_date >= %(limit)s)
+    ORDER BY l.id
+    LIMIT %(batch_size)s
+    FOR UPDATE OF l SKIP LOCKED
+"""
+
+def _fetch_loan_rows(cursor, fields, table: str, loan_id: int, where: str, params, order_by: str) -> List[Dict[str, Any]]:
+    """
+    _fetch_json_rows sobre {table} si el préstamo sigue en loans y, si no, solo sobre
+    {table}_archive (un préstamo se archiva completo, nunca queda repartido).
+    """
+    cursor.execute("SELECT EXISTS (SELECT 1 FROM loans WHERE id = %s) AS hot", (loan_id,))
+    source = table if cursor.fetchone()["hot"] else f"{table}_archive"
+    return _fetch_json_rows(cursor, fields, f"FROM {source} WHERE {where}", params, order_by)
+
+def _archive_loans(cursor, loan_ids: List[int]) -> Dict[str, int]:
+    """Mueve los préstamos (ya bloqueados) y sus filas hijas al archivo, sin commit."""
+    # Solo en esta transacción: los rollups del portafolio no restan lo archivado
+    cursor.execute("SELECT set_config('loans.archiving', 'on', true)")
+    counts = {}
+    for table in ("movements", "statements"):
+        cursor.execute(f"""
+            WITH moved AS (DELETE FROM {table} WHERE loan_id = ANY(%s) RETURNING *)
+            INSERT INTO {table}_archive SELECT * FROM moved
+        """, (loan_ids,))
+        counts[table] = cursor.rowcount
+    cursor.execute("DELETE FROM loan_checkpoints WHERE loan_id = ANY(%s)", (loan_ids,))
+    cursor.execute("""
+        WITH moved AS (DELETE FROM loans WHERE id = ANY(%s) RETURNING *)
+        INSERT INTO loans_archive SELECT moved.*, CURRENT_TIMESTAMP FROM moved
+    """, (loan_ids,))
+    counts["loans"] = cursor.rowcount
+    return counts
+
+@app.tool(cost="batch")
+def Archive_closed_loans(retention_days: Optional[int] = None, batch_size: int = 500,
+                         max_batches: Optional[int] = None) -> Dict[str, Any]:
+    """
+    Mueve a las tablas de archivo los préstamos 'closed' con todos sus statements pagados y
+    sin movimientos en los últimos retention_days (por defecto ARCHIVE_RETENTION_DAYS),
+    junto con sus movements y statements. Procesa lotes de batch_size préstamos con commit
+    por lote; con max_batches la corrida se detiene antes y la siguiente continúa.
+    """
+    try:
+        retention_days = ARCHIVE_RETENTION_DAYS if retention_days is None else retention_days
+        if retention_days < 0:
+            return {"error": "retention_days no puede ser negativo."}
+        if batch_size <= 0:
+            return {"error": "batch_size debe ser mayor a 0."}
+
+        limit_dt = datetime.now().date() - timedelta(days=retention_days)
+        results = {
+            "success": True,
+            "retention_days": retention_days,
+            "inactive_since": limit_dt.strftime('%Y-%m-%d'),
+            "batches": 0,
+            "loans": 0,
+            "movements": 0,
+            "statements": 0,
+            "more_pending": False
+        }
+        after = 0
+        while True:
+            if max_batches is not None and results["batches"] >= max_batches:
+                results["more_pending"] = True
+                break
+            conn = get_db_connection()
+            cursor = conn.cursor()
+            cursor.execute(_ARCHIVE_CANDIDATES_SQL, {"after": after, "limit": limit_dt, "batch_size": batch_size})
+            loan_ids = [row["id"] for row in cursor.fetchall()]
+            if loan_ids:
+                counts = _archive_loans(cursor, loan_ids)
+                conn.commit()
+            cursor.close()
+            conn.close()
+            if not loan_ids:
+                break
+            after = loan_ids[-1]
+            results["batches"] += 1
+            for key, count in counts.items():
+                results[key] += count
+        return results
+    except Exception as e:
+        return {"error": f"Error en Archive_closed_loans: {str(e)}"}
+
+# ==================== VERIFICACIÓN DEL LEDGER ====================
+
+# Cadena de saldos: cada movimiento nuevo debe partir del new_balance del anterior
+# (o del monto original si es el primero) y respetar su tipo. Solo se leen los
+# movimientos posteriores a la marca de agua más el último anterior a ella.
+_LEDGER_CHAIN_SQL = """
+    WITH chain AS (
+        SELECT m.id, m.loan_id, m.movement_type, m.amount, m.previous_balance, m.new_balance,
+               LAG(m.new_balance) OVER w AS expected_previous,
+               LAG(m.id) OVER w AS prior_id
+        FROM (
+            SELECT id, loan_id, movement_type, amount, previous_balance, new_balance
+            FROM movements
+            WHERE loan_id = ANY(%(loan_ids)s) AND id > %(from_id)s AND id <= %(to_id)s
+            UNION ALL
+            SELECT p.id, p.loan_id, p.movement_type, p.amount, p.previous_balance, p.new_balance
+            FROM unnest(%(loan_ids)s::int[]) AS t(loan_id)
+            CROSS JOIN LATERAL (
+                SELECT id, loan_id, movement_type, amount, previous_balance, new_balance
+                FROM movements
+                WHERE loan_id = t.loan_id AND id <= %(from_id)s
+                ORDER BY id DESC
+                LIMIT 1
+            ) p
+        ) m
+        WINDOW w AS (PARTITION BY m.loan_id ORDER BY m.id)
+    )
+    SELECT c.id AS movement_id, c.loan_id, c.movement_type, c.amount, c.previous_balance,
+           c.new_balance, COALESCE(c.expected_previous, l.original_amount) AS expected_previous
+    FROM chain c
+    JOIN loans l ON l.id = c.loan_id
+    WHERE c.id > %(from_id)s
+      AND (
+          c.previous_balance <> COALESCE(c.expected_previous, l.original_amount)
+          OR (c.movement_type = 'principal_payment' AND c.new_balance <> c.previous_balance - c.amount)
+          OR (c.movement_type IN ('interest_payment', 'interest_charge', 'late_fee_charge', 'late_fee_payment')
+              AND c.new_balance <> c.previous_balance)
+      )
+    ORDER BY c.loan_id, c.id
+"""
+
+# Saldo del préstamo vs. new_balance de su último movimiento
+_LEDGER_BALANCE_SQL = """
+    SELECT l.id AS loan_id, l.current_balance, lm.new_balance AS last_movement_balance, lm.id AS movement_id
+    FROM loans l
+    CROSS JOIN LATERAL (
+        SELECT id, new_balance FROM movements WHERE loan_id = l.id ORDER BY id DESC LIMIT 1
+    ) lm
+    WHERE l.id = ANY(%(loan_ids)s) AND lm.new_balance <> l.current_balance
+    ORDER BY l.id
+"""
+
+# interest_paid del statement vs. suma de pagos de interés del periodo,
+# solo para los (préstamo, periodo) con pagos nuevos
+_LEDGER_INTEREST_SQL = """
+    WITH touched AS (
+        SELECT DISTINCT loan_id, application_period
+        FROM movements
+        WHERE loan_id = ANY(%(loan_ids)s) AND id > %(from_id)s AND id <= %(to_id)s
+          AND movement_type = 'interest_payment'
+    )
+    SELECT s.id AS statement_id, s.loan_id, s.period, COALESCE(s.interest_paid, 0) AS interest_paid,
+           COALESCE(p.total, 0) AS movements_total
+    FROM touched t
+    JOIN statements s ON s.loan_id = t.loan_id AND s.period = t.application_period
+    CROSS JOIN LATERAL (
+        SELECT SUM(amount) AS total
+        FROM movements
+        WHERE loan_id = t.loan_id AND application_period = t.application_period
+          AND movement_type = 'interest_payment'
+    ) p
+    WHERE COALESCE(s.interest_paid, 0) <> COALESCE(p.total, 0)
+    ORDER BY s.loan_id, s.period
+"""
+
+def _verify_ledger_chunk(loan_ids: List[int], from_id: int, to_id: int) -> List[Dict[str, Any]]:
+    params = {"loan_ids": loan_ids, "from_id": from_id, "to_id": to_id}
+    conn = get_db_connection()
+    try:
+        conn.set_session(isolation_level="REPEATABLE READ", readonly=True)
+        cursor = conn.cursor()
+        discrepancies = []
+
+        cursor.execute(_LEDGER_CHAIN_SQL, params)
+        for row in cursor.fetchall():
+            discrepancies.append({
+                "check": "balance_chain",
+                "loan_id": row["loan_id"],
+                "movement_id": row["movement_id"],
+                "movement_type": row["movement_type"],
+                "amount": float(row["amount"]),
+                "previous_balance": float(row["previous_balance"]),
+                "new_balance": float(row["new_balance"]),
+                "expected_previous_balance": float(row["expected_previous"])
+            })
+
+        cursor.execute(_LEDGER_BALANCE_SQL, params)
+        for row in cursor.fetchall():
+            discrepancies.append({
+                "check": "current_balance",
+                "loan_id": row["loan_id"],
+                "movement_id": row["movement_id"],
                 "current_balance": float(row["current_balance"]),
+                "last_movement_balance": float(row["last_movement_balance"])
+            })
+
+        cursor.execute(_LEDGER_INTEREST_SQL, params)
+        for row in cursor.fetchall():
+            discrepancies.append({
+                "check": "statement_interest_paid",
+                "loan_id": row["loan_id"],
+                "statement_id": row["statement_id"],
                 "period": row["period"],
-                "interest_generated": float(row["interest_generated"]),
                 "interest_paid": float(row["interest_paid"]),
-                "pending_interest": pending_interest,
-                "due_date": row["due_date"].strftime('%Y-%m-%d'),
-                "status": row["status"]
+                "interest_payments_total": float(row["movements_total"])
             })
-        return pending_statements
+
+        cursor.close()
+        conn.rollback()
+        return discrepancies
+    finally:
+        conn.set_session(isolation_level="DEFAULT", readonly="DEFAULT")
+        conn.close()
+
+# Transacciones de otras sesiones abiertas desde antes del instante dado. pg_stat_activity se
+# congela dentro de una transacción, por eso cada consulta va en una transacción nueva.
+_OLDER_TRANSACTIONS_SQL = """
+    SELECT COUNT(*) AS pending FROM pg_stat_activity
+    WHERE datname = current_database() AND pid <> pg_backend_pid()
+      AND state <> 'idle' AND xact_start <= %s
+"""
+
+def _ledger_horizon(cursor, wait_seconds: float):
+    """
+    Retorna (to_id, pending): el último id de movements que ya no puede cambiar.
+    Un id de la secuencia se asigna dentro de una transacción que empezó antes de pedirlo,
+    así que todos los ids <= last_value son definitivos (confirmados o descartados) cuando
+    terminan las transacciones abiertas desde antes de leerlo. MAX(id) no sirve: a READ
+    COMMITTED no ve inserciones en curso con ids menores, que quedarían bajo la marca de agua.
+    Espera hasta wait_seconds; si sigue habiendo transacciones viejas retorna to_id=None.
+    """
+    cursor.execute("""
+        SELECT COALESCE(pg_sequence_last_value(pg_get_serial_sequence('movements', 'id')::regclass), 0) AS last_id
+    """)
+    last_id = cursor.fetchone()["last_id"]
+    cursor.execute("SELECT clock_timestamp() AS read_at")
+    read_at = cursor.fetchone()["read_at"]
+    deadline = time.monotonic() + wait_seconds
+    while True:
+        cursor.connection.rollback()
+        cursor.execute(_OLDER_TRANSACTIONS_SQL, (read_at,))
+        pending = cursor.fetchone()["pending"]
+        if pending == 0:
+            return last_id, 0
+        if time.monotonic() >= deadline:
+            return None, pending
+        time.sleep(0.1)
+
+def verify_ledger(full: bool = False, chunk_size: int = 500, parallelism: int = 4,
+                  horizon_wait_seconds: float = 10) -> Dict[str, Any]:
+    """
+    Verifica invariantes del ledger de forma incremental (desde la última marca de agua
+    hasta el horizonte seguro de _ledger_horizon) y registra la corrida en ledger_verification_runs.
+    """
+    from concurrent.futures import ThreadPoolExecutor
+
+    started_at = datetime.now()
+    conn = get_db_connection()
+    cursor = conn.cursor()
+    cursor.execute("SELECT COALESCE(MAX(to_movement_id), 0) AS watermark FROM ledger_verification_runs")
+    watermark = cursor.fetchone()["watermark"]
+    from_id = 0 if full else watermark
+    to_id, pending_transactions = _ledger_horizon(cursor, horizon_wait_seconds)
+    if to_id is None:
+        # Alguna transacción vieja puede tener ids sin confirmar: se revisa solo lo ya verificado
+        # antes (full) o nada, y la marca de agua no avanza.
+        to_id = watermark
+    to_id = max(to_id, watermark)
+    cursor.execute("""
+        SELECT DISTINCT loan_id FROM movements WHERE id > %s AND id <= %s ORDER BY loan_id
+    """, (from_id, to_id))
+    loan_ids = [row["loan_id"] for row in cursor.fetchall()]
+    cursor.close()
+    conn.close()
+
+    chunks = [loan_ids[i:i + chunk_size] for i in range(0, len(loan_ids), max(chunk_size, 1))]
+    discrepancies = []
+    if chunks:
+        tenant = get_tenant()
+        with ThreadPoolExecutor(max_workers=max(1, min(parallelism, tenant.pool_max, len(chunks)))) as executor:
+            for found in executor.map(lambda ids: _run_as_tenant(tenant.name, _verify_ledger_chunk, ids, from_id, to_id), chunks):
+                discrepancies.extend(found)
+
+    conn = get_db_connection()
+    cursor = conn.cursor()
+    cursor.execute("""
+        INSERT INTO ledger_verification_runs (
+            from_movement_id, to_movement_id, loans_checked, discrepancies, details, started_at
+        ) VALUES (%s, %s, %s, %s, %s::jsonb, %s)
+        RETURNING id
+    """, (from_id, to_id, len(loan_ids), len(discrepancies), json.dumps(discrepancies), started_at))
+    run_id = cursor.fetchone()["id"]
+    conn.commit()
+    cursor.close()
+    conn.close()
+
+    return {
+        "success": True,
+        "run_id": run_id,
+        "from_movement_id": from_id,
+        "to_movement_id": to_id,
+        "pending_transactions": pending_transactions,
+        "loans_checked": len(loan_ids),
+        "chunks": len(chunks),
+        "discrepancies": len(discrepancies),
+        "details": discrepancies,
+        "elapsed_ms": round((datetime.now() - started_at).total_seconds() * 1000, 1)
+    }
+
+@app.tool(cost="batch")
+def Verify_ledger(full: bool = False, chunk_size: int = 500, max_details: int = 100) -> Dict[str, Any]:
+    """
+    Verifica la integridad del ledger solo para préstamos con movimientos nuevos desde la última verificación:
+    - Cadena previous_balance/new_balance de movements (y coherencia con el tipo de movimiento)
+    - loans.current_balance igual al new_balance del último movimiento
+    - statements.interest_paid igual a la suma de pagos 'interest_payment' del periodo
+    Revisa los préstamos en bloques paralelos y guarda la corrida como nueva marca de agua.
+
+    full: True para ignorar la marca de agua y revisar todo el historial
+    """
+    try:
+        result = verify_ledger(full=full, chunk_size=chunk_size)
+        result["details"] = result["details"][:max_details]
+        return result
     except Exception as e:
-        return [{"error": f"Error en Get_all_pending_interest_statements: {str(e)}"}]
+        return {"error": f"Error en Verify_ledger: {str(e)}"}
+
+# ==================== TAREAS PROGRAMADAS ====================
+# Programador interno estilo cron para el corte mensual, la revisión de vencidos y los
+# cargos por mora. Cada worker/réplica corre su programador, pero cada tarea la ejecuta
+# solo quien obtiene su advisory lock en Postgres; además job_runs tiene una fila única por
+# (job_name, scheduled_for), así un mismo disparo no se repite en otra réplica.
+# Las tareas procesan los préstamos en lotes de loans_per_second con commit por lote y se
+# detienen (status 'interrupted') si se cierra su ventana; la siguiente corrida continúa,
+# porque cada tarea omite lo que ya está hecho.
+
+SCHEDULER_ENABLED = os.getenv("SCHEDULER_ENABLED", "false").lower() in ("1", "true", "yes")
+SCHEDULER_TICK_SECONDS = float(os.getenv("SCHEDULER_TICK_SECONDS", "30"))
+
+# cron: "minuto hora día_mes mes día_semana"; window: "HH:MM-HH:MM" (puede cruzar medianoche)
+# SCHEDULER_JOBS (JSON) sobreescribe estos valores por tarea, p. ej.
+# {"late_fees": {"enabled": true, "params": {"late_fee_amount": 150}}}
+_DEFAULT_JOBS = {
+    "monthly_cutoff": {
+        "enabled": True, "cron": "0 1 * * *", "window": "00:00-06:00", "loans_per_second": 200,
+        "params": {"due_days": 10, "reprice": False}
+    },
+    "overdue_check": {
+        "enabled": True, "cron": "0 6 * * *", "window": None, "loans_per_second": 0,
+        "params": {}
+    },
+    "late_fees": {
+        "enabled": False, "cron": "0 2 * * *", "window": "00:00-06:00", "loans_per_second": 100,
+        "params": {"late_fee_amount": 0, "grace_days": 0}
+    }
+}
+
+class _CronSchedule:
+    _RANGES = ((0, 59), (0, 23), (1, 31), (1, 12), (0, 7))
+
+    def __init__(self, expr: str):
+        fields = expr.split()
+        if len(fields) != 5:
+            raise ValueError(f"Expresión cron inválida '{expr}': se esperan 5 campos.")
+        parsed = [self._parse(field, lo, hi) for field, (lo, hi) in zip(fields, self._RANGES)]
+        self.minutes, self.hours, self.days, self.months, weekdays = parsed
+        self.weekdays = {0 if d == 7 else d for d in weekdays}
+        self.any_day = fields[2] == "*"
+        self.any_weekday = fields[4] == "*"
+
+    @staticmethod
+    def _parse(field: str, lo: int, hi: int) -> set:
+        values = set()
+        for part in field.split(","):
+            step = 1
+            if "/" in part:
+                part, step_text = part.split("/", 1)
+                step = int(step_text)
+            if part == "*":
+                start, end = lo, hi
+            elif "-" in part:
+                start, end = (int(v) for v in part.split("-", 1))
+            else:
+                start = int(part)
+                end = hi if step > 1 else start
+            if start < lo or end > hi or start > end or step < 1:
+                raise ValueError(f"Campo cron fuera de rango: '{field}'.")
+            values.update(range(start, end + 1, step))
+        return values
+
+    def _day_matches(self, dt: datetime) -> bool:
+        dom = dt.day in self.days
+        dow = dt.isoweekday() % 7 in self.weekdays
+        # Como en cron: si día del mes y día de la semana están restringidos, basta con uno
+        if self.any_day or self.any_weekday:
+            return dom and dow
+        return dom or dow
+
+    def next_after(self, dt: datetime) -> datetime:
+        dt = dt.replace(second=0, microsecond=0) + timedelta(minutes=1)
+        for _ in range(366 * 5):
+            if dt.month in self.months and self._day_matches(dt):
+                for hour in sorted(h for h in self.hours if h >= dt.hour):
+                    minutes = sorted(m for m in self.minutes if hour > dt.hour or m >= dt.minute)
+                    if minutes:
+                        return dt.replace(hour=hour, minute=minutes[0])
+            dt = (dt + timedelta(days=1)).replace(hour=0, minute=0)
+        raise ValueError("La expresión cron no tiene ejecuciones en los próximos 5 años.")
+
+def _in_window(window: Optional[str], now: datetime) -> bool:
+    if not window:
+        return True
+    start_text, end_text = window.split("-", 1)
+    start, end = ((int(t.split(":")[0]) * 60 + int(t.split(":")[1])) for t in (start_text, end_text))
+    minute = now.hour * 60 + now.minute
+    if start <= end:
+        return start <= minute < end
+    return minute >= start or minute < end
+
+def load_job_config() -> Dict[str, Dict[str, Any]]:
+    overrides = json.loads(os.getenv("SCHEDULER_JOBS") or "{}")
+    unknown = set(overrides) - set(_DEFAULT_JOBS)
+    if unknown:
+        raise ValueError(f"Tareas desconocidas en SCHEDULER_JOBS: {', '.join(sorted(unknown))}.")
+    jobs = {}
+    for name, defaults in _DEFAULT_JOBS.items():
+        override = overrides.get(name, {})
+        config = dict(defaults, **override)
+        config["params"] = dict(defaults["params"], **override.get("params", {}))
+        config["schedule"] = _CronSchedule(config["cron"])
+        if config["window"]:
+            _in_window(config["window"], datetime.now())
+        jobs[name] = config
+    return jobs
+
+class _JobRun:
+    """Estado de una corrida: parámetros, ventana y entrega de lotes con límite de préstamos por segundo."""
+
+    def __init__(self, name: str, config: Dict[str, Any], stop_event: Optional[threading.Event], respect_window: bool):
+        self.name = name
+        self.params = config["params"]
+        self.window = config["window"] if respect_window else None
+        self.loans_per_second = float(config.get("loans_per_second") or 0)
+        self.stop_event = stop_event
+        self.interrupted = False
+        # Tiempo procesando lotes, sin las pausas de loans_per_second (ver SIMULACIÓN)
+        self.work_seconds = 0.0
+
+    def should_stop(self) -> bool:
+        return bool(self.stop_event and self.stop_event.is_set()) or not _in_window(self.window, datetime.now())
+
+    def batches(self, items: List[Any]):
+        size = max(1, int(self.loans_per_second)) if self.loans_per_second > 0 else 500
+        for start in range(0, len(items), size):
+            if self.should_stop():
+                self.interrupted = True
+                return
+            started = time.monotonic()
+            batch = items[start:start + size]
+            yield batch
+            self.work_seconds += time.monotonic() - started
+            if self.loans_per_second > 0:
+                # Cada lote debe durar al menos len(batch)/loans_per_second segundos
+                remaining = len(batch) / self.loans_per_second - (time.monotonic() - started)
+                if remaining > 0 and start + size < len(items):
+                    time.sleep(remaining)
+
+def _job_monthly_cutoff(run: _JobRun) -> Dict[str, Any]:
+    # Corte del periodo en curso solo para préstamos cuya fecha de corte ya llegó
+    today = datetime.now().date()
+    period = run.params.get("period") or today.strftime("%Y-%m")
+    cutoff_month = datetime.strptime(period, "%Y-%m")
+    conn = get_db_connection()
+    cursor = conn.cursor()
+    cursor.execute("""
+        SELECT l.id, l.start_date
+        FROM loans l
+        WHERE l.status = 'active'
+          AND NOT EXISTS (SELECT 1 FROM statements s WHERE s.loan_id = l.id AND s.period = %s)
+        ORDER BY l.id
+    """, (period,))
+    loan_ids = [
+        row["id"] for row in cursor.fetchall()
+        if row["start_date"].strftime("%Y-%m") != period
+        and _period_cutoff_date(cutoff_month, row["start_date"]) <= today
+    ]
+    cursor.close()
+    conn.close()
+
+    results = {"period": period, "due": len(loan_ids), "generated": 0, "skipped": 0, "errors": 0, "details": [], "repriced": 0}
+    for batch in run.batches(loan_ids):
+        conn = get_db_connection()
+        cursor = conn.cursor()
+        cursor.execute("""
+            SELECT id, client_id, original_amount, current_balance, interest_rate, start_date, status, folio, loan_type
+            FROM loans
+            WHERE id = ANY(%s) AND status = 'active'
+            ORDER BY id
+            FOR UPDATE
+        """, (batch,))
+        rate_index = get_rate_index(cursor) if run.params.get("reprice") else None
+        results["repriced"] += _generate_period_cutoffs(
+            cursor, period, cursor.fetchall(), int(run.params.get("due_days", 10)), results, rate_index
+        )
+        conn.commit()
+        cursor.close()
+        conn.close()
+        # El detalle por préstamo no se guarda en job_runs
+        results["details"] = []
+    del results["details"]
+    results["processed"] = results["generated"] + results["skipped"]
+    results["work_seconds"] = round(run.work_seconds, 3)
+    return results
+
+def _job_overdue_check(run: _JobRun) -> Dict[str, Any]:
+    # Solo lectura: deja en el historial el tamaño de la cartera vencida del día
+    check_dt = datetime.now().date()
+    conn = get_db_connection()
+    cursor = conn.cursor()
+    cursor.execute(f"""
+        SELECT COUNT(*) AS statements,
+               COUNT(DISTINCT s.loan_id) AS loans,
+               COALESCE(SUM(s.interest_generated - s.interest_paid), 0) AS pending_interest,
+               MIN(s.due_date) AS oldest_due_date
+        FROM statements s
+        WHERE {_OVERDUE_FILTER}
+    """, {"as_of": check_dt})
+    row = cursor.fetchone()
+    cursor.close()
+    conn.close()
+    return {
+        "check_date": check_dt.strftime('%Y-%m-%d'),
+        "processed": row["statements"],
+        "overdue_statements": row["statements"],
+        "overdue_loans": row["loans"],
+        "pending_interest": float(row["pending_interest"]),
+        "oldest_due_date": row["oldest_due_date"].strftime('%Y-%m-%d') if row["oldest_due_date"] else None
+    }
+
+def _job_late_fees(run: _JobRun) -> Dict[str, Any]:
+    # Un cargo por statement vencido (más allá de grace_days) que aún no tiene mora
+    late_fee_amount = float(run.params.get("late_fee_amount") or 0)
+    if late_fee_amount <= 0:
+        raise ValueError("late_fees requiere params.late_fee_amount > 0.")
+    charge_dt = datetime.now().date()
+    limit_dt = charge_dt - timedelta(days=int(run.params.get("grace_days", 0)))
+    conn = get_db_connection()
+    cursor = conn.cursor()
+    cursor.execute("""
+        SELECT id FROM statements
+        WHERE status IN ('pending', 'partial') AND late_fee_generated = 0 AND due_date < %s
+        ORDER BY due_date, id
+    """, (limit_dt,))
+    statement_ids = [row["id"] for row in cursor.fetchall()]
+    cursor.close()
+    conn.close()
+
+    results = {"due": len(statement_ids), "charged": 0, "skipped": 0, "late_fee_total": 0.0}
+    for batch in run.batches(statement_ids):
+        conn = get_db_connection()
+        cursor = conn.cursor()
+        # Préstamos primero (FOR SHARE, en orden de id) y luego cada statement; el UPDATE vuelve
+        # a filtrar porque un Generate_late_fee manual o un pago pudo llegar entre tanto
+        cursor.execute("""
+            SELECT s.loan_id, s.period, l.current_balance
+            FROM statements s
+            JOIN loans l ON l.id = s.loan_id
+            WHERE s.id = ANY(%s)
+            ORDER BY s.loan_id, s.id
+            FOR SHARE OF l
+        """, (batch,))
+        charged = 0
+        for stmt in cursor.fetchall():
+            mov, _ = _apply_late_fee(cursor, stmt["loan_id"], stmt["current_balance"], stmt["period"],
+                                     late_fee_amount, charge_dt, unbilled_only=True)
+            charged += 1 if mov else 0
+        conn.commit()
+        cursor.close()
+        conn.close()
+        results["charged"] += charged
+        results["skipped"] += len(batch) - charged
+    results["late_fee_total"] = round(results["charged"] * late_fee_amount, 2)
+    results["processed"] = results["charged"] + results["skipped"]
+    results["work_seconds"] = round(run.work_seconds, 3)
+    return results
+
+_JOB_HANDLERS = {
+    "monthly_cutoff": _job_monthly_cutoff,
+    "overdue_check": _job_overdue_check,
+    "late_fees": _job_late_fees
+}
+
+def run_job(name: str, scheduled_for: Optional[datetime] = None, stop_event: Optional[threading.Event] = None,
+            respect_window: bool = True) -> Dict[str, Any]:
+    """
+    Ejecuta una tarea si esta réplica obtiene su advisory lock y el disparo no se registró antes.
+    Registra la corrida en job_runs (running -> succeeded | interrupted | failed).
+    """
+    config = load_job_config().get(name)
+    if config is None:
+        raise ValueError(f"Tarea desconocida: {name}.")
+    scheduled_for = scheduled_for or datetime.now()
+    tenant = get_tenant()
+    lock_key = tenant.lock_key(f"loans.job.{name}")
+    # El lock (y el registro en job_runs) va en una conexión fuera del pool: la tarea pide
+    # conexiones del pool por lote y, con un pool chico o tráfico de herramientas, esperaría
+    # por la conexión que retiene su propio lock.
+    lock_conn = tenant.connect()
+    cursor = lock_conn.cursor()
+    cursor.execute("SELECT pg_try_advisory_lock(hashtext(%s)) AS locked", (lock_key,))
+    locked = cursor.fetchone()["locked"]
+    lock_conn.commit()
+    if not locked:
+        cursor.close()
+        lock_conn.close()
+        return {"job_name": name, "status": "skipped", "reason": "running_elsewhere"}
+    try:
+        # Con el lock tomado, una corrida 'running' es de una réplica que murió a mitad
+        cursor.execute("""
+            UPDATE job_runs SET status = 'abandoned', finished_at = CURRENT_TIMESTAMP
+            WHERE job_name = %s AND status = 'running'
+        """, (name,))
+        cursor.execute("""
+            INSERT INTO job_runs (job_name, scheduled_for, host)
+            VALUES (%s, %s, %s)
+            ON CONFLICT (job_name, scheduled_for) DO NOTHING
+            RETURNING id
+        """, (name, scheduled_for, f"{os.uname().nodename}:{os.getpid()}"))
+        row = cursor.fetchone()
+        lock_conn.commit()
+        if not row:
+            return {"job_name": name, "status": "skipped", "reason": "already_ran"}
+
+        run = _JobRun(name, config, stop_event, respect_window)
+        status, summary, error = "succeeded", None, None
+        try:
+            summary = _JOB_HANDLERS[name](run)
+            if run.interrupted:
+                status = "interrupted"
+        except Exception as e:
+            logger.exception("La tarea %s falló", name)
+            status, error = "failed", str(e)
+        cursor.execute("""
+            UPDATE job_runs
+            SET status = %s, finished_at = CURRENT_TIMESTAMP, processed = %s, summary = %s::jsonb, error = %s
+            WHERE id = %s
+        """, (status, (summary or {}).get("processed", 0), json.dumps(summary), error, row["id"]))
+        lock_conn.commit()
+        return {"job_name": name, "run_id": row["id"], "status": status, "summary": summary, "error": error}
+    finally:
+        if not lock_conn.closed:
+            lock_conn.rollback()
+            cursor.execute("SELECT pg_advisory_unlock(hashtext(%s))", (lock_key,))
+            lock_conn.commit()
+        cursor.close()
+        lock_conn.close()
+
+def _record_manual_run(cursor, name: str, tool_name: str, started_at: datetime, summary: Dict[str, Any]) -> None:
+    """
+    Registra en job_runs (ya terminada) una corrida de la tarea lanzada desde una herramienta,
+    así los dry_run también estiman con ella. No hace commit.
+    """
+    cursor.execute("""
+        INSERT INTO job_runs (job_name, scheduled_for, started_at, finished_at, status, processed, summary, host)
+        VALUES (%s, %s, %s, CURRENT_TIMESTAMP, 'succeeded', %s, %s::jsonb, %s)
+        ON CONFLICT (job_name, scheduled_for) DO NOTHING
+    """, (name, started_at, started_at, summary.get("processed", 0), json.dumps(dict(summary, tool=tool_name)),
+          f"{os.uname().nodename}:{os.getpid()}"))
+
+class _Scheduler:
+    def __init__(self, jobs: Dict[str, Dict[str, Any]]):
+        self.jobs = {name: config for name, config in jobs.items() if config["enabled"]}
+        self.stop = threading.Event()
+        now = datetime.now()
+        self.next_run = {name: config["schedule"].next_after(now) for name, config in self.jobs.items()}
+        # Disparos vencidos que esperan a que abra su ventana (se conserva solo el más reciente)
+        self.pending: Dict[str, datetime] = {}
+
+    def tick(self, now: datetime):
+        for name, config in self.jobs.items():
+            if now >= self.next_run[name]:
+                self.pending[name] = self.next_run[name]
+                self.next_run[name] = config["schedule"].next_after(now)
+            if name in self.pending and _in_window(config["window"], now):
+                result = run_job(name, self.pending.pop(name), self.stop)
+                logger.info("Tarea programada %s: %s", name, {k: v for k, v in result.items() if k != "summary"})
+
+    def run(self):
+        logger.info("Programador de tareas activo: %s", {n: d.strftime("%Y-%m-%d %H:%M") for n, d in self.next_run.items()})
+        while not self.stop.wait(SCHEDULER_TICK_SECONDS):
+            try:
+                self.tick(datetime.now())
+            except Exception as e:
+                logger.warning("Error en el programador de tareas: %s", e)
+
+def start_scheduler() -> List[_Scheduler]:
+    # Un programador (hilo) por tenant: el corte de mes de uno no retrasa las tareas de otro
+    schedulers = []
+    for tenant in _TENANTS.values():
+        scheduler = _Scheduler(load_job_config())
+        _start_tenant_thread(tenant, scheduler.run, "scheduler")
+        schedulers.append(scheduler)
+    return schedulers
+
+@app.tool
+def Get_scheduled_jobs(limit: int = 10) -> Dict[str, Any]:
+    """
+    Muestra la configuración del programador de tareas (cron, ventana, préstamos por segundo,
+    próxima ejecución) y las últimas corridas registradas en job_runs.
+    """
+    try:
+        jobs = load_job_config()
+        now = datetime.now()
+        conn = get_db_connection()
+        cursor = conn.cursor()
+        cursor.execute("""
+            SELECT id, job_name, scheduled_for, started_at, finished_at, status, processed, summary, error, host
+            FROM job_runs
+            ORDER BY id DESC
+            LIMIT %s
+        """, (limit,))
+        rows = cursor.fetchall()
+        cursor.close()
+        conn.close()
+
+        return {
+            "scheduler_enabled": SCHEDULER_ENABLED,
+            "jobs": [{
+                "job_name": name,
+                "enabled": config["enabled"],
+                "cron": config["cron"],
+                "window": config["window"],
+                "loans_per_second": config["loans_per_second"],
+                "params": config["params"],
+                "next_run": config["schedule"].next_after(now).strftime('%Y-%m-%d %H:%M') if config["enabled"] else None
+            } for name, config in jobs.items()],
+            "runs": [{
+                "id": row["id"],
+                "job_name": row["job_name"],
+                "scheduled_for": row["scheduled_for"].strftime('%Y-%m-%d %H:%M:%S'),
+                "started_at": row["started_at"].strftime('%Y-%m-%d %H:%M:%S'),
+                "finished_at": row["finished_at"].strftime('%Y-%m-%d %H:%M:%S') if row["finished_at"] else None,
+                "status": row["status"],
+                "processed": row["processed"],
+                "summary": row["summary"],
+                "error": row["error"],
+                "host": row["host"]
+            } for row in rows]
+        }
+    except Exception as e:
+        return {"error": f"Error en Get_scheduled_jobs: {str(e)}"}
+
+# ==================== SIMULACIÓN ====================
+# dry_run de los procesos de fin de mes: el mismo cálculo que la corrida real sobre un
+# snapshot REPEATABLE READ de solo lectura, con una consulta por proceso y sin locks.
+# La duración de la corrida real se estima con el tiempo de trabajo por préstamo de las
+# últimas corridas de la tarea en job_runs (work_seconds, sin las pausas de
+# loans_per_second), programadas o lanzadas desde Generate_monthly_cutoff_for_period y
+# Generate_late_fees_for_overdue. Los dry_run de un préstamo reportan la misma estimación
+# por préstamo. Sin historial se usa la latencia de una consulta de muestra por los
+# viajes a la base que hace la corrida real por elemento (cota inferior).
+
+_ESTIMATE_HISTORY_RUNS = 5
+_ESTIMATE_SAMPLES = 20
+
+def _estimate_runtime(cursor, job_name: str, items: int, count_key: str, round_trips: int,
+                      probe_sql: str, probe_params: List[tuple]) -> Dict[str, Any]:
+    cursor.execute("""
+        SELECT COALESCE(SUM((summary->>'work_seconds')::float), 0) AS seconds,
+               COALESCE(SUM((summary->>%(key)s)::int), 0) AS items
+        FROM (
+            SELECT summary FROM job_runs
+            WHERE job_name = %(job)s AND status = 'succeeded'
+              AND summary ? 'work_seconds' AND (summary->>%(key)s)::int > 0
+            ORDER BY started_at DESC
+            LIMIT %(runs)s
+        ) r
+    """, {"key": count_key, "job": job_name, "runs": _ESTIMATE_HISTORY_RUNS})
+    history = cursor.fetchone()
+    if history["items"]:
+        per_item, basis = history["seconds"] / history["items"], "job_runs"
+    else:
+        timings = []
+        for params in probe_params[:_ESTIMATE_SAMPLES]:
+            started = time.perf_counter()
+            cursor.execute(probe_sql, params)
+            cursor.fetchall()
+            timings.append(time.perf_counter() - started)
+        per_item = round_trips * sorted(timings)[len(timings) // 2] if timings else 0.0
+        basis = "round_trips"
+    seconds = items * per_item
+    loans_per_second = float(load_job_config()[job_name].get("loans_per_second") or 0)
+    return {
+        "basis": basis,
+        "per_item_ms": round(per_item * 1000, 3),
+        "seconds": round(seconds, 1),
+        # La tarea programada además respeta loans_per_second
+        "scheduled_job_seconds": round(max(seconds, items / loans_per_second if loans_per_second > 0 else 0), 1)
+    }
+
+@contextlib.contextmanager
+def _snapshot_cursor():
+    conn = get_db_connection()
+    try:
+        conn.set_session(isolation_level="REPEATABLE READ", readonly=True)
+        cursor = conn.cursor()
+        yield cursor
+        cursor.close()
+    finally:
+        conn.rollback()
+        conn.set_session(isolation_level="DEFAULT", readonly="DEFAULT")
+        conn.close()
+
+def simulate_period_cutoff(period: str, due_days: int = 10, reprice: bool = False, due_by=None) -> Dict[str, Any]:
+    """
+    Simula Generate_monthly_cutoff_for_period sin escribir nada. Con due_by simula la tarea
+    monthly_cutoff: solo préstamos cuya fecha de corte ya llegó a esa fecha.
+    """
+    started = time.perf_counter()
+    cutoff_month = datetime.strptime(period, "%Y-%m")
+    with _snapshot_cursor() as cursor:
+        cursor.execute("""
+            SELECT l.id, l.original_amount, l.current_balance, l.interest_rate, l.start_date, l.loan_type,
+                   EXISTS (SELECT 1 FROM statements s WHERE s.loan_id = l.id AND s.period = %s) AS already_exists
+            FROM loans l
+            WHERE l.status = 'active'
+        """, (period,))
+        loans = cursor.fetchall()
+        rate_index = get_rate_index(cursor) if reprice else None
+
+        results = {
+            "success": True,
+            "dry_run": True,
+            "period": period,
+            "total_loans": len(loans),
+            "generated": 0,
+            "skipped": 0,
+            "skipped_same_month_as_start": 0,
+            "skipped_already_exists": 0,
+            "interest_generated": 0.0,
+            "principal_balance": 0.0
+        }
+        if due_by is not None:
+            results["not_due_yet"] = 0
+        if reprice:
+            results["repriced"] = 0
+        cutoff_dates = []
+        sample = []
+        for loan in loans:
+            if loan["start_date"].strftime("%Y-%m") == period:
+                results["skipped"] += 1
+                results["skipped_same_month_as_start"] += 1
+                continue
+            if loan["already_exists"]:
+                results["skipped"] += 1
+                results["skipped_already_exists"] += 1
+                continue
+            cutoff_dt = _period_cutoff_date(cutoff_month, loan["start_date"])
+            if due_by is not None and cutoff_dt > due_by:
+                results["not_due_yet"] += 1
+                continue
+            interest_generated, new_rate = _period_interest(loan, cutoff_dt, rate_index)
+            if new_rate is not None:
+                results["repriced"] += 1
+            results["generated"] += 1
+            results["interest_generated"] += interest_generated
+            results["principal_balance"] += float(loan["current_balance"])
+            cutoff_dates.append(cutoff_dt)
+            if len(sample) < _ESTIMATE_SAMPLES:
+                sample.append((loan["id"], period))
+
+        results["interest_generated"] = round(results["interest_generated"], 2)
+        results["principal_balance"] = round(results["principal_balance"], 2)
+        results["cut_off_dates"] = {
+            "from": min(cutoff_dates).strftime('%Y-%m-%d'),
+            "to": max(cutoff_dates).strftime('%Y-%m-%d')
+        } if cutoff_dates else None
+        # Corrida real por préstamo: ¿existe el statement?, INSERT movement e INSERT statement
+        results["estimate"] = _estimate_runtime(
+            cursor, "monthly_cutoff", results["generated"], "generated", 3,
+            "SELECT id FROM statements WHERE loan_id = %s AND period = %s", sample
+        )
+    results["dry_run_seconds"] = round(time.perf_counter() - started, 3)
+    return results
+
+def simulate_late_fees(late_fee_amount: float, grace_days: int = 0, charge_dt=None) -> Dict[str, Any]:
+    """
+    Simula la tarea late_fees / Generate_late_fees_for_overdue (una mora por statement vencido
+    sin mora) sin escribir nada.
+    """
+    if late_fee_amount <= 0:
+        raise ValueError("late_fees requiere params.late_fee_amount > 0.")
+    started = time.perf_counter()
+    charge_dt = charge_dt or datetime.now().date()
+    limit_dt = charge_dt - timedelta(days=grace_days)
+    with _snapshot_cursor() as cursor:
+        cursor.execute("""
+            SELECT COUNT(*) AS statements, COUNT(DISTINCT loan_id) AS loans,
+                   MIN(due_date) AS oldest_due_date,
+                   (array_agg(id ORDER BY due_date, id))[1:%s] AS sample
+            FROM statements
+            WHERE status IN ('pending', 'partial') AND late_fee_generated = 0 AND due_date < %s
+        """, (_ESTIMATE_SAMPLES, limit_dt))
+        row = cursor.fetchone()
+        results = {
+            "success": True,
+            "dry_run": True,
+            "charge_date": charge_dt.strftime('%Y-%m-%d'),
+            "charged": row["statements"],
+            "loans": row["loans"],
+            "late_fee_total": round(row["statements"] * late_fee_amount, 2),
+            "oldest_due_date": row["oldest_due_date"].strftime('%Y-%m-%d') if row["oldest_due_date"] else None,
+            # Corrida real por statement: UPDATE del statement e INSERT del movement
+            "estimate": _estimate_runtime(
+                cursor, "late_fees", row["statements"], "charged", 2,
+                "SELECT id FROM statements WHERE id = %s", [(i,) for i in row["sample"] or []]
+            )
+        }
+    results["dry_run_seconds"] = round(time.perf_counter() - started, 3)
+    return results
+
+def simulate_job(name: str) -> Dict[str, Any]:
+    """Simula una tarea programada con su configuración actual, sin escribir ni registrar en job_runs."""
+    config = load_job_config().get(name)
+    if config is None:
+        raise ValueError(f"Tarea desconocida: {name}.")
+    params = config["params"]
+    today = datetime.now().date()
+    if name == "monthly_cutoff":
+        return simulate_period_cutoff(params.get("period") or today.strftime("%Y-%m"), int(params.get("due_days", 10)),
+                                      bool(params.get("reprice")), due_by=today)
+    if name == "late_fees":
+        return simulate_late_fees(float(params.get("late_fee_amount") or 0), int(params.get("grace_days", 0)), today)
+    # overdue_check ya es de solo lectura
+    return _JOB_HANDLERS[name](_JobRun(name, config, None, respect_window=False))
+
+# ==================== EXPORTACIÓN ====================
+# Extractos para finanzas sin pasar por las herramientas JSON: cada partición (tabla x mes)
+# se copia con COPY ... TO STDOUT directo a un archivo comprimido, en bloques, con memoria
+# constante. Todas las particiones leen del mismo snapshot (pg_export_snapshot) aunque se
+# exporten en paralelo por conexiones distintas.
+
+EXPORT_DIR = os.getenv("EXPORT_DIR", "exports")
+EXPORT_TABLES = ("loans", "statements", "movements")
+
+def _with_archive(columns: str, table: str, where: str) -> str:
+    # Los periodos históricos incluyen los préstamos ya archivados (ver ARCHIVO DE PRÉSTAMOS CERRADOS)
+    return f"""
+        SELECT {columns} FROM {table} WHERE {where}
+        UNION ALL
+        SELECT {columns} FROM {table}_archive WHERE {where}
+    """
+
+_EXPORT_QUERIES = {
+    # Foto de la cartera al cierre del rango
+    "loans": _with_archive(
+        """id, client_id, folio, loan_type, original_amount, current_balance, interest_rate,
+               granting_date, start_date, created_date, status""",
+        "loans", "granting_date < %(end)s"
+    ),
+    "statements": _with_archive(
+        """id, loan_id, period, initial_balance, final_balance, interest_generated, interest_paid,
+               principal_paid, late_fee_generated, cut_off_date, due_date, status, created_at""",
+        "statements", "period = %(period)s"
+    ),
+    "movements": _with_archive(
+        """id, loan_id, movement_type, amount, previous_balance, new_balance, movement_date,
+               application_period, reference, note, created_at""",
+        "movements", "movement_date >= %(start)s AND movement_date < %(end)s"
+    )
+}
+
+def _arrow_schema(description):
+    import pyarrow as pa
+    types = {16: pa.bool_(), 20: pa.int64(), 21: pa.int16(), 23: pa.int32(), 700: pa.float32(),
+             701: pa.float64(), 1082: pa.date32(), 1114: pa.timestamp("us")}
+    fields = []
+    for column in description:
+        if column.type_code == 1700:
+            arrow_type = pa.decimal128(column.precision, column.scale) if column.precision else pa.float64()
+        else:
+            arrow_type = types.get(column.type_code, pa.string())
+        fields.append(pa.field(column.name, arrow_type))
+    return pa.schema(fields)
+
+def _csv_to_parquet(csv_path: str, parquet_path: str, schema) -> None:
+    # Lectura por bloques del CSV comprimido: cada bloque es un row group
+    import pyarrow as pa
+    from pyarrow import csv as pa_csv
+    from pyarrow import parquet as pq
+    reader = pa_csv.open_csv(
+        pa.input_stream(csv_path, compression="gzip"),
+        read_options=pa_csv.ReadOptions(block_size=4 << 20),
+        convert_options=pa_csv.ConvertOptions(
+            column_types=schema,
+            strings_can_be_null=True,
+            quoted_strings_can_be_null=False
+        )
+    )
+    with pq.ParquetWriter(parquet_path, schema, compression="zstd") as writer:
+        for batch in reader:
+            writer.write_table(pa.Table.from_batches([batch], schema=schema))
+
+def _write_partition(cursor, table: str, params: Dict[str, Any], path: str, file_format: str) -> Dict[str, Any]:
+    """Escribe una partición con un cursor que ya está en el snapshot de la exportación."""
+    query = cursor.mogrify(_EXPORT_QUERIES[table], params).decode()
+    schema = None
+    if file_format == "parquet":
+        cursor.execute(f"SELECT * FROM ({query}) q LIMIT 0")
+        schema = _arrow_schema(cursor.description)
+
+    import gzip
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    csv_path = path if file_format == "csv" else path + ".csv.gz"
+    with gzip.open(csv_path + ".tmp", "wb", compresslevel=6 if file_format == "csv" else 1) as out:
+        cursor.copy_expert(f"COPY ({query}) TO STDOUT WITH (FORMAT csv, HEADER true)", out, size=1 << 20)
+    rows = cursor.rowcount
+
+    os.replace(csv_path + ".tmp", csv_path)
+    if file_format == "parquet":
+        _csv_to_parquet(csv_path, path + ".tmp", schema)
+        os.replace(path + ".tmp", path)
+        os.remove(csv_path)
+    return {"table": table, "partition": params.get("period"), "path": path, "rows": rows, "bytes": os.path.getsize(path)}
+
+def _export_partition(snapshot: str, table: str, params: Dict[str, Any], path: str, file_format: str) -> Dict[str, Any]:
+    conn = get_db_connection()
+    try:
+        conn.set_session(isolation_level="REPEATABLE READ", readonly=True)
+        cursor = conn.cursor()
+        cursor.execute("SET TRANSACTION SNAPSHOT %s", (snapshot,))
+        result = _write_partition(cursor, table, params, path, file_format)
+        cursor.close()
+        conn.rollback()
+        return result
+    finally:
+        conn.set_session(isolation_level="DEFAULT", readonly="DEFAULT")
+        conn.close()
+
+def export_period(from_period: str, to_period: Optional[str] = None, tables: Optional[List[str]] = None,
+                  file_format: str = "csv", output_dir: Optional[str] = None, parallelism: int = 4) -> Dict[str, Any]:
+    """
+    Exporta loans, statements y movements del rango de periodos (YYYY-MM, inclusivo) a
+    {output_dir}/{tabla}/period=YYYY-MM/{tabla}.csv.gz (o .parquet). loans va en un solo
+    archivo con la cartera otorgada hasta el fin del rango. Escribe manifest.json.
+    """
+    from concurrent.futures import ThreadPoolExecutor
+
+    if file_format not in ("csv", "parquet"):
+        raise ValueError("El formato debe ser 'csv' o 'parquet'.")
+    if file_format == "parquet":
+        try:
+            import pyarrow  # noqa: F401
+        except ImportError:
+            raise ValueError("El formato parquet requiere pyarrow (instalar el extra 'parquet').")
+    tables = list(tables or EXPORT_TABLES)
+    unknown = set(tables) - set(EXPORT_TABLES)
+    if unknown:
+        raise ValueError(f"Tablas no exportables: {', '.join(sorted(unknown))}.")
+    start = datetime.strptime(from_period, "%Y-%m")
+    end = datetime.strptime(to_period or from_period, "%Y-%m")
+    if end < start:
+        raise ValueError("to_period debe ser mayor o igual a from_period.")
+
+    months = []
+    month = start
+    while month <= end:
+        following = (month.replace(day=28) + timedelta(days=4)).replace(day=1)
+        months.append((month.strftime("%Y-%m"), month.date(), following.date()))
+        month = following
+    range_end = months[-1][2]
+
+    started = time.perf_counter()
+    tenant_dir = "" if get_tenant().name == "default" else get_tenant().name
+    output_dir = output_dir or os.path.join(EXPORT_DIR, tenant_dir, f"{from_period}_{to_period or from_period}_{datetime.now().strftime('%Y%m%d%H%M%S')}")
+    extension = "csv.gz" if file_format == "csv" else "parquet"
+    jobs = []
+    for table in tables:
+        if table == "loans":
+            jobs.append((table, {"end": range_end}, os.path.join(output_dir, table, f"{table}.{extension}")))
+            continue
+        for period, month_start, month_end in months:
+            params = {"period": period, "start": month_start, "end": month_end}
+            jobs.append((table, params, os.path.join(output_dir, table, f"period={period}", f"{table}.{extension}")))
+
+    # La transacción que exporta el snapshot debe seguir abierta hasta el final
+    snapshot_conn = get_db_connection()
+    try:
+        snapshot_conn.set_session(isolation_level="REPEATABLE READ", readonly=True)
+        cursor = snapshot_conn.cursor()
+        cursor.execute("SELECT pg_export_snapshot() AS snapshot")
+        snapshot = cursor.fetchone()["snapshot"]
+        tenant = get_tenant()
+        # Cada hilo usa su propia conexión además de la del snapshot; con un solo hilo (o un
+        # pool de una conexión, donde esperaría para siempre) se exporta en la del snapshot.
+        workers = min(parallelism, tenant.pool_max - 1, len(jobs))
+        if workers <= 1:
+            files = [_write_partition(cursor, *job, file_format) for job in jobs]
+        else:
+            with ThreadPoolExecutor(max_workers=workers) as executor:
+                files = list(executor.map(lambda job: _run_as_tenant(tenant.name, _export_partition, snapshot, *job, file_format), jobs))
+        cursor.close()
+        snapshot_conn.rollback()
+    finally:
+        snapshot_conn.set_session(isolation_level="DEFAULT", readonly="DEFAULT")
+        snapshot_conn.close()
+
+    manifest = {
+        "from_period": from_period,
+        "to_period": to_period or from_period,
+        "format": file_format,
+        "output_dir": os.path.abspath(output_dir),
+        "files": files,
+        "rows": {table: sum(f["rows"] for f in files if f["table"] == table) for table in tables},
+        "bytes": sum(f["bytes"] for f in files),
+        "elapsed_ms": round((time.perf_counter() - started) * 1000, 1)
+    }
+    with open(os.path.join(output_dir, "manifest.json"), "w", encoding="utf-8") as f:
+        json.dump(manifest, f, indent=2, ensure_ascii=False, default=str)
+    return manifest
+
+@app.tool(cost="batch")
+def Export_period(from_period: str, to_period: Optional[str] = None, format: str = "csv",
+                  tables: Optional[List[str]] = None) -> Dict[str, Any]:
+    """
+    Exporta statements, movements y loans de un rango de periodos (YYYY-MM) a archivos en disco
+    del servidor (EXPORT_DIR), particionados por mes: CSV comprimido (gzip) o Parquet.
+    Retorna el manifiesto con rutas, filas y bytes por archivo (no los datos).
+
+    format: 'csv' o 'parquet'
+    tables: subconjunto de ['loans', 'statements', 'movements'] (por defecto todas)
+    """
+    try:
+        return dict(export_period(from_period, to_period, tables, format), success=True)
+    except Exception as e:
+        return {"error": f"Error en Export_period: {str(e)}"}
+
+# ==================== OUTBOX DE EVENTOS ====================
+# Los triggers de init.sql escriben en outbox_events dentro de la misma transacción de
+# cada mutación. El dispatcher entrega lotes a cada sink configurado (OUTBOX_SINKS) y
+# guarda la posición (txid, id) por sink en outbox_consumers. La fila del consumidor se
+# bloquea con FOR UPDATE SKIP LOCKED, así solo un worker/réplica entrega cada lote.
+# Entrega al menos una vez: si un sink falla, el lote se reintenta (los eventos traen id).
+
+OUTBOX_SINKS = [name.strip() for name in os.getenv("OUTBOX_SINKS", "").split(",") if name.strip()]
+OUTBOX_BATCH_SIZE = int(os.getenv("OUTBOX_BATCH_SIZE", "500"))
+OUTBOX_POLL_SECONDS = float(os.getenv("OUTBOX_POLL_SECONDS", "1"))
+OUTBOX_FILE_PATH = os.getenv("OUTBOX_FILE_PATH", os.path.join("outbox", "events.jsonl"))
+OUTBOX_WEBHOOK_URL = os.getenv("OUTBOX_WEBHOOK_URL")
+OUTBOX_NOTIFY_CHANNEL = os.getenv("OUTBOX_NOTIFY_CHANNEL", "loan_events")
+OUTBOX_RETENTION_DAYS = int(os.getenv("OUTBOX_RETENTION_DAYS", "7"))
+
+class _FileSink:
+    """Agrega los eventos como JSON lines a un archivo local (fsync por lote)."""
+    name = "file"
+
+    def __init__(self, path: str):
+        self.path = path
+
+    def deliver(self, cursor, events: List[Dict[str, Any]]) -> None:
+        os.makedirs(os.path.dirname(self.path) or ".", exist_ok=True)
+        with open(self.path, "a", encoding="utf-8") as f:
+            for event in events:
+                f.write(json.dumps(event, ensure_ascii=False, default=str) + "\n")
+            f.flush()
+            os.fsync(f.fileno())
+
+class _WebhookSink:
+    """POST del lote como {"events": [...]} a OUTBOX_WEBHOOK_URL; cualquier respuesta no 2xx reintenta."""
+    name = "webhook"
+
+    def __init__(self, url: str, tenant: Optional[str] = None):
+        self.url = url
+        self.headers = {"Content-Type": "application/json"}
+        if tenant:
+            self.headers["X-Tenant"] = tenant
+
+    def deliver(self, cursor, events: List[Dict[str, Any]]) -> None:
+        import urllib.request
+        body = json.dumps({"events": events}, ensure_ascii=False, default=str).encode("utf-8")
+        request = urllib.request.Request(self.url, data=body, method="POST", headers=self.headers)
+        with urllib.request.urlopen(request, timeout=10) as response:
+            if response.status >= 300:
+                raise RuntimeError(f"El webhook respondió {response.status}.")
+
+class _NotifySink:
+    """NOTIFY por evento en OUTBOX_NOTIFY_CHANNEL; se emite al confirmar la misma transacción que avanza la posición."""
+    name = "notify"
+
+    def __init__(self, channel: str):
+        self.channel = channel
+
+    def deliver(self, cursor, events: List[Dict[str, Any]]) -> None:
+        cursor.execute("SELECT pg_notify(%s, e) FROM unnest(%s::text[]) AS e", (
+            self.channel, [json.dumps(event, ensure_ascii=False, default=str) for event in events]
+        ))
+
+def _build_sinks(names: List[str]) -> List[Any]:
+    tenant = get_tenant().name
+    sinks = []
+    for name in names:
+        if name == "file":
+            path = OUTBOX_FILE_PATH
+            if tenant != "default":
+                path = os.path.join(os.path.dirname(path), tenant, os.path.basename(path))
+            sinks.append(_FileSink(path))
+        elif name == "webhook":
+            if not OUTBOX_WEBHOOK_URL:
+                raise ValueError("El sink webhook requiere OUTBOX_WEBHOOK_URL.")
+            sinks.append(_WebhookSink(OUTBOX_WEBHOOK_URL, None if tenant == "default" else tenant))
+        elif name == "notify":
+            sinks.append(_NotifySink(OUTBOX_NOTIFY_CHANNEL))
+        else:
+            raise ValueError(f"Sink de outbox desconocido: {name} (disponibles: file, webhook, notify).")
+    return sinks
+
+def _dispatch_batch(sink) -> int:
+    conn = get_db_connection()
+    cursor = conn.cursor()
+    try:
+        cursor.execute("""
+            SELECT last_txid, last_event_id FROM outbox_consumers
+            WHERE name = %s
+            FOR UPDATE SKIP LOCKED
+        """, (sink.name,))
+        position = cursor.fetchone()
+        if not position:
+            conn.rollback()
+            return 0
+
+        # txid < xmin: toda transacción que pudiera confirmar un evento anterior ya terminó
+        cursor.execute("""
+            SELECT id, txid, event_type, loan_id, payload, created_at
+            FROM outbox_events
+            WHERE (txid, id) > (%s, %s)
+              AND txid < txid_snapshot_xmin(txid_current_snapshot())
+            ORDER BY txid, id
+            LIMIT %s
+        """, (position["last_txid"], position["last_event_id"], OUTBOX_BATCH_SIZE))
+        rows = cursor.fetchall()
+        if not rows:
+            conn.rollback()
+            return 0
+
+        events = [{
+            "id": row["id"],
+            "event_type": row["event_type"],
+            "loan_id": row["loan_id"],
+            "payload": row["payload"],
+            "created_at": row["created_at"].strftime('%Y-%m-%d %H:%M:%S')
+        } for row in rows]
+        try:
+            sink.deliver(cursor, events)
+        except Exception as e:
+            conn.rollback()
+            cursor.execute("""
+                UPDATE outbox_consumers SET last_error = %s, updated_at = CURRENT_TIMESTAMP WHERE name = %s
+            """, (str(e), sink.name))
+            conn.commit()
+            logger.warning("Sink de outbox %s falló, se reintentará: %s", sink.name, e)
+            return 0
+
+        cursor.execute("""
+            UPDATE outbox_consumers
+            SET last_txid = %s, last_event_id = %s, delivered = delivered + %s,
+                last_error = NULL, updated_at = CURRENT_TIMESTAMP
+            WHERE name = %s
+        """, (rows[-1]["txid"], rows[-1]["id"], len(rows), sink.name))
+        conn.commit()
+        return len(rows)
+    finally:
+        cursor.close()
+        conn.close()
+
+def _prune_outbox() -> int:
+    # Solo eventos ya entregados a todos los consumidores y más viejos que la retención
+    conn = get_db_connection()
+    cursor = conn.cursor()
+    cursor.execute("""
+        WITH slowest AS (
+            SELECT last_txid, last_event_id FROM outbox_consumers
+            ORDER BY last_txid, last_event_id
+            LIMIT 1
+        )
+        DELETE FROM outbox_events e
+        USING slowest
+        WHERE (e.txid, e.id) <= (slowest.last_txid, slowest.last_event_id)
+          AND e.created_at < CURRENT_TIMESTAMP - make_interval(days => %s)
+    """, (OUTBOX_RETENTION_DAYS,))
+    deleted = cursor.rowcount
+    conn.commit()
+    cursor.close()
+    conn.close()
+    return deleted
+
+class _OutboxDispatcher:
+    PRUNE_EVERY_SECONDS = 600
+
+    def __init__(self, sinks: List[Any]):
+        self.sinks = sinks
+        self.stop = threading.Event()
+        conn = get_db_connection()
+        cursor = conn.cursor()
+        for sink in sinks:
+            cursor.execute("INSERT INTO outbox_consumers (name) VALUES (%s) ON CONFLICT DO NOTHING", (sink.name,))
+        conn.commit()
+        cursor.close()
+        conn.close()
+
+    def run_once(self) -> Dict[str, int]:
+        # Vacía lo pendiente de cada sink (lotes completos seguidos) antes de volver a esperar
+        delivered = {}
+        for sink in self.sinks:
+            total = 0
+            while not self.stop.is_set():
+                count = _dispatch_batch(sink)
+                total += count
+                if count < OUTBOX_BATCH_SIZE:
+                    break
+            delivered[sink.name] = total
+        return delivered
+
+    def run(self):
+        logger.info("Dispatcher de outbox activo: %s", ", ".join(s.name for s in self.sinks))
+        last_prune = time.monotonic()
+        while not self.stop.is_set():
+            delivered = {}
+            try:
+                delivered = self.run_once()
+                if time.monotonic() - last_prune > self.PRUNE_EVERY_SECONDS:
+                    last_prune = time.monotonic()
+                    _prune_outbox()
+            except Exception as e:
+                logger.warning("Error en el dispatcher de outbox: %s", e)
+            if not any(delivered.values()):
+                self.stop.wait(OUTBOX_POLL_SECONDS)
+
+def start_outbox_dispatcher() -> List[_OutboxDispatcher]:
+    dispatchers = []
+    for tenant in _TENANTS.values():
+        dispatcher = _run_as_tenant(tenant.name, lambda: _OutboxDispatcher(_build_sinks(OUTBOX_SINKS)))
+        _start_tenant_thread(tenant, dispatcher.run, "outbox-dispatcher")
+        dispatchers.append(dispatcher)
+    return dispatchers
+
+@app.tool
+def Get_outbox_status() -> Dict[str, Any]:
+    """
+    Estado del outbox de eventos: total de eventos, y por consumidor (sink) su posición,
+    eventos entregados, eventos pendientes, antigüedad del pendiente más viejo y último error.
+    """
+    try:
+        conn = get_db_connection()
+        cursor = conn.cursor()
+        cursor.execute("SELECT COUNT(*) AS events, MAX(id) AS last_event_id FROM outbox_events")
+        totals = cursor.fetchone()
+        cursor.execute("""
+            SELECT c.name, c.last_event_id, c.delivered, c.last_error, c.updated_at,
+                   p.pending, p.oldest_pending
+            FROM outbox_consumers c
+            CROSS JOIN LATERAL (
+                SELECT COUNT(*) AS pending, MIN(e.created_at) AS oldest_pending
+                FROM outbox_events e
+                WHERE (e.txid, e.id) > (c.last_txid, c.last_event_id)
+            ) p
+            ORDER BY c.name
+        """)
+        rows = cursor.fetchall()
+        cursor.close()
+        conn.close()
+
+        return {
+            "sinks_enabled": OUTBOX_SINKS,
+            "events": totals["events"],
+            "last_event_id": totals["last_event_id"],
+            "consumers": [{
+                "name": row["name"],
+                "last_event_id": row["last_event_id"],
+                "delivered": row["delivered"],
+                "pending": row["pending"],
+                "oldest_pending": row["oldest_pending"].strftime('%Y-%m-%d %H:%M:%S') if row["oldest_pending"] else None,
+                "last_error": row["last_error"],
+                "updated_at": row["updated_at"].strftime('%Y-%m-%d %H:%M:%S') if row["updated_at"] else None
+            } for row in rows]
+        }
+    except Exception as e:
+        return {"error": f"Error en Get_outbox_status: {str(e)}"}
+
+# ==================== SERVIDOR ====================
+# Con MCP_WORKERS > 1 el proceso principal actúa como supervisor pre-fork:
+# lanza N workers (cada uno con su event loop, GIL y pool de conexiones) en puertos
+# internos y hace de proxy TCP en el puerto público. Cada worker publica su endpoint
+# de mensajes como /messages/w{i}/, así los POST de una sesión SSE siempre llegan
+# al worker que abrió el stream (afinidad de sesión sin estado compartido).
+# El proxy enruta por la línea de petición, así que cada conexión lleva una sola petición:
+# reenvía los encabezados con "Connection: close" y el cliente abre otra conexión (que se
+# vuelve a enrutar) para la siguiente, en vez de reusar la de otro worker con keep-alive.
+
+MCP_HOST = os.getenv("MCP_HOST", "0.0.0.0")
+MCP_PORT = int(os.getenv("MCP_PORT", "3000"))
+MCP_WORKERS = int(os.getenv("MCP_WORKERS", "1"))
+MCP_WORKER_BASE_PORT = int(os.getenv("MCP_WORKER_BASE_PORT", str(MCP_PORT + 100)))
+MCP_DRAIN_TIMEOUT = float(os.getenv("MCP_DRAIN_TIMEOUT", "30"))
+# Presupuesto global de conexiones a la base repartido entre workers
+DB_MAX_CONNECTIONS = int(os.getenv("DB_MAX_CONNECTIONS", str(DB_POOL_MAX * MCP_WORKERS)))
+
+_WORKER_MESSAGE_PATH = re.compile(r"^/messages/w(\d+)/")
+_HOP_BY_HOP_HEADERS = (b"connection", b"keep-alive")
+
+def run_worker():
+    # Warm-up antes de abrir el listener SSE; si la base no responde aún,
+    # se arranca igual y /ready responde 503 hasta que el reintento termine.
+    try:
+        logger.info("Warm-up de base de datos completado: %s", warm_up_db())
+    except Exception as e:
+        logger.warning("Warm-up de base de datos falló, se reintentará en segundo plano: %s", e)
+        threading.Thread(target=_warm_up_until_ready, name="db-warmup", daemon=True).start()
+    if SCHEDULER_ENABLED:
+        start_scheduler()
+    if OUTBOX_SINKS:
+        start_outbox_dispatcher()
+    app.run(
+        transport="sse",
+        host=MCP_HOST,
+        port=MCP_PORT,
+        show_banner=MCP_WORKERS <= 1,
+        uvicorn_config={"timeout_graceful_shutdown": MCP_DRAIN_TIMEOUT}
+    )
+
+class _Supervisor:
+    def __init__(self, workers: int):
+        self.workers = workers
+        self.pool_max = max(1, DB_MAX_CONNECTIONS // workers)
+        self.procs: List[Optional[subprocess.Popen]] = [None] * workers
+        self.active = [0] * workers
+        self.next_worker = 0
+        self.draining = False
+
+    def _spawn(self, index: int) -> subprocess.Popen:
+        env = dict(
+            os.environ,
+            MCP_WORKER_INDEX=str(index),
+            MCP_WORKERS="1",
+            MCP_HOST="127.0.0.1",
+            MCP_PORT=str(MCP_WORKER_BASE_PORT + index),
+            DB_POOL_MAX=str(self.pool_max),
+            DB_POOL_MIN=str(min(DB_POOL_MIN, self.pool_max)),
+            FASTMCP_MESSAGE_PATH=f"/messages/w{index}/"
+        )
+        logger.info("Iniciando worker %s en 127.0.0.1:%s (pool=%s)", index, MCP_WORKER_BASE_PORT + index, self.pool_max)
+        return subprocess.Popen([sys.executable, os.path.abspath(__file__)], env=env)
+
+    def _pick(self, path: str) -> int:
+        match = _WORKER_MESSAGE_PATH.match(path)
+        if match and int(match.group(1)) < self.workers:
+            return int(match.group(1))
+        # Menor cantidad de conexiones activas; empates en round-robin
+        index = min(range(self.workers), key=lambda i: (self.active[i], (i - self.next_worker) % self.workers))
+        self.next_worker = (index + 1) % self.workers
+        return index
+
+    async def _pipe(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        try:
+            while True:
+                data = await reader.read(65536)
+                if not data:
+                    break
+                writer.write(data)
+                await writer.drain()
+        except (ConnectionError, asyncio.CancelledError):
+            pass
+        finally:
+            try:
+                if writer.can_write_eof():
+                    writer.write_eof()
+            except (OSError, RuntimeError):
+                pass
+
+    @staticmethod
+    def _single_request_head(head: bytes) -> bytes:
+        # Encabezados de la petición con keep-alive reemplazado por "Connection: close"
+        request_line, _, headers = head[:-4].partition(b"\r\n")
+        kept = [
+            header for header in headers.split(b"\r\n")
+            if header and header.split(b":", 1)[0].strip().lower() not in _HOP_BY_HOP_HEADERS
+        ]
+        return b"\r\n".join([request_line, *kept, b"Connection: close", b"", b""])
+
+    async def _handle(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        try:
+            head = await reader.readuntil(b"\r\n\r\n")
+        except (asyncio.IncompleteReadError, asyncio.LimitOverrunError, ConnectionError):
+            writer.close()
+            return
+        parts = head.split(b"\r\n", 1)[0].split(b" ")
+        index = self._pick(parts[1].decode("latin-1") if len(parts) > 1 else "/")
+        try:
+            up_reader, up_writer = await asyncio.open_connection("127.0.0.1", MCP_WORKER_BASE_PORT + index)
+        except OSError:
+            writer.write(b"HTTP/1.1 503 Service Unavailable\r\nContent-Length: 0\r\nConnection: close\r\n\r\n")
+            await writer.drain()
+            writer.close()
+            return
+        self.active[index] += 1
+        up_writer.write(self._single_request_head(head))
+        to_upstream = asyncio.create_task(self._pipe(reader, up_writer))
+        try:
+            # El worker cierra al terminar la respuesta; ahí termina también la conexión del cliente
+            await self._pipe(up_reader, writer)
+        finally:
+            to_upstream.cancel()
+            self.active[index] -= 1
+            up_writer.close()
+            writer.close()
+
+    async def _monitor(self):
+        while not self.draining:
+            for i, proc in enumerate(self.procs):
+                if proc.poll() is not None and not self.draining:
+                    logger.warning("Worker %s terminó (código %s), reiniciando", i, proc.returncode)
+                    self.procs[i] = self._spawn(i)
+            await asyncio.sleep(1)
+
+    async def _drain(self, server: asyncio.AbstractServer):
+        # Dejar de aceptar conexiones y pedir a cada worker un apagado ordenado:
+        # uvicorn termina las peticiones en curso hasta MCP_DRAIN_TIMEOUT.
+        self.draining = True
+        server.close()
+        for proc in self.procs:
+            if proc.poll() is None:
+                proc.send_signal(signal.SIGTERM)
+        deadline = time.monotonic() + MCP_DRAIN_TIMEOUT + 5
+        while any(p.poll() is None for p in self.procs) and time.monotonic() < deadline:
+            await asyncio.sleep(0.2)
+        for proc in self.procs:
+            if proc.poll() is None:
+                proc.kill()
+
+    async def run(self):
+        for i in range(self.workers):
+            self.procs[i] = self._spawn(i)
+        server = await asyncio.start_server(self._handle, MCP_HOST, MCP_PORT, reuse_address=True)
+        logger.info("Supervisor escuchando en %s:%s con %s workers", MCP_HOST, MCP_PORT, self.workers)
+        stop = asyncio.Event()
+        loop = asyncio.get_running_loop()
+        for sig in (signal.SIGTERM, signal.SIGINT):
+            loop.add_signal_handler(sig, stop.set)
+        monitor = asyncio.create_task(self._monitor())
+        await stop.wait()
+        logger.info("Señal de apagado recibida, drenando workers")
+        await self._drain(server)
+        monitor.cancel()
+
+def _cli(argv: List[str]) -> int:
+    import argparse
+
+    parser = argparse.ArgumentParser(prog="main.py", description="Loans MCP server")
+    parser.add_argument("--tenant", help="Tenant de DB_TENANTS (por defecto DB_DEFAULT_TENANT)")
+    commands = parser.add_subparsers(dest="command", required=True)
+    verify = commands.add_parser("verify-ledger", help="Verifica el ledger desde la última marca de agua")
+    verify.add_argument("--full", action="store_true", help="Revisar todo el historial")
+    verify.add_argument("--chunk-size", type=int, default=500)
+    verify.add_argument("--parallelism", type=int, default=4)
+    job = commands.add_parser("run-job", help="Ejecuta ahora una tarea programada")
+    job.add_argument("name", choices=sorted(_DEFAULT_JOBS))
+    job.add_argument("--ignore-window", action="store_true", help="Ejecutar aunque esté fuera de su ventana")
+    job.add_argument("--dry-run", action="store_true", help="Simular sin escribir (ni registrar en job_runs)")
+    export = commands.add_parser("export-period", help="Exporta loans, statements y movements de un rango de periodos")
+    export.add_argument("from_period", help="YYYY-MM")
+    export.add_argument("to_period", nargs="?", help="YYYY-MM (inclusivo, por defecto from_period)")
+    export.add_argument("--format", choices=("csv", "parquet"), default="csv")
+    export.add_argument("--tables", nargs="+", choices=EXPORT_TABLES)
+    export.add_argument("--output-dir")
+    export.add_argument("--parallelism", type=int, default=4)
+    outbox = commands.add_parser("outbox-dispatch", help="Entrega los eventos del outbox a los sinks")
+    outbox.add_argument("--sinks", default=",".join(OUTBOX_SINKS) or "file", help="Lista separada por comas: file, webhook, notify")
+    outbox.add_argument("--once", action="store_true", help="Entregar lo pendiente y salir")
+    args = parser.parse_args(argv)
+    _current_tenant.set(get_tenant(args.tenant).name)
+
+    if args.command == "verify-ledger":
+        result = verify_ledger(full=args.full, chunk_size=args.chunk_size, parallelism=args.parallelism)
+        print(json.dumps(result, indent=2, ensure_ascii=False))
+        return 1 if result["discrepancies"] else 0
+    if args.command == "run-job" and args.dry_run:
+        print(json.dumps(simulate_job(args.name), indent=2, ensure_ascii=False, default=str))
+        return 0
+    if args.command == "run-job":
+        result = run_job(args.name, respect_window=not args.ignore_window)
+        print(json.dumps(result, indent=2, ensure_ascii=False, default=str))
+        return 1 if result["status"] == "failed" else 0
+    if args.command == "export-period":
+        result = export_period(args.from_period, args.to_period, args.tables, args.format,
+                               args.output_dir, args.parallelism)
+        print(json.dumps(result, indent=2, ensure_ascii=False, default=str))
+        return 0
+    if args.command == "outbox-dispatch":
+        dispatcher = _OutboxDispatcher(_build_sinks([name.strip() for name in args.sinks.split(",") if name.strip()]))
+        if args.once:
+            print(json.dumps(dispatcher.run_once(), indent=2))
+            return 0
+        signal.signal(signal.SIGTERM, lambda *_: dispatcher.stop.set())
+        try:
+            dispatcher.run()
+        except KeyboardInterrupt:
+            pass
+        return 0
+    return 2
 
 if __name__ == "__main__":
-    app.run(transport="sse", host="0.0.0.0", port=3000)
\ No newline at end of file
+    logging.basicConfig(level=os.getenv("LOG_LEVEL", "INFO"))
+    if len(sys.argv) > 1:
+        sys.exit(_cli(sys.argv[1:]))
+    if MCP_WORKERS > 1:
+        asyncio.run(_Supervisor(MCP_WORKERS).run())
+    else:
+        run_worker()
\ No newline at end of file